@@ -0,0 +1,107 @@
+"""Admission control for the ingest path.
+
+Every event is checked, in memory and before it is queued, against
+
+1. its site's token bucket (INGEST_SITE_RATE events/s refill, INGEST_SITE_BURST
+   capacity, or the site's `ingest_rate_limit` override). Low-priority events
+   may only spend tokens above a reserve, so when a site runs hot its
+   scroll/engagement events are refused first and page views keep flowing.
+   Refusal -> 429.
+2. the fill level of its writer shard queue. Low-priority events are shed once
+   the queue is half full, normal ones at 80%, and high-priority ones only when
+   it is completely full. Refusal -> 503.
+
+Both answers are immediate, so an overloaded site gets a fast 429/503 rather
+than a timeout, and one site's spike cannot starve the others. Limits apply per
+worker process. Shed events are counted per site, reason and priority in
+`ingest_shed_events_total`.
+"""
+import os
+import time
+
+import metrics
+
+SITE_RATE = float(os.getenv("INGEST_SITE_RATE", "200"))
+SITE_BURST = float(os.getenv("INGEST_SITE_BURST", str(SITE_RATE * 5)))
+
+HIGH, NORMAL, LOW = "high", "normal", "low"
+HIGH_PRIORITY = {"page_view", "session_start", "first_visit"}
+LOW_PRIORITY = {"scroll", "user_engagement"}
+
+# share of the bucket a priority class may not dip into
+_TOKEN_RESERVE = {HIGH: 0.0, NORMAL: 0.1, LOW: 0.25}
+# queue fill ratio at which a priority class starts being shed
+_QUEUE_SHED_AT = {HIGH: 1.0, NORMAL: 0.8, LOW: 0.5}
+
+
+def priority_of(event_type):
+    if event_type in HIGH_PRIORITY:
+        return HIGH
+    if event_type in LOW_PRIORITY:
+        return LOW
+    return NORMAL
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, reserve=0.0):
+        """Take one token unless that would leave fewer than `reserve` tokens."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens - 1 < reserve:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        """Seconds until a token is available again (at least 1, for the Retry-After header)."""
+        return max(1, int((1 - self.tokens) / self.rate + 0.999)) if self.rate > 0 else 60
+
+
+class Rejected(Exception):
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+_buckets = {}
+
+
+def _bucket(site_id, rate_limit):
+    rate = float(rate_limit) if rate_limit else SITE_RATE
+    bucket = _buckets.get(site_id)
+    if bucket is None or bucket.rate != rate:
+        burst = SITE_BURST if not rate_limit else rate * 5
+        bucket = _buckets[site_id] = TokenBucket(rate, burst)
+    return bucket
+
+
+def admit(site_id, event_type, queue, rate_limit=None):
+    """Raise Rejected if the event must be shed; otherwise the caller may enqueue it.
+
+    Call only for validated site_ids so the bucket map stays bounded by the site count.
+    """
+    priority = priority_of(event_type)
+
+    maxsize = queue.maxsize or 0
+    if maxsize:
+        fill = queue.qsize() / maxsize
+        if fill >= _QUEUE_SHED_AT[priority]:
+            reason = "queue_full" if fill >= 1.0 else "queue_pressure"
+            metrics.INGEST_SHED_EVENTS.labels(site_id, reason, priority).inc()
+            raise Rejected(503, reason, 1)
+
+    bucket = _bucket(site_id, rate_limit)
+    if not bucket.take(bucket.burst * _TOKEN_RESERVE[priority]):
+        metrics.INGEST_SHED_EVENTS.labels(site_id, "rate_limited", priority).inc()
+        raise Rejected(429, "rate_limited", bucket.retry_after())
@@ -1,10 +1,10 @@
 from fastapi import FastAPI, Request, HTTPException, Form, Body, Depends
 from fastapi.responses import HTMLResponse, Response, FileResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 import os
 import uuid
 import pymysql
@@ -12,11 +12,49 @@ import json
 from dotenv import load_dotenv
 from authlib.integrations.starlette_client import OAuth
 from starlette.middleware.sessions import SessionMiddleware
+from db import get_connection, get_read_connection, init_db
+import codec
+import cold_storage
+import dictionary
+import etl
+import explorer
+import fanout
+import funnel
+import geo
+import governor
+import ingest
+import metrics
+import retention
+import scheduler
+import scroll_depth
+import sessions
+import sketches
+import slow_queries
+import urlnorm
 
 load_dotenv()
-templates = Jinja2Templates(directory="templates")
+templates = metrics.InstrumentedTemplates(directory="templates")
 
-app = FastAPI(title="Analytics API")
+# APP_ROLE=all (default) also serves the ingest endpoints from this app;
+# APP_ROLE=dashboard leaves them to a separately deployed ingest tier (see serve.py)
+APP_ROLE = os.getenv("APP_ROLE", "all")
+
+# replication lag (seconds) each read-only route tolerates before it reads from the primary
+FRESHNESS_REALTIME_SEC = float(os.getenv("FRESHNESS_REALTIME_SEC", "5"))
+FRESHNESS_REPORTS_SEC = float(os.getenv("FRESHNESS_REPORTS_SEC", "300"))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Ingest writers (APP_ROLE=all) and the background job scheduler (scheduler.py)."""
+    async with AsyncExitStack() as stack:
+        if APP_ROLE == "all":
+            await stack.enter_async_context(ingest.lifespan(app))
+        await stack.enter_async_context(scheduler.lifespan(app))
+        yield
+
+
+app = FastAPI(title="Analytics API", lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 # ---------------- CORS ----------------
 # CORS
@@ -34,6 +72,9 @@ app.add_middleware(
     secret_key="SUPER_SECRET_SESSION_KEY"
 )
 
+# Metrics (outermost, so it times the whole middleware stack)
+app.add_middleware(metrics.MetricsMiddleware)
+
 #---------------- OAUTH ----------------
 oauth = OAuth()
 oauth.register(
@@ -44,178 +85,8 @@ oauth.register(
     client_kwargs={"scope": "openid email profile"}
 )
 
-# ---------------- DB CONNECTION ----------------
-def get_connection():
-    return pymysql.connect(
-        host=os.getenv("MYSQL_HOST"),
-        user=os.getenv("MYSQL_USER"),      # user@servername
-        password=os.getenv("MYSQL_PASSWORD"),
-        database=os.getenv("MYSQL_DB"),
-        port=3306,
-        connect_timeout=5,
-        autocommit=True,
-        ssl={"ssl": {}}   # 🔐 SSL ENABLED
-    )
-
-# ---------------- INIT DB ----------------
-def init_db():
-    conn = get_connection()
-    cur = conn.cursor()
-    try:
-        # create users first so FK in sites can reference it
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            email VARCHAR(200) UNIQUE,
-            name VARCHAR(200),
-            picture VARCHAR(500),
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        ) ENGINE=InnoDB
-        """)
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS sites (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            site_id VARCHAR(100) UNIQUE,
-            site_name VARCHAR(200),
-            domain VARCHAR(200),
-            PropertyName VARCHAR(200),
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            user_id INT,
-            INDEX (user_id),
-            CONSTRAINT FK_sites_users FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
-        ) ENGINE=InnoDB
-        """)
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS visitors (
-            id BIGINT AUTO_INCREMENT PRIMARY KEY,
-            visitor_id VARCHAR(100),
-            site_id VARCHAR(100),
-            first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-            last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE KEY uniq_visitor_site (visitor_id, site_id)
-        ) ENGINE=InnoDB
-        """)
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS events (
-            id BIGINT AUTO_INCREMENT PRIMARY KEY,
-            site_id VARCHAR(100),
-            visitor_id VARCHAR(100),
-            event_type VARCHAR(50),
-            page_url TEXT,
-            referrer TEXT,
-            user_agent TEXT,
-            ip_address VARCHAR(50),
-            language VARCHAR(20),
-            platform VARCHAR(50),
-            screen_size VARCHAR(20),
-            timezone VARCHAR(50),
-            clicked_url TEXT,
-            is_external TINYINT(1),
-            page_title VARCHAR(255),
-            scroll_percent INT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            INDEX (site_id),
-            INDEX (visitor_id),
-            INDEX (created_at)
-        ) ENGINE=InnoDB
-        """)
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS TechStack (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            site_id VARCHAR(100),
-            visitor_id VARCHAR(100),
-            Browser VARCHAR(100),
-            BrowserVersion VARCHAR(50),
-            DeviceCat VARCHAR(50),
-            ScreenRes VARCHAR(50),
-            Platform VARCHAR(50),
-            OS VARCHAR(50),
-            OSVersion VARCHAR(50),
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            INDEX (site_id)
-            ,INDEX (visitor_id)
-        ) ENGINE=InnoDB
-        """)
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS site_access (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            site_id VARCHAR(100),
-            user_id INT,
-            role VARCHAR(50) DEFAULT 'admin',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE KEY uniq_access (site_id, user_id),
-            CONSTRAINT FK_access_site FOREIGN KEY (site_id) REFERENCES sites(site_id) ON DELETE CASCADE,
-            CONSTRAINT FK_access_user FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        ) ENGINE=InnoDB
-        """)
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS tracking_rules (
-            id BIGINT AUTO_INCREMENT PRIMARY KEY,
-            site_id VARCHAR(50),
-            event_type VARCHAR(20),
-            selector VARCHAR(255),
-            event_name VARCHAR(100),
-            active BOOLEAN DEFAULT TRUE,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            INDEX (site_id)
-        ) ENGINE=InnoDB
-        """)
-
-        # Watermark table: tracks last processed watermark per table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS watermark (
-            tbl_name VARCHAR(200) PRIMARY KEY,
-            last_watermark DATETIME
-        ) ENGINE=InnoDB
-        """)
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS ip_geolocation (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            ip_address VARCHAR(50) UNIQUE,
-            site_id VARCHAR(100),
-            visitor_id VARCHAR(100),
-            country VARCHAR(100),
-            countryCode VARCHAR(10),
-            region VARCHAR(10),
-            regionName VARCHAR(100),
-            city VARCHAR(100),
-            lat DECIMAL(10, 6),
-            lon DECIMAL(10, 6),
-            timezone VARCHAR(50),
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            INDEX (ip_address)
-        ) ENGINE=InnoDB
-        """)
-
-
-        # Ensure optional columns exist on upgrades
-        try:
-            cur.execute("ALTER TABLE TechStack ADD COLUMN visitor_id VARCHAR(100)")
-        except Exception:
-            pass
-        try:
-            cur.execute("ALTER TABLE events ADD COLUMN page_title VARCHAR(255)")
-        except Exception:
-            pass
-        try:
-            cur.execute("ALTER TABLE events ADD COLUMN scroll_percent INT")
-        except Exception:
-            pass
-
-
-        conn.commit()
-    finally:
-        conn.close()
-        print('DB Init Completed!')
-
 init_db()
+slow_queries.configure(get_connection)
 
 # ---------------- HELPERS ----------------
 def get_user_sites_sql():
@@ -240,44 +111,30 @@ def get_authorized_site_ids(user_id):
     finally:
         conn.close()
 
+def is_admin(request: Request):
+    """Operators allowed to see internal diagnostics (comma separated ADMIN_EMAILS)."""
+    user = request.session.get("user") or {}
+    admins = {e.strip().lower() for e in os.getenv("ADMIN_EMAILS", "").split(",") if e.strip()}
+    return bool(user.get("email")) and user["email"].lower() in admins
+
 def get_current_user(request: Request):
     user = request.session.get("user")
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return user
 
-def get_client_ip(request: Request):
-    """
-    Get the client IP address, handling X-Forwarded-For header
-    if the app is behind a proxy (like Azure App Service).
-    """
-    x_forwarded_for = request.headers.get("X-Forwarded-For")
-    if x_forwarded_for:
-        # The first IP in the list is the original client
-        return x_forwarded_for.split(",")[0].strip()
-    # Fallback to direct connection IP
-    return request.client.host
-
-# ---------------- MODELS ----------------
-class CollectEvent(BaseModel):
-    siteId: str
-    visitorId: str
-    pageUrl: str
-    pageTitle: str
-    referrer: str | None = None
-    userAgent: str
-    language: str | None = None
-    platform: str | None = None
-    screenSize: str | None = None
-    timezone: str | None = None
-    scrollPercent: float | None = None
-    timestamp: str
-
 # ---------------- HEALTH ----------------
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
+# ---------------- METRICS ----------------
+app.include_router(metrics.router)
+
+# ---------------- INGEST (/collect, /rules, /track.js) ----------------
+if APP_ROLE == "all":
+    app.include_router(ingest.router)
+
 # ---------------- INDEX UI ----------------
 @app.get("/", response_class=HTMLResponse)
 async def read_index(request: Request):
@@ -434,6 +291,7 @@ def dashboard(request: Request):
 
 # ---------------- Reports UI ----------------
 @app.get("/reports/referrers", response_class=HTMLResponse)
+@governor.governed("reports_referrers")
 def report_referrers(request: Request):
     user = request.session.get("user")
     user_id = request.session.get("user_id")
@@ -441,7 +299,7 @@ def report_referrers(request: Request):
         raise HTTPException(status_code=401, detail="Not authenticated")
 
     # fetch sites for selector
-    conn = get_connection()
+    conn = get_read_connection("reports_referrers", FRESHNESS_REPORTS_SEC)
     cur = conn.cursor()
     try:
         # REFACTOR: Fetch owned + shared sites
@@ -475,19 +333,30 @@ def report_referrers(request: Request):
         
         if sites and not found_site:
             raise HTTPException(status_code=400, detail="Invalid site_id")
+        governor.enter(cur, site_id)
 
         # optional date range filters: ?start=YYYY-MM-DD&end=YYYY-MM-DD
         start_q = request.query_params.get("start")
         end_q = request.query_params.get("end")
 
-        where_clauses = ["site_id=%s"]
+        # only page loads carry the referrer (track.js sends it with page_view, not with later events)
+        where_clauses = ["site_id=%s", "event_type='page_view'"]
         params = [site_id]
 
+        # site/referrer filters without the date range, used by the cold tier (plain-text referrers)
+        base_clauses = list(where_clauses)
+        base_params = list(params)
+
         # exclude internal referrers if domain is known
         if domain_to_exclude:
-            where_clauses.append("referrer NOT LIKE %s")
-            params.append(f"%{domain_to_exclude}%")
-
+            base_clauses.append("referrer NOT LIKE %s")
+            base_params.append(f"%{domain_to_exclude}%")
+            # hot rows reference url_dict: exclude the referrer ids whose host matches the domain
+            host = urlsplit(domain_to_exclude if "//" in domain_to_exclude else "//" + domain_to_exclude).hostname
+            where_clauses.append("(referrer_id IS NULL OR referrer_id NOT IN (SELECT id FROM url_dict WHERE host LIKE %s))")
+            params.append(f"%{host or domain_to_exclude}%")
+
+        start_dt = end_dt = None
         try:
             if start_q:
                 # treat start as inclusive beginning of day
@@ -504,36 +373,178 @@ def report_referrers(request: Request):
 
         where_sql = " AND ".join(where_clauses)
 
-        # fetch referrers grouped by referrer: total events and distinct visitors
-        sql = f"SELECT referrer, COUNT(*) as ref_count, COUNT(DISTINCT visitor_id) as visitors FROM events WHERE {where_sql} GROUP BY referrer ORDER BY ref_count DESC"
-        cur.execute(sql, tuple(params))
-        ref_rows = cur.fetchall()
+        if cold_storage.reaches_cold(conn, "events", start_dt):
+            # range reaches archived days: merge Parquet partials with the MySQL hot range
+            ref_rows = cold_storage.hybrid_query(
+                cur, "events", site_id, base_clauses, base_params, start_dt, end_dt,
+                "SELECT referrer, visitor_id, SUM(sample_weight) AS cnt, MAX(sample_weight) AS w FROM {table} WHERE {where} GROUP BY referrer, visitor_id",
+                "SELECT referrer, SUM(cnt) AS ref_count, SUM(w) AS visitors FROM "
+                "(SELECT referrer, visitor_id, SUM(cnt) AS cnt, MAX(w) AS w FROM part GROUP BY referrer, visitor_id) v "
+                "GROUP BY referrer ORDER BY ref_count DESC LIMIT 100"
+            )
+        else:
+            # fetch top referrers by id: total events and distinct visitors, scaled by sample weight
+            sql = f"""
+            SELECT referrer_id, SUM(cnt) as ref_count, SUM(w) as visitors FROM (
+                SELECT referrer_id, visitor_id, SUM(sample_weight) as cnt, MAX(sample_weight) as w
+                FROM events WHERE {where_sql} GROUP BY referrer_id, visitor_id
+            ) v GROUP BY referrer_id ORDER BY ref_count DESC LIMIT 100
+            """
+            cur.execute(sql, tuple(params))
+            id_rows = cur.fetchall()
+            names = dictionary.labels(cur, dictionary.URLS, [r[0] for r in id_rows])
+            ref_rows = [(names.get(r[0]), r[1], r[2]) for r in id_rows]
+
         referrers = []
         for r in ref_rows:
             ref = r[0] or ''
             label = ref if ref.strip() else 'Direct'
-            referrers.append({"referrer": label, "count": int(r[1]), "visitors": int(r[2])})
+            referrers.append({"referrer": label, "count": int(round(r[1])), "visitors": int(round(r[2]))})
+
+        # bounce rate, session duration and landing pages for sessions started in the range
+        session_clauses = ["site_id=%s"]
+        session_params = [site_id]
+        if start_dt:
+            session_clauses.append("started_at >= %s")
+            session_params.append(start_dt)
+        if end_dt:
+            session_clauses.append("started_at < %s")
+            session_params.append(end_dt)
+        session_where = " AND ".join(session_clauses)
+
+        session_aggs = """SUM(sample_weight) as sessions,
+                   SUM(IF(pageview_count <= 1 AND engaged = 0, sample_weight, 0)) as bounces,
+                   SUM(TIMESTAMPDIFF(SECOND, started_at, ended_at) * sample_weight) as duration"""
+        cur.execute(f"SELECT {session_aggs} FROM sessions WHERE {session_where}", tuple(session_params))
+        total_sessions, total_bounces, total_duration = cur.fetchone()
+
+        cur.execute(f"""
+            SELECT landing_page_id, {session_aggs}
+            FROM sessions WHERE {session_where}
+            GROUP BY landing_page_id ORDER BY sessions DESC LIMIT 20
+        """, tuple(session_params))
+        landing_rows = cur.fetchall()
+        names = dictionary.labels(cur, dictionary.URLS, [r[0] for r in landing_rows])
+        landing_pages = [{
+            "page": names.get(r[0]) or '(unknown)',
+            "sessions": int(round(r[1])),
+            "bounce_rate": round(r[2] / r[1] * 100, 1) if r[1] else 0,
+            "avg_duration": int(r[3] / r[1]) if r[1] else 0,
+        } for r in landing_rows]
+        avg_duration = int(total_duration / total_sessions) if total_sessions else None
+
+        if total_sessions:
+            bounce_rate = round(total_bounces / total_sessions * 100, 1)
+        else:
+            # no sessions recorded for the range (older data): visitors with only 1 event, weighted like the counts above
+            if cold_storage.reaches_cold(conn, "events", start_dt):
+                visitor_counts = cold_storage.hybrid_query(
+                    cur, "events", site_id, base_clauses, base_params, start_dt, end_dt,
+                    "SELECT visitor_id, COUNT(*) AS cnt, MAX(sample_weight) AS w FROM {table} WHERE {where} GROUP BY visitor_id",
+                    "SELECT visitor_id, SUM(cnt) AS cnt, MAX(w) AS w FROM part GROUP BY visitor_id"
+                )
+            else:
+                sql_vis = f"SELECT visitor_id, COUNT(*) as cnt, MAX(sample_weight) as w FROM events WHERE {where_sql} GROUP BY visitor_id"
+                cur.execute(sql_vis, tuple(params))
+                visitor_counts = cur.fetchall()
+            total_visitors = sum(v[2] for v in visitor_counts)
+            bounce_visitors = sum(v[2] for v in visitor_counts if v[1] == 1)
+            bounce_rate = round((bounce_visitors / total_visitors) * 100, 1) if total_visitors else 0
+
+        return templates.TemplateResponse("report.html", {"request": request, "user": user, "sites": sites, "selected_site": site_id, "referrers": referrers, "bounce_rate": bounce_rate, "avg_duration": avg_duration, "landing_pages": landing_pages})
+    finally:
+        conn.close()
+
+@app.get("/reports/campaigns", response_class=HTMLResponse)
+@governor.governed("reports_campaigns")
+def report_campaigns(request: Request):
+    """UTM campaigns of a site: events, page views and visitors per (utm_source, utm_medium, utm_campaign)."""
+    user = request.session.get("user")
+    user_id = request.session.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    conn = get_read_connection("reports_campaigns", FRESHNESS_REPORTS_SEC)
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT site_name, domain, site_id FROM sites WHERE user_id=%s UNION SELECT s.site_name, s.domain, s.site_id FROM sites s JOIN site_access sa ON s.site_id=sa.site_id WHERE sa.user_id=%s", (user_id, user_id))
+        sites = [{"site_name": r[0], "domain": r[1], "site_id": r[2]} for r in cur.fetchall()]
+
+        site_id = request.query_params.get("site_id")
+        if not site_id:
+            return templates.TemplateResponse("campaigns.html", {"request": request, "user": user, "sites": sites, "selected_site": None, "campaigns": []})
+        if site_id not in [s["site_id"] for s in sites]:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        governor.enter(cur, site_id)
+
+        # optional date range filters: ?start=YYYY-MM-DD&end=YYYY-MM-DD (end inclusive)
+        start_q = request.query_params.get("start")
+        end_q = request.query_params.get("end")
+        try:
+            start_dt = datetime.fromisoformat(start_q) if start_q else None
+            end_dt = datetime.fromisoformat(end_q) + timedelta(days=1) if end_q else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+
+        # tagged events only: a range scan of idx_site_campaign (site_id, utm_source, utm_medium, utm_campaign, created_at)
+        base_clauses = ["site_id=%s", "utm_source IS NOT NULL"]
+        base_params = [site_id]
+        # per-visitor partials, so visitors are distinct (and weighted) within each campaign
+        inner_sql = (
+            "SELECT utm_source, utm_medium, utm_campaign, visitor_id, SUM(sample_weight) AS cnt, "
+            "SUM(CASE WHEN event_type='page_view' THEN sample_weight ELSE 0 END) AS pv, MAX(sample_weight) AS w "
+            "FROM {table} WHERE {where} GROUP BY utm_source, utm_medium, utm_campaign, visitor_id"
+        )
+        outer_sql = (
+            "SELECT utm_source, utm_medium, utm_campaign, SUM(cnt) AS events, SUM(pv) AS page_views, SUM(w) AS visitors "
+            "FROM {part} GROUP BY utm_source, utm_medium, utm_campaign ORDER BY visitors DESC LIMIT 100"
+        )
+
+        if cold_storage.reaches_cold(conn, "events", start_dt):
+            # range reaches archived days: merge Parquet partials with the MySQL hot range
+            rows = cold_storage.hybrid_query(
+                cur, "events", site_id, base_clauses, base_params, start_dt, end_dt, inner_sql,
+                outer_sql.format(part="(SELECT utm_source, utm_medium, utm_campaign, visitor_id, SUM(cnt) AS cnt, SUM(pv) AS pv, "
+                                      "MAX(w) AS w FROM part GROUP BY utm_source, utm_medium, utm_campaign, visitor_id) v")
+            )
+        else:
+            where_clauses = list(base_clauses)
+            params = list(base_params)
+            if start_dt:
+                where_clauses.append("created_at >= %s")
+                params.append(start_dt)
+            if end_dt:
+                where_clauses.append("created_at < %s")
+                params.append(end_dt)
+            cur.execute(
+                outer_sql.format(part=f"({inner_sql.format(table='events', where=' AND '.join(where_clauses))}) v"),
+                tuple(params)
+            )
+            rows = cur.fetchall()
 
-        # compute bounce rate for the same range: visitors with only 1 event
-        sql_vis = f"SELECT visitor_id, COUNT(*) as cnt FROM events WHERE {where_sql} GROUP BY visitor_id"
-        cur.execute(sql_vis, tuple(params))
-        visitor_counts = cur.fetchall()
-        total_visitors = len(visitor_counts)
-        bounce_visitors = sum(1 for v in visitor_counts if v[1] == 1)
-        bounce_rate = round((bounce_visitors / total_visitors) * 100, 1) if total_visitors else 0
+        campaigns = [{
+            "source": r[0],
+            "medium": r[1] or "(none)",
+            "campaign": r[2] or "(none)",
+            "events": int(round(r[3])),
+            "page_views": int(round(r[4])),
+            "visitors": int(round(r[5])),
+        } for r in rows]
 
-        return templates.TemplateResponse("report.html", {"request": request, "user": user, "sites": sites, "selected_site": site_id, "referrers": referrers, "bounce_rate": bounce_rate})
+        return templates.TemplateResponse("campaigns.html", {"request": request, "user": user, "sites": sites, "selected_site": site_id, "campaigns": campaigns})
     finally:
         conn.close()
 
+
 @app.get("/reports/tech", response_class=HTMLResponse)
+@governor.governed("reports_tech")
 def report_tech(request: Request):
     user = request.session.get("user")
     user_id = request.session.get("user_id")
     if not user_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    conn = get_connection()
+    conn = get_read_connection("reports_tech", FRESHNESS_REPORTS_SEC)
     cur = conn.cursor()
     try:
         # Fetch sites owned + shared
@@ -556,6 +567,7 @@ def report_tech(request: Request):
 
         if site_id not in authorized_site_ids:
             raise HTTPException(status_code=403, detail="Not authorized")
+        governor.enter(cur, site_id)
 
         # Filters
         start_q = request.query_params.get("start")
@@ -564,6 +576,7 @@ def report_tech(request: Request):
         where_clauses = ["site_id=%s"]
         params = [site_id]
 
+        start_dt = end_dt = None
         if start_q:
             start_dt = datetime.fromisoformat(start_q)
             where_clauses.append("created_at >= %s")
@@ -574,116 +587,78 @@ def report_tech(request: Request):
             params.append(end_dt)
         
         where_sql = " AND ".join(where_clauses)
+        use_cold = cold_storage.reaches_cold(conn, "TechStack", start_dt)
         
-        # Aggregations
-        data = {}
-        
-        # Browser
-        cur.execute(f"SELECT Browser, COUNT(*) as cnt FROM TechStack WHERE {where_sql} GROUP BY Browser ORDER BY cnt DESC", tuple(params))
-        data["browsers"] = [{"label": r[0], "count": r[1]} for r in cur.fetchall()]
-
-        # OS
-        cur.execute(f"SELECT OS, COUNT(*) as cnt FROM TechStack WHERE {where_sql} GROUP BY OS ORDER BY cnt DESC", tuple(params))
-        data["os"] = [{"label": r[0], "count": r[1]} for r in cur.fetchall()]
-
-        # Device Category
-        cur.execute(f"SELECT DeviceCat, COUNT(*) as cnt FROM TechStack WHERE {where_sql} GROUP BY DeviceCat ORDER BY cnt DESC", tuple(params))
-        data["devices"] = [{"label": r[0], "count": r[1]} for r in cur.fetchall()]
-
-        # Screen Resolution
-        cur.execute(f"SELECT ScreenRes, COUNT(*) as cnt FROM TechStack WHERE {where_sql} GROUP BY ScreenRes ORDER BY cnt DESC", tuple(params))
-        data["screens"] = [{"label": r[0], "count": r[1]} for r in cur.fetchall()]
+        # Aggregations: Browser, OS, Device Category, Screen Resolution (run concurrently)
+        def aggregate(column):
+            def query(cur):
+                if use_cold:
+                    # weighted counts are additive, so cold and hot partials just get summed
+                    rows = cold_storage.hybrid_query(
+                        cur, "TechStack", site_id, ["site_id=%s"], [site_id], start_dt, end_dt,
+                        f"SELECT {column}, SUM(sample_weight) AS cnt FROM {{table}} WHERE {{where}} GROUP BY {column}",
+                        f"SELECT {column}, SUM(cnt) AS cnt FROM part GROUP BY {column} ORDER BY cnt DESC"
+                    )
+                else:
+                    cur.execute(f"SELECT {column}, SUM(sample_weight) as cnt FROM TechStack WHERE {where_sql} GROUP BY {column} ORDER BY cnt DESC", tuple(params))
+                    rows = cur.fetchall()
+                return [{"label": r[0], "count": int(round(r[1]))} for r in rows]
+            return query
+
+        columns = {"browsers": "Browser", "os": "OS", "devices": "DeviceCat", "screens": "ScreenRes"}
+        results = fanout.run("reports_tech", FRESHNESS_REPORTS_SEC, {key: aggregate(c) for key, c in columns.items()})
+        data = {key: results[key] for key in columns}
 
         return templates.TemplateResponse("tech_details.html", {"request": request, "user": user, "sites": sites, "selected_site": site_id, "data": data})
 
     finally:
         conn.close()
-#---------------- Event Collection ----------------
-@app.post("/collect")
-async def collect(request: Request):
-    data = await request.json()
-
-    site_id = data.get("siteId")
-    visitor_id = data.get("visitorId")
 
-    if not site_id or not visitor_id:
-        raise HTTPException(status_code=400, detail="Invalid payload")
 
-    conn = get_connection()
-    cur = conn.cursor()
+@app.get("/reports/retention", response_class=HTMLResponse)
+@governor.governed("reports_retention")
+def report_retention(request: Request):
+    """Cohort retention (?granularity=day|week, ?cohorts=<n>) from the per-day visitor bitmaps."""
+    user = request.session.get("user")
+    user_id = request.session.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
 
+    granularity = "week" if request.query_params.get("granularity") == "week" else "day"
     try:
-        # validate site
-        cur.execute("SELECT 1 FROM sites WHERE site_id=%s", (site_id,))
-        if not cur.fetchone():
-            raise HTTPException(400, "Invalid site_id")
-
-        # visitor upsert - use MySQL ON DUPLICATE KEY UPDATE
-        cur.execute(
-            """
-            INSERT INTO visitors (visitor_id, site_id, last_seen)
-            VALUES (%s, %s, %s)
-            ON DUPLICATE KEY UPDATE last_seen = %s
-            """,
-            (visitor_id, site_id, datetime.utcnow(), datetime.utcnow())
-        )
-
-        # insert event
-        cur.execute("""
-        INSERT INTO events (
-            site_id, visitor_id, event_type,
-            page_url, referrer, user_agent, ip_address,
-            language, platform, screen_size, timezone,
-            clicked_url, is_external, page_title, scroll_percent,
-            created_at
-        ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """, (
-            site_id,
-            visitor_id,
-            data.get("eventType", "page_view"),
-            data.get("pageUrl"),
-            data.get("referrer"),
-            data.get("userAgent"),
-            get_client_ip(request),
-            data.get("language"),
-            data.get("platform"),
-            data.get("screenSize"),
-            data.get("timezone"),
-            data.get("clicked_url"),
-            data.get("is_external"),
-            data.get("pageTitle"),
-            data.get("scrollPercent"),
-            datetime.utcnow()
-        ))
-        conn.commit()
-
-    finally:
-        conn.close()
-
-    return {"status": "ok"}
-
+        cohorts = int(request.query_params.get("cohorts") or (8 if granularity == "week" else 14))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cohorts")
+    cohorts = max(1, min(cohorts, 52 if granularity == "week" else 90))
 
-# ---------------- Tracking rules API ----------------
-@app.get("/rules")
-def get_rules(request: Request):
-    """Public endpoint used by track.js to fetch active rules for a site."""
-    site_id = request.query_params.get("site_id")
-    if not site_id:
-        raise HTTPException(status_code=400, detail="site_id required")
-
-    conn = get_connection()
+    conn = get_read_connection("reports_retention", FRESHNESS_REPORTS_SEC)
     cur = conn.cursor()
     try:
-        cur.execute("SELECT id, selector, event_type, event_name FROM tracking_rules WHERE site_id=%s AND active=1", (site_id,))
-        rows = cur.fetchall()
-        rules = []
-        for r in rows:
-            rules.append({"id": r[0], "selector": r[1], "event_type": r[2], "event_name": r[3]})
-        return {"rules": rules}
+        cur.execute("SELECT site_name, domain, site_id FROM sites WHERE user_id=%s UNION SELECT s.site_name, s.domain, s.site_id FROM sites s JOIN site_access sa ON s.site_id=sa.site_id WHERE sa.user_id=%s", (user_id, user_id))
+        sites = [{"site_name": r[0], "domain": r[1], "site_id": r[2]} for r in cur.fetchall()]
+
+        site_id = request.query_params.get("site_id") or (sites[0]["site_id"] if sites else None)
+        context = {"request": request, "user": user, "sites": sites, "selected_site": site_id,
+                   "granularity": granularity, "cohorts": cohorts, "rows": []}
+        if not site_id:
+            return templates.TemplateResponse("retention.html", context)
+        if site_id not in {s["site_id"] for s in sites}:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        governor.enter(cur, site_id)
+
+        last = datetime.utcnow().date()
+        first = last - timedelta(days=(cohorts - 1) * (7 if granularity == "week" else 1))
+        if granularity == "week":
+            first -= timedelta(days=first.weekday())
+        days = retention.load(cur, site_id, first, last)
+        context["rows"] = retention.matrix(days, first, last, granularity)
+        return templates.TemplateResponse("retention.html", context)
     finally:
         conn.close()
 
 
+# ---------------- Tracking rules API ----------------
+# (the public /rules endpoint used by track.js lives in ingest.py)
 @app.post("/api/rules")
 async def create_rule(request: Request):
     """Create a tracking rule from dashboard. Requires authenticated user who owns the site."""
@@ -747,13 +722,14 @@ def manage_rules_page(request: Request):
 
 
 @app.get("/rule_analysis", response_class=HTMLResponse)
+@governor.governed("rule_analysis")
 def rule_analysis_page(request: Request):
     user = request.session.get("user")
     user_id = request.session.get("user_id")
     if not user_id:
         return RedirectResponse(url="/")
 
-    conn = get_connection()
+    conn = get_read_connection("rule_analysis", FRESHNESS_REPORTS_SEC)
     cur = conn.cursor()
     try:
         # Fetch sites owned + shared
@@ -764,13 +740,16 @@ def rule_analysis_page(request: Request):
         site_id = request.query_params.get("site_id")
         if not site_id and sites:
             site_id = sites[0]["site_id"]
+        if site_id and site_id not in {s["site_id"] for s in sites}:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        governor.enter(cur, site_id)
 
         analysis = []
         if site_id:
             cur.execute(
                 """
                 SELECT tr.id, tr.event_name, tr.selector, tr.active,
-                       COUNT(e.id) AS clicks, MAX(e.created_at) AS last_click
+                       SUM(e.sample_weight) AS clicks, MAX(e.created_at) AS last_click
                 FROM tracking_rules tr
                 LEFT JOIN events e ON e.site_id = tr.site_id AND e.event_type = tr.event_name
                 WHERE tr.site_id=%s
@@ -786,7 +765,7 @@ def rule_analysis_page(request: Request):
                     "event_name": r[1],
                     "selector": r[2],
                     "active": bool(r[3]),
-                    "clicks": int(r[4] or 0),
+                    "clicks": int(round(r[4] or 0)),
                     "last_click": r[5].isoformat() if r[5] else None
                 })
 
@@ -794,16 +773,65 @@ def rule_analysis_page(request: Request):
     finally:
         conn.close()
 
+@app.get("/reports/funnel", response_class=HTMLResponse)
+@governor.governed("reports_funnel")
+def report_funnel(request: Request):
+    """Conversion funnel over an ordered list of event names.
+    ?steps=a,b,c  ?window=<hours, default 24>  ?start= / ?end= (default: last 30 days)
+    """
+    user = request.session.get("user")
+    user_id = request.session.get("user_id")
+    if not user_id:
+        return RedirectResponse(url="/")
+
+    steps = [s.strip() for s in (request.query_params.get("steps") or "").split(",") if s.strip()]
+    if len(steps) > funnel.MAX_STEPS:
+        raise HTTPException(status_code=400, detail=f"At most {funnel.MAX_STEPS} steps")
+    try:
+        window_hours = float(request.query_params.get("window") or 24)
+        end_q = request.query_params.get("end")
+        start_q = request.query_params.get("start")
+        end_dt = datetime.fromisoformat(end_q) + timedelta(days=1) if end_q else datetime.utcnow()
+        start_dt = datetime.fromisoformat(start_q) if start_q else end_dt - timedelta(days=30)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid window or date")
+
+    conn = get_read_connection("reports_funnel", FRESHNESS_REPORTS_SEC)
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT site_name, domain, site_id FROM sites WHERE user_id=%s UNION SELECT s.site_name, s.domain, s.site_id FROM sites s JOIN site_access sa ON s.site_id=sa.site_id WHERE sa.user_id=%s", (user_id, user_id))
+        sites = [{"site_name": r[0], "domain": r[1], "site_id": r[2]} for r in cur.fetchall()]
+
+        site_id = request.query_params.get("site_id") or (sites[0]["site_id"] if sites else None)
+        if site_id and site_id not in {s["site_id"] for s in sites}:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        governor.enter(cur, site_id)
+
+        event_names = ["page_view", "session_start", "first_visit", "click"]
+        result = []
+        if site_id:
+            cur.execute("SELECT DISTINCT event_name FROM tracking_rules WHERE site_id=%s ORDER BY event_name", (site_id,))
+            event_names += [r[0] for r in cur.fetchall() if r[0]]
+            if steps:
+                result = funnel.run(cur, site_id, steps, start_dt, end_dt, window_hours * 3600)
+
+        return templates.TemplateResponse("funnel.html", {
+            "request": request, "user": user, "sites": sites, "selected_site": site_id,
+            "steps": steps, "window": window_hours, "event_names": event_names, "funnel": result
+        })
+    finally:
+        conn.close()
 
 
 @app.get("/reports/demographics", response_class=HTMLResponse)
+@governor.governed("reports_demographics")
 def report_demographics(request: Request):
     user = request.session.get("user")
     user_id = request.session.get("user_id")
     if not user_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    conn = get_connection()
+    conn = get_read_connection("reports_demographics", FRESHNESS_REPORTS_SEC)
     cur = conn.cursor()
     try:
         # Fetch sites owned + shared (reused logic)
@@ -819,29 +847,28 @@ def report_demographics(request: Request):
         authorized_ids = [s["site_id"] for s in sites]
         if site_id and site_id not in authorized_ids:
              raise HTTPException(status_code=403, detail="Not authorized")
+        governor.enter(cur, site_id)
 
         locations = []
         if site_id:
-            # Aggregate visitor locations
-            # Count distinct visitors per location
+            # Top cities for the table; the map loads its clusters from /api/geo_clusters
             sql = """
-            SELECT country, regionName, city, lat, lon, COUNT(DISTINCT visitor_id) as visitors
+            SELECT country, MAX(countryCode), regionName, city, COUNT(DISTINCT visitor_id) as visitors
             FROM ip_geolocation
-            WHERE site_id=%s AND lat IS NOT NULL AND lon IS NOT NULL
-            GROUP BY country, regionName, city, lat, lon
+            WHERE site_id=%s
+            GROUP BY country, regionName, city
             ORDER BY visitors DESC
-            LIMIT 1000
+            LIMIT 100
             """
             cur.execute(sql, (site_id,))
             loc_rows = cur.fetchall()
             for r in loc_rows:
                 locations.append({
                     "country": r[0],
-                    "region": r[1],
-                    "city": r[2],
-                    "lat": float(r[3]),
-                    "lon": float(r[4]),
-                    "visitors": int(r[5])
+                    "countryCode": r[1],
+                    "region": r[2],
+                    "city": r[3],
+                    "visitors": int(r[4])
                 })
 
         return templates.TemplateResponse("demographics.html", {
@@ -855,14 +882,94 @@ def report_demographics(request: Request):
         conn.close()
 
 
+@app.get("/api/geo_clusters")
+@governor.governed("geo_clusters")
+def geo_clusters(request: Request):
+    """Visitor location clusters of one site for the map viewport.
+    Query: site_id, zoom, bbox=west,south,east,north (degrees).
+    """
+    user_id = request.session.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    site_id = request.query_params.get("site_id")
+    try:
+        zoom = int(request.query_params.get("zoom", 2))
+        west, south, east, north = (float(v) for v in request.query_params.get("bbox", "-180,-90,180,90").split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid zoom or bbox")
+
+    conn = get_read_connection("geo_clusters", FRESHNESS_REPORTS_SEC)
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT site_id FROM sites WHERE user_id=%s UNION SELECT site_id FROM site_access WHERE user_id=%s", (user_id, user_id))
+        if site_id not in [r[0] for r in cur.fetchall()]:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        governor.enter(cur, site_id)
+        return codec.FastJSONResponse({
+            "zoom": max(0, min(zoom, geo.MAX_ZOOM)),
+            "clusters": geo.clusters(cur, site_id, zoom, west, south, east, north)
+        })
+    finally:
+        conn.close()
+
+
+@app.get("/api/events")
+@governor.governed("events_explorer")
+def events_explorer(request: Request):
+    """Raw events of one site, newest first, keyset-paginated (see explorer.py).
+    Query: site_id, start, end (YYYY-MM-DD, end inclusive, or ISO datetimes), event_type,
+    page (URL), visitor_id, fields (comma-separated), limit, cursor (next_cursor of the previous page).
+    """
+    user_id = request.session.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    q = request.query_params
+    site_id = q.get("site_id")
+    if not site_id:
+        raise HTTPException(status_code=400, detail="site_id is required")
+    filters = {}
+    try:
+        if q.get("start"):
+            filters["start"] = datetime.fromisoformat(q["start"])
+        if q.get("end"):
+            # a bare date is inclusive -> add one day and use < end
+            filters["end"] = datetime.fromisoformat(q["end"]) + (timedelta(days=1) if len(q["end"]) == 10 else timedelta(0))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD or an ISO datetime")
+    for name in ("event_type", "page", "visitor_id"):
+        if q.get(name):
+            filters[name] = q[name]
+    try:
+        fields = explorer.parse_fields(q.get("fields"))
+        limit = max(1, min(int(q.get("limit", explorer.DEFAULT_LIMIT)), explorer.MAX_LIMIT))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e) if isinstance(e, explorer.InvalidQuery) else "Invalid limit")
+
+    conn = get_read_connection("events_explorer", FRESHNESS_REALTIME_SEC)
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT site_id FROM sites WHERE user_id=%s UNION SELECT site_id FROM site_access WHERE user_id=%s", (user_id, user_id))
+        if site_id not in [r[0] for r in cur.fetchall()]:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        governor.enter(cur, site_id)
+        try:
+            events, next_cursor = explorer.page(cur, site_id, filters, fields, limit, q.get("cursor"))
+        except explorer.InvalidQuery as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return codec.FastJSONResponse({"events": events, "next_cursor": next_cursor})
+    finally:
+        conn.close()
+
+
 @app.get("/audience", response_class=HTMLResponse)
+@governor.governed("audience")
 def audience_page(request: Request):
     user = request.session.get("user")
     user_id = request.session.get("user_id")
     if not user_id:
         return RedirectResponse(url="/")
 
-    conn = get_connection()
+    conn = get_read_connection("audience", FRESHNESS_REPORTS_SEC)
     cur = conn.cursor()
     try:
         # Fetch sites owned + shared
@@ -873,42 +980,46 @@ def audience_page(request: Request):
         site_id = request.query_params.get("site_id")
         if not site_id and sites:
             site_id = sites[0]["site_id"]
+        if site_id and site_id not in {s["site_id"] for s in sites}:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        governor.enter(cur, site_id)
 
         # optional date filters
         start_q = request.query_params.get("start")
         end_q = request.query_params.get("end")
-        where_clauses = ["site_id=%s", "scroll_percent IS NOT NULL"]
-        params = [site_id]
+        start_day = end_day = None
         try:
             if start_q:
-                start_dt = datetime.fromisoformat(start_q)
-                where_clauses.append("created_at >= %s")
-                params.append(start_dt)
+                start_day = datetime.fromisoformat(start_q).date()
             if end_q:
-                end_dt = datetime.fromisoformat(end_q) + timedelta(days=1)
-                where_clauses.append("created_at < %s")
-                params.append(end_dt)
+                end_day = datetime.fromisoformat(end_q).date() + timedelta(days=1)
         except Exception:
             raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
 
-        where_sql = " AND ".join(where_clauses)
+        # summaries from the per-day scroll histograms and visitor sketches (scroll_depth.py); independent, run concurrently
+        def pages_query(cur):
+            page_hists = scroll_depth.top_pages(cur, site_id, start_day, end_day)
+            names = dictionary.labels(cur, dictionary.URLS, [pid for pid, _ in page_hists if pid])
+            return [(names.get(pid), hist) for pid, hist in page_hists]
 
-        scroll_buckets_sql = f"SELECT CASE WHEN scroll_percent>=100 THEN '100' WHEN scroll_percent>=90 THEN '90-99' WHEN scroll_percent>=70 THEN '70-89' WHEN scroll_percent>=50 THEN '50-69' ELSE '<50' END as bucket, COUNT(*) as cnt, COUNT(DISTINCT visitor_id) as visitors FROM events WHERE {where_sql} GROUP BY bucket ORDER BY cnt DESC"
-        cur.execute(scroll_buckets_sql, tuple(params))
-        bucket_rows = cur.fetchall()
-        buckets = [{"bucket": r[0], "count": int(r[1]), "visitors": int(r[2])} for r in bucket_rows]
+        results = fanout.run("audience", FRESHNESS_REPORTS_SEC, {
+            "histogram": lambda cur: scroll_depth.site_histogram(cur, site_id, start_day, end_day),
+            "visitors": lambda cur: scroll_depth.visitors(cur, site_id, start_day, end_day),
+            "pages": pages_query,
+        })
+        histogram, bucket_visitors = results["histogram"], results["visitors"]
 
-        # average scroll percent
-        cur.execute(f"SELECT AVG(scroll_percent) FROM events WHERE {where_sql}", tuple(params))
-        avg_row = cur.fetchone()
-        avg_scroll = float(avg_row[0]) if avg_row and avg_row[0] is not None else 0
+        buckets = [{"bucket": label, "count": int(round(count)), "visitors": int(round(bucket_visitors.get(label, 0)))}
+                   for label, count in scroll_depth.buckets(histogram).items() if count]
+        buckets.sort(key=lambda b: -b["count"])
+        overall = scroll_depth.summary(histogram)
 
-        # top pages by average scroll
-        cur.execute(f"SELECT page_url, AVG(scroll_percent) as avg_sc, COUNT(*) as cnt FROM events WHERE {where_sql} GROUP BY page_url ORDER BY avg_sc DESC LIMIT 20", tuple(params))
-        page_rows = cur.fetchall()
-        top_pages = [{"url": r[0], "avg_scroll": round(float(r[1]),1) if r[1] is not None else 0, "count": int(r[2])} for r in page_rows]
+        top_pages = []
+        for url, hist in results["pages"]:
+            page = scroll_depth.summary(hist)
+            top_pages.append({"url": url, "avg_scroll": round(page["avg"], 1), "p50": page["p50"], "p90": page["p90"], "count": int(round(page["events"]))})
 
-        return templates.TemplateResponse("audience.html", {"request": request, "user": user, "sites": sites, "selected_site": site_id, "buckets": buckets, "avg_scroll": round(avg_scroll,1), "top_pages": top_pages})
+        return templates.TemplateResponse("audience.html", {"request": request, "user": user, "sites": sites, "selected_site": site_id, "buckets": buckets, "avg_scroll": round(overall["avg"], 1), "p50_scroll": overall["p50"], "p90_scroll": overall["p90"], "top_pages": top_pages})
     finally:
         conn.close()
 
@@ -920,7 +1031,7 @@ def realtime_metrics(request: Request):
     if not user_id:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    conn = get_connection()
+    conn = get_read_connection("realtime", FRESHNESS_REALTIME_SEC)
     cur = conn.cursor()
 
     try:
@@ -937,15 +1048,16 @@ def realtime_metrics(request: Request):
             site_ids = [site_param]
 
         if not site_ids:
-            return {
+            return codec.FastJSONResponse({
                 "activeUsers": 0,
                 "pageViews": 0,
                 "avgDuration": 0,
                 "bounceRate": 0,
                 "timeseries": {"labels": [], "values": []},
                 "trafficSources": {},
-                "topPages": []
-            }
+                "topPages": [],
+                "topReferrers": []
+            })
 
         placeholders = ",".join(["%s"] * len(site_ids))
 
@@ -953,144 +1065,104 @@ def realtime_metrics(request: Request):
         threshold_5 = datetime.utcnow() - timedelta(minutes=5)
         threshold_30 = datetime.utcnow() - timedelta(minutes=30)
 
+        # Counts are scaled by sample_weight; distinct visitors are summed per visitor
+        # (a visitor's events all share one weight since sampling is per visitor).
+
+        # the queries below are independent; fanout runs them concurrently on pooled read connections
+        def scalar(sql, params):
+            def query(cur):
+                cur.execute(sql, params)
+                return int(round(cur.fetchone()[0] or 0))
+            return query
+
+        tasks = {}
+
         # active users right now (last 5 minutes)
-        sql = f"SELECT COUNT(DISTINCT visitor_id) FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s"
-        cur.execute(sql, tuple(site_ids) + (threshold_5,))
-        active_users = cur.fetchone()[0] or 0
+        sql = f"/* active_users */ SELECT SUM(w) FROM (SELECT MAX(sample_weight) AS w FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s GROUP BY visitor_id) v"
+        tasks["active_users"] = scalar(sql, tuple(site_ids) + (threshold_5,))
 
         # page views last 30 minutes
-        sql = f"SELECT COUNT(*) FROM events WHERE site_id IN ({placeholders}) AND event_type=%s AND created_at >= %s"
-        params = tuple(site_ids) + ("page_view", threshold_30)
-        cur.execute(sql, params)
-        page_views = cur.fetchone()[0] or 0
-
-        # average session duration in seconds (approx) over last 30 minutes
-        sql = f"SELECT visitor_id, MIN(created_at) as min_ts, MAX(created_at) as max_ts FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s GROUP BY visitor_id"
-        cur.execute(sql, tuple(site_ids) + (threshold_30,))
-        sessions = cur.fetchall()
-        durations = []
-        for v in sessions:
-            min_ts = v[1]
-            max_ts = v[2]
-            if min_ts and max_ts:
-                diff = (max_ts - min_ts).total_seconds()
-                durations.append(diff)
-        avg_duration = int(sum(durations) / len(durations)) if durations else 0
-
-        # bounce rate (visitors with only 1 event in window)
-        total_visitors = len(sessions)
-        bounce_visitors = sum(1 for v in sessions if v and v[1] == v[2])
-        bounce_rate = round((bounce_visitors / total_visitors) * 100, 1) if total_visitors else 0
+        sql = f"/* page_views */ SELECT SUM(sample_weight) FROM events WHERE site_id IN ({placeholders}) AND event_type=%s AND created_at >= %s"
+        tasks["page_views"] = scalar(sql, tuple(site_ids) + ("page_view", threshold_30))
+
+        # average session duration, bounce rate and traffic sources over sessions active in the last 30 minutes
+        def session_query(cur):
+            sql = f"""/* sessions */ SELECT source, SUM(sample_weight),
+                       SUM(IF(pageview_count <= 1 AND engaged = 0, sample_weight, 0)),
+                       SUM(TIMESTAMPDIFF(SECOND, started_at, ended_at) * sample_weight)
+                FROM sessions WHERE site_id IN ({placeholders}) AND ended_at >= %s GROUP BY source"""
+            cur.execute(sql, tuple(site_ids) + (threshold_30,))
+            return cur.fetchall()
+        tasks["sessions"] = session_query
 
         # timeseries - active users per minute for last 30 minutes
         labels = []
-        values = []
         now = datetime.utcnow()
         for i in range(30, -1, -1):
             start = now - timedelta(minutes=i)
             end = start + timedelta(minutes=1)
-            sql = f"SELECT COUNT(DISTINCT visitor_id) FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s AND created_at < %s"
-            params = tuple(site_ids) + (start, end)
-            cur.execute(sql, params)
-            val = cur.fetchone()[0] or 0
+            sql = f"/* timeseries */ SELECT SUM(w) FROM (SELECT MAX(sample_weight) AS w FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s AND created_at < %s GROUP BY visitor_id) v"
+            tasks[("timeseries", i)] = scalar(sql, tuple(site_ids) + (start, end))
             labels.append(start.strftime('%H:%M'))
-            values.append(val)
 
-        # traffic sources (simple classification based on referrer, last 30 minutes)
-        sql = f"SELECT referrer, COUNT(*) as cnt FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s GROUP BY referrer"
-        cur.execute(sql, tuple(site_ids) + (threshold_30,))
-        ref_rows = cur.fetchall()
-        sources = {"Direct": 0, "Organic": 0, "Social": 0, "Referral": 0, "Email": 0}
-        for r in ref_rows:
-            ref = r[0] or ''
-            cnt = r[1]
-            ref_low = ref.lower()
-            if not ref:
-                sources["Direct"] += cnt
-            elif any(k in ref_low for k in ["google", "bing", "yahoo"]):
-                sources["Organic"] += cnt
-            elif any(k in ref_low for k in ["facebook", "twitter", "instagram", "linkedin", "t.co"]):
-                sources["Social"] += cnt
-            elif "mailto:" in ref_low or "email" in ref_low:
-                sources["Email"] += cnt
-            else:
-                sources["Referral"] += cnt
-
-        # top pages (last 30 minutes) - Python aggregation for better metrics
-        # Fetch raw events for last 30 mins
-        sql = f"SELECT visitor_id, page_url, page_title, event_type, created_at FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s"
-        cur.execute(sql, tuple(site_ids) + (threshold_30,))
-        raw_events = cur.fetchall()
-
-        # Process events
-        # visitor_events: {visitor_id: [events...]}
-        visitor_events = {}
-        # page_stats: {url: {'title': str, 'views': int, 'visitors': set(), 'events': int, 'bounces': int}}
-        page_stats = {}
-        
-        for r in raw_events:
-            vid = r[0]
-            url = r[1]
-            title = r[2]
-            etype = r[3]
-            
-            if vid not in visitor_events:
-                visitor_events[vid] = []
-            visitor_events[vid].append(r)
-            
-            if url not in page_stats:
-                page_stats[url] = {'title': title, 'views': 0, 'visitors': set(), 'events': 0, 'bounces': 0}
-            
-            # Update title if present (take last non-empty)
-            if title:
-                page_stats[url]['title'] = title
-                
-            page_stats[url]['events'] += 1
-            page_stats[url]['visitors'].add(vid)
-            
-            if etype == 'page_view':
-                page_stats[url]['views'] += 1
-
-        # Calculate bounces
-        # A bounce is a visitor with exactly 1 total event in this window.
-        balanced_visitor_events = {k: v for k, v in visitor_events.items()} # simple copy/ref if needed, but not really needed
-        
-        for vid, events in visitor_events.items():
-            if len(events) == 1:
-                # This visitor bounced. Attribute the bounce to the page they visited.
-                bounce_url = events[0][1]
-                if bounce_url in page_stats:
-                    page_stats[bounce_url]['bounces'] += 1
-
-        # Format top pages list
-        top_pages = []
-        for url, stats in page_stats.items():
-            users = len(stats['visitors'])
-            bounce_rate = 0
-            if users > 0:
-                bounce_rate = round((stats['bounces'] / users) * 100, 1)
-                
-            top_pages.append({
-                'url': url,
-                'title': stats['title'] or '(No Title)',
-                'views': stats['views'],
-                'users': users,
-                'event_count': stats['events'],
-                'bounce_rate': bounce_rate
-            })
-            
-        # Sort by active users desc, then views desc
-        top_pages.sort(key=lambda x: (x['users'], x['views']), reverse=True)
-        # return top 50
-        # return top 50
-        top_pages = top_pages[:50]
+        # top pages and referrers (last 30 minutes): merge the ingest workers' per-minute
+        # Space-Saving/HyperLogLog sketches instead of scanning raw events
+        def top_query(cur):
+            sql = f"/* sketches */ SELECT sketch FROM realtime_sketches WHERE site_id IN ({placeholders}) AND minute >= %s"
+            cur.execute(sql, tuple(site_ids) + (threshold_30.replace(second=0, microsecond=0),))
+            merged = sketches.merge(r[0] for r in cur.fetchall())
+            top_pages = merged.top_pages(50)
+            top_referrers = merged.top_referrers(10)
+
+            # per-page bounce rate of sessions that landed on the listed pages
+            page_bounces = {}
+            page_ids = [p["page_id"] for p in top_pages]
+            if page_ids:
+                sql = f"""/* page_bounces */ SELECT landing_page_id, SUM(sample_weight),
+                           SUM(IF(pageview_count <= 1 AND engaged = 0, sample_weight, 0))
+                    FROM sessions WHERE site_id IN ({placeholders}) AND ended_at >= %s
+                      AND landing_page_id IN ({",".join(["%s"] * len(page_ids))})
+                    GROUP BY landing_page_id"""
+                cur.execute(sql, tuple(site_ids) + (threshold_30,) + tuple(page_ids))
+                page_bounces = {r[0]: round(r[2] / r[1] * 100, 1) if r[1] else 0 for r in cur.fetchall()}
+
+            # page and referrer ids -> URLs, only for the rows returned
+            names = dictionary.labels(cur, dictionary.URLS, page_ids + [r["referrer_id"] for r in top_referrers])
+            top_pages = [{
+                'url': names.get(p["page_id"]),
+                'title': p["title"] or '(No Title)',
+                'views': int(round(p["views"])),
+                'users': int(round(p["users"])),
+                'event_count': int(round(p["event_count"])),
+                'bounce_rate': page_bounces.get(p["page_id"], 0)
+            } for p in top_pages]
+            top_referrers = [{'url': names.get(r["referrer_id"]), 'views': int(round(r["views"]))} for r in top_referrers]
+            return top_pages, top_referrers
+        tasks["top"] = top_query
 
         # active users last 30 minutes
-        sql = f"SELECT COUNT(DISTINCT visitor_id) FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s"
-        cur.execute(sql, tuple(site_ids) + (threshold_30,))
-        active_users_30 = cur.fetchone()[0] or 0
-
-        return {
+        sql = f"/* active_users_30 */ SELECT SUM(w) FROM (SELECT MAX(sample_weight) AS w FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s GROUP BY visitor_id) v"
+        tasks["active_users_30"] = scalar(sql, tuple(site_ids) + (threshold_30,))
+
+        results = fanout.run("realtime", FRESHNESS_REALTIME_SEC, tasks)
+        active_users = results["active_users"]
+        active_users_30 = results["active_users_30"]
+        page_views = results["page_views"]
+        values = [results[("timeseries", i)] for i in range(30, -1, -1)]
+        top_pages, top_referrers = results["top"]
+
+        source_rows = results["sessions"]
+        total_sessions = sum(r[1] for r in source_rows)
+        avg_duration = int(sum(r[3] for r in source_rows) / total_sessions) if total_sessions else 0
+        bounce_rate = round(sum(r[2] for r in source_rows) / total_sessions * 100, 1) if total_sessions else 0
+
+        # traffic sources: sessions active in the last 30 minutes by the source class of their referrer
+        sources = {s: 0 for s in sessions.SOURCES}
+        for r in source_rows:
+            if r[0] in sources:
+                sources[r[0]] = int(round(r[1]))
+
+        return codec.FastJSONResponse({
             "activeUsers": active_users,
             "activeUsers30": active_users_30,
             "pageViews": page_views,
@@ -1098,8 +1170,9 @@ def realtime_metrics(request: Request):
             "bounceRate": bounce_rate,
             "timeseries": {"labels": labels, "values": values},
             "trafficSources": sources,
-            "topPages": top_pages
-        }
+            "topPages": top_pages,
+            "topReferrers": top_referrers
+        })
 
     finally:
         conn.close()
@@ -1120,14 +1193,14 @@ def event_counts(request: Request):
     except Exception:
         minutes = 30
 
-    conn = get_connection()
+    conn = get_read_connection("event_counts", FRESHNESS_REALTIME_SEC)
     cur = conn.cursor()
     try:
         cur.execute("SELECT site_id FROM sites WHERE user_id=%s UNION SELECT site_id FROM site_access WHERE user_id=%s", (user_id, user_id))
         rows = cur.fetchall()
         site_ids = [r[0] for r in rows]
         if not site_ids:
-            return {"counts": []}
+            return codec.FastJSONResponse({"counts": []})
 
         # allow optional site filter via query param
         site_param = request.query_params.get("site_id")
@@ -1138,14 +1211,14 @@ def event_counts(request: Request):
 
         placeholders = ",".join(["%s"] * len(site_ids))
         threshold_dt = datetime.utcnow() - timedelta(minutes=minutes)
-        sql = f"SELECT event_type, COUNT(*) as cnt FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s GROUP BY event_type ORDER BY cnt DESC"
+        sql = f"SELECT event_type, SUM(sample_weight) as cnt FROM events WHERE site_id IN ({placeholders}) AND created_at >= %s GROUP BY event_type ORDER BY cnt DESC"
         params = tuple(site_ids) + (threshold_dt,)
         cur.execute(sql, params)
         rows = cur.fetchall()
 
         # ensure common event types are present with zero count if missing
         common = ["page_view", "click", "form_start", "scroll", "session_start", "user_engagement"]
-        counts = {r[0]: r[1] for r in rows}
+        counts = {r[0]: int(round(r[1])) for r in rows}
         result = []
         # add existing counts first (ordered by count desc)
         ordered = sorted(counts.items(), key=lambda x: -x[1])
@@ -1156,7 +1229,7 @@ def event_counts(request: Request):
             if c not in counts:
                 result.append({"event": c, "count": 0})
 
-        return {"counts": result}
+        return codec.FastJSONResponse({"counts": result})
     finally:
         conn.close()
 #---------------- Logout ----------------
@@ -1180,45 +1253,185 @@ def session_info(request: Request):
 
     return {"session": session_data}
 
-#---------------- Serve track.js ----------------
-@app.get("/track.js")
-def track_js():
-    return FileResponse(
-        path="static/track.js",
-        media_type="application/javascript",
-        headers={
-            "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
-            "Pragma": "no-cache",
-            "Expires": "0"
-        }
-    )
-
+#---------------- Slow queries (admin) ----------------
+@app.get("/admin/slow_queries", response_class=HTMLResponse)
+def slow_queries_page(request: Request):
+    """Top slow-query fingerprints by total time, with sampled EXPLAIN plans."""
+    if not request.session.get("user_id"):
+        return RedirectResponse(url="/")
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return templates.TemplateResponse("slow_queries.html", {
+        "request": request,
+        "user": request.session.get("user"),
+        "queries": slow_queries.top(),
+        "threshold_ms": slow_queries.SLOW_QUERY_MS
+    })
 
 #---------------- Run the app ----------------
 
 
 @app.post("/run/update_events_watermark")
 def run_update_events_watermark(request: Request):
-    """Execute the stored procedure `update_events_watermark`.
+    """Run the incremental events pipeline (TechStack + IP list) and advance the watermarks.
+    Only accepts POST requests. Optional ?site_id= limits the run to one site.
+    """
+    site_param = request.query_params.get("site_id")
+    try:
+        processed = etl.run_pipeline(get_connection, [site_param] if site_param else None)
+    except Exception as e:
+        print("Error running events pipeline:", e)
+        raise HTTPException(status_code=500, detail="Failed to run events pipeline")
+    failed = [sid for sid, n in processed.items() if n is None]
+    return {"status": "error" if failed else "ok", "processed": processed, "failed": failed}
+
+
+@app.get("/run/update_events_watermark/lag")
+def events_pipeline_lag(request: Request):
+    """Report how far the events pipeline trails the newest event, per site."""
+    conn = get_connection()
+    try:
+        return {"sites": etl.pipeline_lag(conn)}
+    finally:
+        conn.close()
+
+@app.post("/run/archive_events")
+def run_archive_events(request: Request):
+    """Move closed days of events/TechStack past the hot retention window to the Parquet cold tier.
     Only accepts POST requests.
     """
     conn = get_connection()
-    cur = conn.cursor()
     try:
-        cur.callproc("update_events_watermark")
-        # consume any resultsets the procedure may produce
-        try:
-            cur.fetchall()
-        except Exception:
-            pass
-        conn.commit()
-        return {"status": "ok"}
+        moved = cold_storage.archive_closed_days(conn)
+        return {"status": "ok", "archived": moved}
+    except Exception as e:
+        print("Error archiving events to cold storage:", e)
+        raise HTTPException(status_code=500, detail="Failed to archive events")
+    finally:
+        conn.close()
+
+@app.post("/run/backfill_dictionary")
+def run_backfill_dictionary(request: Request):
+    """Move page_url/referrer/user_agent of events written before dictionary encoding into the dictionaries.
+    Resumable; ?batches=<n> limits the work done per call.
+    """
+    batches = request.query_params.get("batches")
+    conn = get_connection()
+    try:
+        converted = dictionary.backfill_events(conn, int(batches) if batches else None)
+        return {"status": "ok", "converted": converted}
     except Exception as e:
-        print("Error executing stored procedure update_events_watermark:", e)
-        raise HTTPException(status_code=500, detail="Failed to execute stored procedure")
+        print("Error backfilling string dictionaries:", e)
+        raise HTTPException(status_code=500, detail="Failed to backfill dictionaries")
     finally:
         conn.close()
 
+@app.post("/run/backfill_page_paths")
+def run_backfill_page_paths(request: Request):
+    """Set the normalized page URL (page_path_id) on events written before URL normalization.
+    Resumable; ?batches=<n> limits the work done per call.
+    """
+    batches = request.query_params.get("batches")
+    conn = get_connection()
+    try:
+        updated = urlnorm.backfill_events(conn, int(batches) if batches else None)
+        return {"status": "ok", "updated": updated}
+    except Exception as e:
+        print("Error backfilling normalized page URLs:", e)
+        raise HTTPException(status_code=500, detail="Failed to backfill page paths")
+    finally:
+        conn.close()
+
+@app.post("/run/update_geo_cells")
+def run_update_geo_cells(request: Request):
+    """Fold newly geolocated IP addresses into the demographics map clusters.
+    Only accepts POST requests. Resumable; ?batches=<n> limits the work done per call.
+    """
+    batches = request.query_params.get("batches")
+    conn = get_connection()
+    try:
+        return {"status": "ok", "processed": geo.update(conn, max_batches=int(batches) if batches else None)}
+    except Exception as e:
+        print("Error updating geo cells:", e)
+        raise HTTPException(status_code=500, detail="Failed to update geo cells")
+    finally:
+        conn.close()
+
+def _rebuild_days(request: Request, max_days):
+    """?days= of the rebuild jobs: 400 unless an integer, clamped to 1..max_days (the default)."""
+    try:
+        days = int(request.query_params.get("days") or max_days)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid days")
+    return max(1, min(days, max_days))
+
+@app.post("/run/rebuild_scroll_depth")
+def run_rebuild_scroll_depth(request: Request):
+    """Rebuild the scroll-depth histograms of closed days from hot events (?site_id=, ?days=<n>, 1-90, default 90).
+    Only needed for events written before the histograms existed.
+    """
+    site_param = request.query_params.get("site_id")
+    days = _rebuild_days(request, scroll_depth.REBUILD_DAYS)
+    conn = get_connection()
+    try:
+        if site_param:
+            site_ids = [site_param]
+        else:
+            cur = conn.cursor()
+            cur.execute("SELECT site_id FROM sites")
+            site_ids = [r[0] for r in cur.fetchall()]
+        return {"status": "ok", "days": {sid: scroll_depth.rebuild(conn, sid, days) for sid in site_ids}}
+    except Exception as e:
+        print("Error rebuilding scroll-depth histograms:", e)
+        raise HTTPException(status_code=500, detail="Failed to rebuild scroll-depth histograms")
+    finally:
+        conn.close()
+
+@app.post("/run/rebuild_retention")
+def run_rebuild_retention(request: Request):
+    """Rebuild the per-day visitor bitmaps from hot events (?site_id=, ?days=<n>, 1-90, default 90).
+    Only needed for events the pipeline processed before the bitmaps existed.
+    """
+    site_param = request.query_params.get("site_id")
+    days = _rebuild_days(request, retention.REBUILD_DAYS)
+    conn = get_connection()
+    try:
+        if site_param:
+            site_ids = [site_param]
+        else:
+            cur = conn.cursor()
+            cur.execute("SELECT site_id FROM sites")
+            site_ids = [r[0] for r in cur.fetchall()]
+        return {"status": "ok", "days": {sid: retention.rebuild(conn, sid, days) for sid in site_ids}}
+    except Exception as e:
+        print("Error rebuilding retention bitmaps:", e)
+        raise HTTPException(status_code=500, detail="Failed to rebuild retention bitmaps")
+    finally:
+        conn.close()
+
+# ---------------- SCHEDULED JOBS ----------------
+# The /run/* work, run in-process on a schedule (scheduler.py); SCHEDULE_<JOB>=off disables a job.
+def _job_events_pipeline():
+    processed = etl.run_pipeline(get_connection)
+    failed = [sid for sid, n in processed.items() if n is None]
+    if failed:
+        raise RuntimeError(f"events pipeline failed for sites: {', '.join(failed)}")
+
+
+def _job_with_connection(fn):
+    def job():
+        conn = get_connection()
+        try:
+            fn(conn)
+        finally:
+            conn.close()
+    return job
+
+
+scheduler.add("events_pipeline", _job_events_pipeline, 300, jitter=30)
+scheduler.add("geo_cells", _job_with_connection(geo.update), 600, jitter=60)
+scheduler.add("archive_events", _job_with_connection(cold_storage.archive_closed_days), "30 2 * * *", jitter=300)
+
 # ---------------- Settings UI ----------------
 @app.get("/settings", response_class=HTMLResponse)
 def settings_page(request: Request):
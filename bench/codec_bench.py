@@ -0,0 +1,205 @@
+"""Microbenchmarks for the msgspec decode/encode paths in codec.py.
+
+Measures per-call CPU time (process time, best of --repeat runs) of the old and
+new code for
+
+- decoding a /collect beacon into the queued event dict
+  (json.loads + dict.get  vs  typed msgspec decode),
+- serializing a realtime-sized /api/realtime payload
+  (jsonable_encoder + JSONResponse  vs  FastJSONResponse),
+- answering /rules from cache
+  (re-encoding the cached list  vs  returning the cached bytes),
+- decoding a mid-session beacon
+  (every attribute on every event  vs  the compact beacon track.js sends
+  once the session header went out with session_start).
+
+No database or server is needed:
+
+    python bench/codec_bench.py --number 20000
+    python bench/codec_bench.py --out bench_results/codec-<commit>.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+import codec
+
+BEACON = json.dumps({
+    "siteId": "site_0001",
+    "visitorId": "0b7c3f0e-2d3c-4d7e-9d6f-3a2b1c0d9e8f",
+    "sessionId": "6a1f2e3d-4c5b-4a69-8778-695a4b3c2d1e",
+    "eventType": "scroll",
+    "pageUrl": "https://example.com/blog/post-1?utm_source=newsletter",
+    "pageTitle": "Post 1 | Example Blog",
+    "referrer": "https://www.google.com/",
+    "userAgent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "language": "en-US",
+    "platform": "Win32",
+    "screenSize": "1920x1080",
+    "timezone": "Europe/Berlin",
+    "scrollPercent": 72,
+    "scrollThreshold": 70,
+}).encode()
+
+# the same event without the session header and the page-load referrer
+COMPACT_BEACON = json.dumps({
+    k: v for k, v in json.loads(BEACON).items()
+    if k not in ("referrer", "userAgent", "language", "platform", "screenSize", "timezone")
+}).encode()
+
+
+def realtime_payload(pages=50):
+    rnd = random.Random(1)
+    return {
+        "activeUsers": 812,
+        "activeUsers30": 4021,
+        "pageViews": 15880,
+        "avgDuration": 143,
+        "bounceRate": 41.3,
+        "timeseries": {
+            "labels": [f"12:{m:02d}" for m in range(31)],
+            "values": [rnd.randint(50, 900) for _ in range(31)],
+        },
+        "trafficSources": {"Direct": 5100, "Organic": 7020, "Social": 1300, "Referral": 2400, "Email": 60},
+        "topPages": [
+            {
+                "url": f"https://example.com/page/{i}",
+                "title": f"Page {i}",
+                "views": rnd.randint(1, 2000),
+                "users": rnd.randint(1, 900),
+                "event_count": rnd.randint(1, 5000),
+                "bounce_rate": round(rnd.random() * 100, 1),
+            }
+            for i in range(pages)
+        ],
+    }
+
+
+RULES = {"rules": [{"id": i, "selector": f"#cta-{i}", "event_type": "click", "event_name": f"cta_{i}"} for i in range(20)]}
+RULES_BODY = codec.encode(RULES)
+
+
+# ---------------- CASES ----------------
+def decode_old():
+    data = json.loads(BEACON)
+    site_id = data.get("siteId")
+    visitor_id = data.get("visitorId")
+    if not site_id or not visitor_id:
+        raise ValueError
+    return {
+        "site_id": site_id,
+        "visitor_id": visitor_id,
+        "event_type": data.get("eventType", "page_view"),
+        "page_url": data.get("pageUrl"),
+        "referrer": data.get("referrer"),
+        "user_agent": data.get("userAgent"),
+        "language": data.get("language"),
+        "platform": data.get("platform"),
+        "screen_size": data.get("screenSize"),
+        "timezone": data.get("timezone"),
+        "clicked_url": data.get("clicked_url"),
+        "is_external": data.get("is_external"),
+        "page_title": data.get("pageTitle"),
+        "scroll_percent": data.get("scrollPercent"),
+        "created_at": datetime.utcnow(),
+    }
+
+
+def decode_new(body=BEACON):
+    data = codec.decode_event(body)
+    return {
+        "site_id": data.siteId,
+        "visitor_id": data.visitorId,
+        "event_type": data.eventType,
+        "page_url": data.pageUrl,
+        "referrer": data.referrer,
+        "user_agent": data.userAgent,
+        "language": data.language,
+        "platform": data.platform,
+        "screen_size": data.screenSize,
+        "timezone": data.timezone,
+        "clicked_url": data.clicked_url,
+        "is_external": data.is_external,
+        "page_title": data.pageTitle,
+        "scroll_percent": data.scrollPercent,
+        "created_at": datetime.utcnow(),
+    }
+
+
+def decode_compact():
+    return decode_new(COMPACT_BEACON)
+
+
+REALTIME = realtime_payload()
+
+
+def realtime_old():
+    return JSONResponse(jsonable_encoder(REALTIME)).body
+
+
+def realtime_new():
+    return codec.FastJSONResponse(REALTIME).body
+
+
+def rules_old():
+    return JSONResponse(jsonable_encoder(RULES)).body
+
+
+def rules_new():
+    return Response(RULES_BODY, media_type="application/json").body
+
+
+CASES = [
+    ("collect_decode", decode_old, decode_new),
+    ("realtime_encode", realtime_old, realtime_new),
+    ("rules_cached", rules_old, rules_new),
+    ("compact_beacon", decode_new, decode_compact),
+]
+
+
+def measure(fn, number, repeat):
+    """Best per-call CPU time in microseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        for _ in range(number):
+            fn()
+        best = min(best, time.process_time() - start)
+    return best / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="calls per timing run")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs per case (best is kept)")
+    parser.add_argument("--out", help="also write the results as JSON to this path")
+    args = parser.parse_args()
+
+    results = {"beacon_bytes": {"full": len(BEACON), "compact": len(COMPACT_BEACON)}}
+    print(f"beacon bytes: {len(BEACON)} full, {len(COMPACT_BEACON)} compact")
+    print(f"{'case':<18}{'old us':>10}{'new us':>10}{'speedup':>10}")
+    for name, old, new in CASES:
+        if old() is None or new() is None:
+            raise SystemExit(f"{name}: case returned nothing")
+        old_us = measure(old, args.number, args.repeat)
+        new_us = measure(new, args.number, args.repeat)
+        results[name] = {"old_us": round(old_us, 2), "new_us": round(new_us, 2), "speedup": round(old_us / new_us, 2)}
+        print(f"{name:<18}{old_us:>10.2f}{new_us:>10.2f}{old_us / new_us:>9.1f}x")
+
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump({"number": args.number, "repeat": args.repeat, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Benchmark of the funnel engine (funnel.py) on synthetic event streams.
+
+Generates --events rows over --visitors visitors for a --steps step funnel
+(each visitor progresses a random number of steps, with noise events of the
+same names in between) and reports the time to build the sorted arrays from
+fetched rows and to compute the funnel. No database is needed:
+
+    python bench/funnel_bench.py --events 2000000 --visitors 200000
+    python bench/funnel_bench.py --out bench_results/funnel-<commit>.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import funnel
+
+
+def synthetic_rows(events, visitors, steps, seed=1):
+    rng = np.random.default_rng(seed)
+    names = [f"step_{i}" for i in range(steps)]
+    visitor = rng.integers(0, visitors, events)
+    step = rng.integers(0, steps, events)
+    offset = rng.integers(0, 7 * 86400, events)
+    base = datetime(2026, 1, 1)
+    ids = [f"visitor-{v}" for v in range(visitors)]
+    return [(ids[v], names[s], base + timedelta(seconds=int(o)), 1.0)
+            for v, s, o in zip(visitor.tolist(), step.tolist(), offset.tolist())], names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=2000000)
+    parser.add_argument("--visitors", type=int, default=200000)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--window-hours", type=float, default=24)
+    parser.add_argument("--out", help="also write the results as JSON to this path")
+    args = parser.parse_args()
+
+    rows, names = synthetic_rows(args.events, args.visitors, args.steps)
+
+    start = time.perf_counter()
+    arrays = funnel.to_arrays(rows, names)
+    arrays_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = funnel.compute(names, *arrays, args.window_hours * 3600)
+    compute_sec = time.perf_counter() - start
+
+    for step in result:
+        print(f"{step['name']:<10}{step['visitors']:>10}{step['conversion_rate']:>8}%")
+    print(f"to_arrays {arrays_sec:.3f}s  compute {compute_sec:.3f}s  ({args.events} events, {args.steps} steps)")
+
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump({"events": args.events, "visitors": args.visitors, "steps": args.steps,
+                       "to_arrays_sec": round(arrays_sec, 3), "compute_sec": round(compute_sec, 3)}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""Ingest load test: how many beacons per second can one worker absorb?
+
+Point the app at a throwaway MySQL (the same MYSQL_* variables the app reads),
+start one worker and run the harness against it:
+
+    docker run -d --name bench-mysql -p 3306:3306 -e MYSQL_ROOT_PASSWORD=bench -e MYSQL_DATABASE=analytics mysql:8
+    MYSQL_HOST=127.0.0.1 MYSQL_USER=root MYSQL_PASSWORD=bench MYSQL_DB=analytics uvicorn app:app --workers 1
+    MYSQL_HOST=127.0.0.1 MYSQL_USER=root MYSQL_PASSWORD=bench MYSQL_DB=analytics \\
+        python bench/ingest_load.py run --concurrency 1,8,32,128 --duration 20
+
+The harness seeds `--sites` bench sites, then for each concurrency step sends
+either replayed payloads (`--replay payloads.jsonl`, one beacon JSON object per
+line) or a synthetic mix of page_view / scroll / click / rule events spread
+over many sites and visitors. Each step records throughput, status counts,
+p50/p95/p99 latency and MySQL writes per accepted event (from SHOW GLOBAL
+STATUS deltas). Results are written as JSON tagged with the current git commit;
+compare two reports with
+
+    python bench/ingest_load.py compare bench_results/ingest-<old>.json bench_results/ingest-<new>.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import httpx
+import pymysql
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WRITE_COUNTERS = ("Com_insert", "Com_update", "Com_delete", "Com_replace", "Com_insert_select")
+ROW_COUNTERS = ("Innodb_rows_inserted", "Innodb_rows_updated", "Innodb_rows_deleted")
+
+# default synthetic traffic mix (event type -> weight)
+DEFAULT_MIX = {"page_view": 45, "scroll": 30, "user_engagement": 10, "click": 10, "rule": 5}
+
+PAGES = ["/", "/pricing", "/docs", "/docs/getting-started", "/blog", "/blog/post-1", "/blog/post-2", "/contact", "/signup", "/login"]
+REFERRERS = ["", "", "", "https://www.google.com/", "https://www.bing.com/", "https://t.co/abc", "https://news.ycombinator.com/"]
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15",
+    "Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36",
+]
+
+
+# ---------------- DB ----------------
+def get_connection():
+    return pymysql.connect(
+        host=os.getenv("MYSQL_HOST"),
+        user=os.getenv("MYSQL_USER"),
+        password=os.getenv("MYSQL_PASSWORD"),
+        database=os.getenv("MYSQL_DB"),
+        port=int(os.getenv("MYSQL_PORT", "3306")),
+        connect_timeout=5,
+        autocommit=True
+    )
+
+
+def seed_sites(n):
+    """Create bench sites (idempotent) and return their site_ids."""
+    site_ids = [f"bench{i:04d}" for i in range(n)]
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.executemany(
+            "INSERT IGNORE INTO sites (site_id, site_name, domain, PropertyName) VALUES (%s, %s, %s, %s)",
+            [(sid, f"Bench {sid}", f"{sid}.bench.local", "bench") for sid in site_ids]
+        )
+    finally:
+        conn.close()
+    return site_ids
+
+
+def write_counters():
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SHOW GLOBAL STATUS")
+        status = {k: v for k, v in cur.fetchall()}
+    finally:
+        conn.close()
+    return {k: int(status.get(k, 0)) for k in WRITE_COUNTERS + ROW_COUNTERS}
+
+
+# ---------------- PAYLOADS ----------------
+def load_replay(path):
+    payloads = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            obj = json.loads(line)
+            payloads.append(obj.get("payload", obj) if isinstance(obj, dict) else obj)
+    if not payloads:
+        raise SystemExit(f"No payloads found in {path}")
+    return payloads
+
+
+def synthetic_payloads(site_ids, visitors, mix, seed=42):
+    """Endless generator of beacon payloads following the traffic mix."""
+    rng = random.Random(seed)
+    visitor_ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(visitors)]
+    session_ids = {v: str(uuid.UUID(int=rng.getrandbits(128))) for v in visitor_ids}
+    types = list(mix)
+    weights = [mix[t] for t in types]
+
+    while True:
+        site_id = rng.choice(site_ids)
+        vid = rng.choice(visitor_ids)
+        etype = rng.choices(types, weights)[0]
+        page = rng.choice(PAGES)
+        payload = {
+            "siteId": site_id,
+            "visitorId": vid,
+            "sessionId": session_ids[vid],
+            "eventType": etype,
+            "pageUrl": f"https://{site_id}.bench.local{page}?utm_source=bench" if rng.random() < 0.1 else f"https://{site_id}.bench.local{page}",
+            "pageTitle": page.strip("/").title() or "Home",
+            "referrer": rng.choice(REFERRERS),
+            "userAgent": rng.choice(USER_AGENTS),
+            "language": "en-US",
+            "platform": "Win32",
+            "screenSize": rng.choice(["1920x1080", "390x844", "1440x900"]),
+            "timezone": "Europe/London",
+        }
+        if etype == "scroll":
+            t = rng.choice([50, 70, 90, 100])
+            payload.update({"scrollPercent": t, "scrollThreshold": t})
+        elif etype == "click":
+            payload.update({"clicked_url": "https://example.com/", "is_external": True})
+        elif etype == "user_engagement":
+            payload["engagement_time_sec"] = 10
+        elif etype == "rule":
+            payload.update({"eventType": "signup_click", "selector": "#signup", "rule_id": 1})
+        yield payload
+
+
+# ---------------- LOAD ----------------
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+async def run_step(base_url, endpoint, payload_iter, concurrency, duration, batch_size):
+    latencies = []
+    statuses = {}
+    events_sent = 0
+    events_ok = 0
+    deadline = time.perf_counter() + duration
+    headers = {"Content-Type": "text/plain;charset=UTF-8"}  # what sendBeacon sends
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        async def worker():
+            nonlocal events_sent, events_ok
+            while time.perf_counter() < deadline:
+                if batch_size > 1:
+                    batch = list(itertools.islice(payload_iter, batch_size))
+                    body = json.dumps(batch)
+                    n = len(batch)
+                else:
+                    body = json.dumps(next(payload_iter))
+                    n = 1
+                t0 = time.perf_counter()
+                try:
+                    resp = await client.post(endpoint, content=body, headers=headers)
+                    status = resp.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - t0)
+                statuses[status] = statuses.get(status, 0) + 1
+                events_sent += n
+                if status == 200:
+                    events_ok += n
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "elapsed_sec": round(elapsed, 3),
+        "requests": len(latencies),
+        "events_sent": events_sent,
+        "events_ok": events_ok,
+        "events_per_sec": round(events_ok / elapsed, 1) if elapsed else 0,
+        "requests_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "status_counts": {str(k): v for k, v in statuses.items()},
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            "p95": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            "p99": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+            "max": round(latencies[-1] * 1000, 2) if latencies else None,
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def cmd_run(args):
+    site_ids = seed_sites(args.sites)
+    if args.replay:
+        payload_iter = itertools.cycle(load_replay(args.replay))
+    else:
+        mix = json.loads(args.mix) if args.mix else DEFAULT_MIX
+        payload_iter = synthetic_payloads(site_ids, args.visitors, mix)
+
+    steps = []
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        before = write_counters()
+        step = asyncio.run(run_step(args.url, args.endpoint, payload_iter, concurrency, args.duration, args.batch_size))
+        if args.settle:
+            time.sleep(args.settle)  # let batched writers flush before reading counters
+        after = write_counters()
+        delta = {k: after[k] - before[k] for k in after}
+        ok = step["events_ok"] or 1
+        step["db_statements_per_event"] = round(sum(delta[k] for k in WRITE_COUNTERS) / ok, 3)
+        step["db_rows_written_per_event"] = round(sum(delta[k] for k in ROW_COUNTERS) / ok, 3)
+        step["db_counters"] = delta
+        steps.append(step)
+        print(f"c={concurrency:>4}  {step['events_per_sec']:>9} ev/s  p50={step['latency_ms']['p50']}ms  "
+              f"p95={step['latency_ms']['p95']}ms  p99={step['latency_ms']['p99']}ms  "
+              f"stmts/ev={step['db_statements_per_event']}  statuses={step['status_counts']}")
+
+    commit = git_commit()
+    report = {
+        "benchmark": "ingest_load",
+        "commit": commit,
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "config": {
+            "url": args.url, "endpoint": args.endpoint, "batch_size": args.batch_size,
+            "duration_sec": args.duration, "sites": args.sites, "visitors": args.visitors,
+            "source": args.replay or "synthetic", "mix": args.mix or DEFAULT_MIX,
+        },
+        "steps": steps,
+    }
+    out = args.out or os.path.join("bench_results", f"ingest-{commit}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {out}")
+
+
+def cmd_compare(args):
+    with open(args.baseline) as f:
+        base = json.load(f)
+    with open(args.candidate) as f:
+        cand = json.load(f)
+    base_steps = {s["concurrency"]: s for s in base["steps"]}
+    print(f"{base['commit']} -> {cand['commit']}")
+    regressed = False
+    for step in cand["steps"]:
+        old = base_steps.get(step["concurrency"])
+        if not old:
+            continue
+        tput = (step["events_per_sec"] - old["events_per_sec"]) / (old["events_per_sec"] or 1) * 100
+        p99_old, p99_new = old["latency_ms"]["p99"] or 0, step["latency_ms"]["p99"] or 0
+        p99 = (p99_new - p99_old) / (p99_old or 1) * 100
+        flag = ""
+        if tput < -args.tolerance or p99 > args.tolerance:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"c={step['concurrency']:>4}  throughput {tput:+.1f}%  p99 {p99:+.1f}%  "
+              f"stmts/ev {old['db_statements_per_event']} -> {step['db_statements_per_event']}{flag}")
+    sys.exit(1 if regressed else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    run = sub.add_parser("run", help="run the load test")
+    run.add_argument("--url", default="http://127.0.0.1:8000")
+    run.add_argument("--endpoint", default="/collect")
+    run.add_argument("--batch-size", type=int, default=1, help="events per request (for batch endpoints that accept a JSON list)")
+    run.add_argument("--concurrency", default="1,8,32,128", help="comma separated ramp of concurrent clients")
+    run.add_argument("--duration", type=float, default=20, help="seconds per concurrency step")
+    run.add_argument("--sites", type=int, default=50)
+    run.add_argument("--visitors", type=int, default=20000)
+    run.add_argument("--mix", help='JSON event mix, e.g. \'{"page_view": 50, "scroll": 50}\'')
+    run.add_argument("--replay", help="JSONL file of recorded beacon payloads to replay instead of synthetic traffic")
+    run.add_argument("--settle", type=float, default=2, help="seconds to wait after each step before reading DB counters")
+    run.add_argument("--out", help="report path (default bench_results/ingest-<commit>.json)")
+    run.set_defaults(func=cmd_run)
+
+    cmp_ = sub.add_parser("compare", help="compare two reports")
+    cmp_.add_argument("baseline")
+    cmp_.add_argument("candidate")
+    cmp_.add_argument("--tolerance", type=float, default=10, help="percent change treated as a regression")
+    cmp_.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Benchmark of the in-memory recent-events window (event_window.py).
+
+Fills a 30-minute window with --events synthetic events over --sites sites
+(one busy site gets --busy-share of them) and compares
+
+- per-event tuples in a deque, aggregated with dicts and sets per query
+  (the shape the realtime numbers take when built from fetched rows), with
+- `EventWindow`'s typed columns and vectorized aggregation,
+
+on bytes per event held (tracemalloc; events arrive with fresh strings, as
+decoded beacons do, which the tuples keep and the window interns), the time to
+load the stream and the time to
+compute the busy site's realtime numbers: active visitors (5 and 30 minutes),
+page views, visitors per minute and the top 50 pages. No database is needed:
+
+    python bench/window_bench.py --events 1000000
+    python bench/window_bench.py --out bench_results/window-<commit>.json
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import event_window
+
+NOW = 1_800_000_000
+EVENT_TYPES = ["page_view", "scroll", "click", "session_start", "cta_click"]
+
+
+def synthetic_events(events, sites, visitors, pages, busy_share, seed=1):
+    """Column lists of a synthetic stream in time order; site 0 is the busy one."""
+    rng = np.random.default_rng(seed)
+    return (
+        np.sort(rng.integers(NOW - 1800, NOW, events)).tolist(),
+        np.where(rng.random(events) < busy_share, 0, rng.integers(1, max(sites, 2), events)).tolist(),
+        rng.integers(0, visitors, events).tolist(),
+        (rng.zipf(1.3, events) % pages).tolist(),
+        rng.choice(len(EVENT_TYPES), events, p=[0.4, 0.3, 0.15, 0.1, 0.05]).tolist(),
+    )
+
+
+def arrivals(stream):
+    """(epoch_seconds, site_id, visitor_id, page, event_type, weight) rows with fresh strings per
+    event, as decoded beacons arrive."""
+    for t, s, v, p, e in zip(*stream):
+        yield (t, f"site_{s:04d}", f"{v:08x}-2d3c-4d7e-9d6f-3a2b1c0d9e8f", f"https://example.com/page/{p}",
+               EVENT_TYPES[e], 1.0)
+
+
+# ---------------- TUPLES + DICT-OF-SETS ----------------
+def tuples_load(rows):
+    window = deque()
+    for r in rows:
+        window.append(r)
+    return window
+
+
+def tuples_realtime(window, site_id):
+    active_5, active_30 = {}, {}
+    page_views = 0.0
+    minutes = {}
+    pages = {}
+    for ts, site, visitor, page, event, weight in window:
+        if site != site_id:
+            continue
+        active_30[visitor] = weight
+        if ts >= NOW - 300:
+            active_5[visitor] = weight
+        minutes.setdefault((ts - (NOW - 1800)) // 60, {})[visitor] = weight
+        p = pages.get(page)
+        if p is None:
+            p = pages[page] = {"views": 0.0, "users": set(), "event_count": 0.0}
+        p["users"].add(visitor)
+        p["event_count"] += weight
+        if event == "page_view":
+            page_views += weight
+            p["views"] += weight
+    top = sorted(pages.items(), key=lambda kv: -kv[1]["views"])[:50]
+    return {
+        "active_5": sum(active_5.values()),
+        "active_30": sum(active_30.values()),
+        "page_views": page_views,
+        "timeseries": [sum(minutes.get(m, {}).values()) for m in range(30)],
+        "top_pages": [(page, p["views"], len(p["users"]), p["event_count"]) for page, p in top],
+    }
+
+
+# ---------------- EVENT WINDOW ----------------
+def window_load(rows):
+    window = event_window.EventWindow(window_sec=1800)
+    batch = []
+    for r in rows:
+        batch.append(r)
+        if len(batch) == 500:
+            window.append_many(batch)
+            batch = []
+    window.append_many(batch)
+    return window
+
+
+def window_realtime(window, site_id):
+    return {
+        "active_5": window.active_visitors(site_id, NOW - 300),
+        "active_30": window.active_visitors(site_id, NOW - 1800),
+        "page_views": window.event_count(site_id, NOW - 1800, event_type="page_view"),
+        "timeseries": window.visitors_per_minute(site_id, NOW - 1800, 30).tolist(),
+        "top_pages": [(p["page"], p["views"], p["users"], p["event_count"]) for p in window.top_pages(site_id, NOW - 1800, 50)],
+    }
+
+
+def measure_memory(load, stream):
+    """Bytes allocated by loading the stream and still held afterwards, and the loaded structure."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    loaded = load(arrivals(stream))
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return held, loaded
+
+
+def best_time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--sites", type=int, default=50)
+    parser.add_argument("--visitors", type=int, default=100000)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--busy-share", type=float, default=0.5, help="share of events on the busiest site")
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs per case (best is kept)")
+    parser.add_argument("--out", help="also write the results as JSON to this path")
+    args = parser.parse_args()
+
+    stream = synthetic_events(args.events, args.sites, args.visitors, args.pages, args.busy_share)
+    busy_site = "site_0000"
+
+    results = {"events": args.events, "sites": args.sites, "visitors": args.visitors, "pages": args.pages}
+    print(f"{'case':<14}{'bytes/event':>12}{'load s':>9}{'realtime ms':>13}")
+    answers = {}
+    for name, load, realtime in (("tuples", tuples_load, tuples_realtime), ("event_window", window_load, window_realtime)):
+        held, loaded = measure_memory(load, stream)
+        load_sec, _ = best_time(lambda: load(arrivals(stream)), 1)
+        realtime_sec, answers[name] = best_time(lambda: realtime(loaded, busy_site), args.repeat)
+        results[name] = {"bytes_per_event": round(held / args.events, 1), "load_sec": round(load_sec, 3),
+                         "realtime_ms": round(realtime_sec * 1000, 2)}
+        print(f"{name:<14}{held / args.events:>12.1f}{load_sec:>9.3f}{realtime_sec * 1000:>13.2f}")
+        del loaded
+
+    old, new = answers["tuples"], answers["event_window"]
+    same = (old["active_5"] == new["active_5"] and old["active_30"] == new["active_30"]
+            and old["page_views"] == new["page_views"] and old["timeseries"] == new["timeseries"]
+            and sorted(p[1:] for p in old["top_pages"]) == sorted(p[1:] for p in new["top_pages"]))
+    if not same:
+        raise SystemExit("event_window answers differ from the tuple baseline")
+    print(f"memory {results['tuples']['bytes_per_event'] / results['event_window']['bytes_per_event']:.1f}x smaller, "
+          f"realtime {results['tuples']['realtime_ms'] / results['event_window']['realtime_ms']:.1f}x faster")
+
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
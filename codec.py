@@ -0,0 +1,102 @@
+"""msgspec-based decoding and encoding for the hot endpoints.
+
+`/collect` payloads are decoded straight into a typed `CollectEvent` with
+strict types, so a bad beacon is rejected up front instead of failing a whole
+batch insert later. Identifiers longer than their columns are rejected too;
+free-text fields (URLs, title, user agent, ...) longer than their `events`
+columns are truncated to fit instead, as a long URL is no reason to lose the
+event. Bodies larger than INGEST_MAX_BODY_BYTES are refused before they are
+decoded.
+
+`FastJSONResponse` encodes with msgspec; routes return it directly so FastAPI
+skips `jsonable_encoder`.
+"""
+import os
+from typing import Annotated, Optional
+
+import msgspec
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+
+MAX_BODY_BYTES = int(os.getenv("INGEST_MAX_BODY_BYTES", "32768"))
+
+# TEXT holds 65535 bytes, i.e. 16383 characters of 4-byte utf8mb4
+_TEXT = 16383
+
+
+def _str(max_length, min_length=0):
+    return Annotated[str, msgspec.Meta(min_length=min_length, max_length=max_length)]
+
+
+class CollectEvent(msgspec.Struct):
+    """A `/collect` beacon as sent by track.js. Unknown keys are ignored."""
+    siteId: _str(100, 1)
+    visitorId: _str(100, 1)
+    eventType: _str(50, 1) = "page_view"
+    sessionId: Optional[_str(100)] = None
+    eventId: Optional[_str(128)] = None
+    pageUrl: Optional[str] = None
+    pageTitle: Optional[str] = None
+    referrer: Optional[str] = None
+    userAgent: Optional[str] = None
+    language: Optional[str] = None
+    platform: Optional[str] = None
+    screenSize: Optional[str] = None
+    timezone: Optional[str] = None
+    clicked_url: Optional[str] = None
+    is_external: Optional[bool] = None
+    scrollPercent: Optional[Annotated[int, msgspec.Meta(ge=0, le=100)]] = None
+
+
+# free-text fields -> length of their `events` column; longer values are truncated after decoding
+TRUNCATED_FIELDS = {
+    "pageUrl": _TEXT,
+    "pageTitle": 255,
+    "referrer": _TEXT,
+    "userAgent": _TEXT,
+    "language": 20,
+    "platform": 50,
+    "screenSize": 20,
+    "timezone": 50,
+    "clicked_url": _TEXT,
+}
+
+
+_event_decoder = msgspec.json.Decoder(CollectEvent)
+_encoder = msgspec.json.Encoder()
+
+
+async def read_body(request: Request, limit=MAX_BODY_BYTES):
+    """Read the request body, answering 413 as soon as it exceeds `limit` bytes."""
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > limit:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise HTTPException(status_code=413, detail="Payload too large")
+    return bytes(body)
+
+
+def decode_event(body):
+    try:
+        event = _event_decoder.decode(body)
+    except msgspec.ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid payload: {e}")
+    except msgspec.DecodeError:
+        raise HTTPException(status_code=400, detail="Invalid payload")
+    for field, limit in TRUNCATED_FIELDS.items():
+        value = getattr(event, field)
+        if value is not None and len(value) > limit:
+            setattr(event, field, value[:limit])
+    return event
+
+
+def encode(content):
+    return _encoder.encode(content)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return _encoder.encode(content)
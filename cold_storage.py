@@ -0,0 +1,319 @@
+"""Columnar cold tier for closed days of `events` and `TechStack`.
+
+Days older than HOT_RETENTION_DAYS are moved out of MySQL into local Parquet
+files laid out as
+
+    <ARCHIVE_DIR>/<table>/site_id=<site_id>/date=<YYYY-MM-DD>/part-<first_id>-<last_id>.parquet
+
+and removed from the hot table. The archived range is recorded in the
+`watermark` table as `<table>_archive` so report queries can split a date
+range into a cold part (read through DuckDB) and a hot part (read from MySQL)
+and merge the two.
+
+Dictionary-encoded strings (see dictionary.py) are written to Parquet as plain
+text, so the hot tier is read through `dictionary.DECODED_EVENTS` to match.
+Session headers stored on `sessions` (see session_headers.py) are copied back
+onto each archived event.
+"""
+import os
+import re
+from datetime import datetime, timedelta
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pymysql.constants import FIELD_TYPE
+
+import dictionary
+import session_headers
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+HOT_RETENTION_DAYS = int(os.getenv("HOT_RETENTION_DAYS", "90"))
+ARCHIVE_BATCH_ROWS = int(os.getenv("ARCHIVE_BATCH_ROWS", "50000"))
+ARCHIVED_TABLES = ("events", "TechStack")
+# hot tables read with their dictionary ids decoded
+HOT_SOURCES = {"events": dictionary.DECODED_EVENTS}
+# columns added after archiving began, with the value older partitions imply
+COLUMN_DEFAULTS = {
+    "events": {"sample_weight": "CAST(1 AS DOUBLE)", "utm_source": "CAST(NULL AS VARCHAR)",
+               "utm_medium": "CAST(NULL AS VARCHAR)", "utm_campaign": "CAST(NULL AS VARCHAR)"},
+    "TechStack": {"sample_weight": "CAST(1 AS DOUBLE)"},
+}
+
+_SAFE_SITE_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+_PART_FILE = re.compile(r"^part-(\d+)-(\d+)\.parquet$")
+
+_INT_TYPES = {FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.LONG, FIELD_TYPE.LONGLONG, FIELD_TYPE.INT24, FIELD_TYPE.YEAR}
+_FLOAT_TYPES = {FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE, FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL}
+_TIME_TYPES = {FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP}
+
+
+# ---------------- BOUNDARY ----------------
+def get_boundary(conn, table):
+    """Return the first datetime still held in MySQL for `table`, or None if nothing is archived."""
+    cur = conn.cursor()
+    cur.execute("SELECT last_watermark FROM watermark WHERE tbl_name=%s", (f"{table}_archive",))
+    row = cur.fetchone()
+    return row[0] if row and row[0] else None
+
+
+def _set_boundary(conn, table, boundary):
+    cur = conn.cursor()
+    # never move the boundary backwards
+    cur.execute(
+        """
+        INSERT INTO watermark (tbl_name, last_watermark) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE last_watermark = GREATEST(COALESCE(last_watermark, VALUES(last_watermark)), VALUES(last_watermark))
+        """,
+        (f"{table}_archive", boundary)
+    )
+    conn.commit()
+
+
+def archive_cutoff(conn):
+    """Start of the oldest day that must stay hot.
+
+    Only closed days past HOT_RETENTION_DAYS are eligible, and never anything the
+    events watermark pipeline has not processed yet (TechStack/IP derivation
+    still needs those rows in MySQL).
+    """
+    cutoff = datetime.combine(datetime.utcnow().date(), datetime.min.time()) - timedelta(days=HOT_RETENTION_DAYS)
+    cur = conn.cursor()
+    cur.execute("SELECT last_watermark FROM watermark WHERE tbl_name='events'")
+    row = cur.fetchone()
+    if row and row[0]:
+        processed_day = datetime.combine(row[0].date(), datetime.min.time())
+        cutoff = min(cutoff, processed_day)
+    return cutoff
+
+
+def split_range(conn, table, start, end):
+    """Split [start, end) into (cold_range, hot_range); either part may be None.
+
+    `start`/`end` may be None for an open range.
+    """
+    boundary = get_boundary(conn, table)
+    if boundary is None or (start is not None and start >= boundary):
+        return None, (start, end)
+    if end is not None and end <= boundary:
+        return (start, end), None
+    return (start, boundary), (boundary, end)
+
+
+def reaches_cold(conn, table, start):
+    """True when a range starting at `start` needs archived data."""
+    boundary = get_boundary(conn, table)
+    return boundary is not None and (start is None or start < boundary)
+
+
+# ---------------- ARCHIVAL JOB ----------------
+def _arrow_type(type_code):
+    if type_code in _INT_TYPES:
+        return pa.int64()
+    if type_code in _FLOAT_TYPES:
+        return pa.float64()
+    if type_code in _TIME_TYPES:
+        return pa.timestamp("us")
+    if type_code == FIELD_TYPE.DATE:
+        return pa.date32()
+    return pa.string()
+
+
+def _to_arrow(description, rows):
+    columns = {}
+    for i, col in enumerate(description):
+        arrow_type = _arrow_type(col[1])
+        values = [r[i] for r in rows]
+        if arrow_type == pa.float64():
+            values = [float(v) if v is not None else None for v in values]
+        elif arrow_type == pa.string():
+            values = [v.decode("utf-8", "replace") if isinstance(v, bytes) else (str(v) if v is not None else None) for v in values]
+        columns[col[0]] = pa.array(values, type=arrow_type)
+    return pa.table(columns)
+
+
+def _partition_dir(table, site_id, day):
+    return os.path.join(ARCHIVE_DIR, table, f"site_id={site_id}", f"date={day.isoformat()}")
+
+
+def _drop_stale_parts(part_dir, min_remaining_id):
+    """Remove part files left behind by an interrupted run.
+
+    Rows are archived in id order and deleted right after their file is written,
+    so any file whose ids reach the smallest id still in MySQL was never
+    committed and will be rewritten.
+    """
+    if not os.path.isdir(part_dir):
+        return
+    for name in os.listdir(part_dir):
+        m = _PART_FILE.match(name)
+        if m and int(m.group(2)) >= min_remaining_id:
+            os.remove(os.path.join(part_dir, name))
+
+
+def _archive_partition(conn, table, site_id, day):
+    cur = conn.cursor()
+    day_start = datetime.combine(day, datetime.min.time())
+    day_end = day_start + timedelta(days=1)
+    part_dir = _partition_dir(table, site_id, day)
+
+    moved = 0
+    last_id = 0
+    first_batch = True
+    while True:
+        cur.execute(
+            f"SELECT * FROM {table} WHERE site_id=%s AND created_at >= %s AND created_at < %s AND id > %s ORDER BY id LIMIT %s",
+            (site_id, day_start, day_end, last_id, ARCHIVE_BATCH_ROWS)
+        )
+        rows = cur.fetchall()
+        if not rows:
+            break
+
+        description = cur.description
+        names = [d[0] for d in description]
+        id_idx = names.index("id")
+        first_id, last_id = rows[0][id_idx], rows[-1][id_idx]
+        if table == "events":
+            rows = session_headers.fill_events(conn.cursor(), names, rows)
+            rows = dictionary.fill_labels(conn.cursor(), names, rows)
+        if first_batch:
+            _drop_stale_parts(part_dir, first_id)
+            first_batch = False
+
+        os.makedirs(part_dir, exist_ok=True)
+        final_path = os.path.join(part_dir, f"part-{first_id}-{last_id}.parquet")
+        tmp_path = final_path + ".tmp"
+        pq.write_table(_to_arrow(description, rows), tmp_path, compression="zstd")
+        os.replace(tmp_path, final_path)
+
+        cur.execute(
+            f"DELETE FROM {table} WHERE site_id=%s AND created_at >= %s AND created_at < %s AND id BETWEEN %s AND %s",
+            (site_id, day_start, day_end, first_id, last_id)
+        )
+        conn.commit()
+        moved += len(rows)
+    return moved
+
+
+def archive_table(conn, table, cutoff):
+    """Move every (site_id, day) partition of `table` older than `cutoff` to Parquet.
+
+    Partitions of site_ids that are unsafe as path names are skipped, and so is
+    every partition from the first such day on: the boundary (below which
+    reports read Parquet only) stops at the start of that day, so no rows are
+    moved past it.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT site_id, DATE(created_at) AS d FROM {table} WHERE created_at < %s AND site_id IS NOT NULL GROUP BY site_id, d",
+        (cutoff,)
+    )
+    partitions = cur.fetchall()
+
+    boundary = cutoff
+    for site_id, day in partitions:
+        if not _SAFE_SITE_ID.match(site_id or ""):
+            print(f"Skipping archive of {table} for unsafe site_id {site_id!r}")
+            boundary = min(boundary, datetime.combine(day, datetime.min.time()))
+
+    moved = 0
+    for site_id, day in partitions:
+        if datetime.combine(day, datetime.min.time()) < boundary:
+            moved += _archive_partition(conn, table, site_id, day)
+
+    _set_boundary(conn, table, boundary)
+    return moved
+
+
+def archive_closed_days(conn):
+    """Archive all eligible closed days. Returns rows moved per table."""
+    cutoff = archive_cutoff(conn)
+    return {table: archive_table(conn, table, cutoff) for table in ARCHIVED_TABLES}
+
+
+# ---------------- HYBRID QUERIES ----------------
+def _partition_files(table, site_id, start, end):
+    """Parquet files for one site restricted to the day partitions overlapping [start, end)."""
+    if not site_id or not _SAFE_SITE_ID.match(site_id):
+        return []
+    site_dir = os.path.join(ARCHIVE_DIR, table, f"site_id={site_id}")
+    if not os.path.isdir(site_dir):
+        return []
+
+    files = []
+    for name in sorted(os.listdir(site_dir)):
+        if not name.startswith("date="):
+            continue
+        day = datetime.fromisoformat(name[5:])
+        if start is not None and day + timedelta(days=1) <= start:
+            continue
+        if end is not None and day >= end:
+            continue
+        day_dir = os.path.join(site_dir, name)
+        files.extend(os.path.join(day_dir, f) for f in sorted(os.listdir(day_dir)) if _PART_FILE.match(f))
+    return files
+
+
+def _cold_source(con, table, files):
+    """Relation over the Parquet files, filling in columns older partitions lack."""
+    source = f"read_parquet({files!r}, union_by_name=true)"
+    present = {row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()}
+    missing = [f"{value} AS {name}" for name, value in COLUMN_DEFAULTS.get(table, {}).items() if name not in present]
+    if missing:
+        source = f"(SELECT *, {', '.join(missing)} FROM {source})"
+    return source
+
+
+def _with_range(where_clauses, params, start, end):
+    clauses = list(where_clauses)
+    values = list(params)
+    if start is not None:
+        clauses.append("created_at >= %s")
+        values.append(start)
+    if end is not None:
+        clauses.append("created_at < %s")
+        values.append(end)
+    return " AND ".join(clauses), values
+
+
+def hybrid_query(cur, table, site_id, where_clauses, params, start, end, inner_sql, outer_sql):
+    """Run a two-stage aggregate over the cold and hot tiers of `table`.
+
+    `inner_sql` is a partial aggregate with `{table}` and `{where}` placeholders
+    that must be valid in both MySQL and DuckDB; it runs against MySQL for the
+    hot range and against the Parquet partitions for the cold range. `outer_sql`
+    then combines the partial rows, exposed to it as the relation `part`, inside
+    DuckDB. Keep partials mergeable (counts/sums, or per-visitor rows when
+    distinct visitors are needed) so the merged answer is exact.
+
+    `where_clauses`/`params` must not contain date filters; they are added per tier.
+    """
+    cold, hot = split_range(cur.connection, table, start, end)
+
+    relations = []
+    cold_params = []
+    con = duckdb.connect()
+    try:
+        if hot is not None:
+            where_sql, values = _with_range(where_clauses, params, *hot)
+            cur.execute(inner_sql.format(table=HOT_SOURCES.get(table, table), where=where_sql), tuple(values))
+            rows = cur.fetchall()
+            if rows:
+                names = [d[0] for d in cur.description]
+                con.register("hot_part", pa.table({n: [r[i] for r in rows] for i, n in enumerate(names)}))
+                relations.append("SELECT * FROM hot_part")
+
+        if cold is not None:
+            files = _partition_files(table, site_id, *cold)
+            if files:
+                where_sql, values = _with_range(where_clauses, params, *cold)
+                source = _cold_source(con, table, files)
+                relations.append(inner_sql.format(table=source, where=where_sql).replace("%s", "?"))
+                cold_params.extend(values)
+
+        if not relations:
+            return []
+        union_sql = " UNION ALL ".join(f"({r})" for r in relations)
+        return con.execute(f"WITH part AS ({union_sql}) {outer_sql}", cold_params).fetchall()
+    finally:
+        con.close()
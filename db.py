@@ -0,0 +1,580 @@
+"""MySQL access shared by the dashboard and the ingest tier: connections, a small
+connection pool for long-lived workers, and schema setup.
+
+Writes (ingest, settings, jobs) always go to the primary through
+`get_connection()`. Read-only dashboard routes use `get_read_connection()`,
+which picks one of the MYSQL_READ_HOSTS replicas whose replication lag is
+within the route's freshness bound and falls back to the primary when none is
+(or none is configured or reachable). Every decision is counted in
+`db_read_routes_total`.
+"""
+import itertools
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import pymysql
+import pymysql.cursors
+
+import metrics
+
+# comma-separated host[:port] list; empty = all reads go to the primary
+READ_HOSTS = [h.strip() for h in os.getenv("MYSQL_READ_HOSTS", "").split(",") if h.strip()]
+REPLICA_LAG_CHECK_SEC = float(os.getenv("REPLICA_LAG_CHECK_SEC", "5"))
+REPLICA_RETRY_SEC = float(os.getenv("REPLICA_RETRY_SEC", "30"))
+
+
+# ---------------- DB CONNECTION ----------------
+def _connect(host, port=3306, user=None, password=None):
+    with metrics.DB_CONNECT_SECONDS.time():
+        return pymysql.connect(
+            host=host,
+            user=user or os.getenv("MYSQL_USER"),      # user@servername
+            password=password or os.getenv("MYSQL_PASSWORD"),
+            database=os.getenv("MYSQL_DB"),
+            port=port,
+            connect_timeout=5,
+            autocommit=True,
+            ssl={"ssl": {}},   # 🔐 SSL ENABLED
+            cursorclass=metrics.InstrumentedCursor
+        )
+
+
+def get_connection():
+    """Connection to the primary (writer)."""
+    return _connect(os.getenv("MYSQL_HOST"))
+
+
+# ---------------- READ REPLICAS ----------------
+class _Replica:
+    __slots__ = ("name", "host", "port", "lag", "checked_at", "down_until")
+
+    def __init__(self, name):
+        host, _, port = name.rpartition(":") if ":" in name else (name, "", "")
+        self.name = name
+        self.host = host
+        self.port = int(port or 3306)
+        self.lag = None
+        self.checked_at = float("-inf")
+        self.down_until = 0.0
+
+
+_replicas = [_Replica(h) for h in READ_HOSTS]
+_replica_lock = threading.Lock()
+_next_replica = itertools.count()
+
+
+def _replica_lag(conn):
+    """Seconds the replica is behind its source; inf when replication is stopped,
+    0 for a server that is not a replica at all."""
+    cur = conn.cursor(pymysql.cursors.DictCursor)
+    try:
+        cur.execute("SHOW REPLICA STATUS")
+    except pymysql.err.ProgrammingError:
+        cur.execute("SHOW SLAVE STATUS")   # MySQL < 8.0.22
+    row = cur.fetchone()
+    if row is None:
+        return 0.0
+    lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+    return float("inf") if lag is None else float(lag)
+
+
+def _mark_down(replica, now, error):
+    with _replica_lock:
+        replica.down_until = now + REPLICA_RETRY_SEC
+    print(f"Read replica {replica.name} unavailable, retrying in {REPLICA_RETRY_SEC:.0f}s: {error}")
+
+
+def get_read_connection(route, max_lag):
+    """Connection for read-only queries that tolerate `max_lag` seconds of replication lag.
+
+    Replicas are tried round-robin; a replica's lag is re-checked at most every
+    REPLICA_LAG_CHECK_SEC and an unreachable one is skipped for
+    REPLICA_RETRY_SEC. Falls back to the primary.
+    """
+    reason = "no_replicas"
+    start = next(_next_replica)
+    for i in range(len(_replicas)):
+        replica = _replicas[(start + i) % len(_replicas)]
+        now = time.monotonic()
+        if replica.down_until > now:
+            reason = "down"
+            continue
+        stale = now - replica.checked_at >= REPLICA_LAG_CHECK_SEC
+        if not stale and replica.lag > max_lag:
+            reason = "lag"
+            continue
+        try:
+            conn = _connect(replica.host, replica.port, os.getenv("MYSQL_READ_USER"), os.getenv("MYSQL_READ_PASSWORD"))
+        except Exception as e:
+            _mark_down(replica, now, e)
+            reason = "down"
+            continue
+        if stale:
+            try:
+                lag = _replica_lag(conn)
+            except Exception as e:
+                conn.close()
+                _mark_down(replica, now, e)
+                reason = "down"
+                continue
+            with _replica_lock:
+                replica.lag = lag
+                replica.checked_at = now
+            metrics.DB_REPLICA_LAG.labels(replica.name).set(lag)
+        if replica.lag > max_lag:
+            conn.close()
+            reason = "lag"
+            continue
+        metrics.DB_READ_ROUTES.labels(route, "replica", "ok").inc()
+        return conn
+
+    metrics.DB_READ_ROUTES.labels(route, "primary", reason).inc()
+    return get_connection()
+
+# ---------------- INIT DB ----------------
+def init_db():
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        # create users first so FK in sites can reference it
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            email VARCHAR(200) UNIQUE,
+            name VARCHAR(200),
+            picture VARCHAR(500),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS sites (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            site_id VARCHAR(100) UNIQUE,
+            site_name VARCHAR(200),
+            domain VARCHAR(200),
+            PropertyName VARCHAR(200),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            user_id INT,
+            INDEX (user_id),
+            CONSTRAINT FK_sites_users FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
+        ) ENGINE=InnoDB
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS visitors (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            visitor_id VARCHAR(100),
+            site_id VARCHAR(100),
+            first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uniq_visitor_site (visitor_id, site_id)
+        ) ENGINE=InnoDB
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            site_id VARCHAR(100),
+            visitor_id VARCHAR(100),
+            event_type VARCHAR(50),
+            page_url TEXT,
+            referrer TEXT,
+            user_agent TEXT,
+            ip_address VARCHAR(50),
+            language VARCHAR(20),
+            platform VARCHAR(50),
+            screen_size VARCHAR(20),
+            timezone VARCHAR(50),
+            clicked_url TEXT,
+            is_external TINYINT(1),
+            page_title VARCHAR(255),
+            scroll_percent INT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            INDEX (site_id),
+            INDEX (visitor_id),
+            INDEX (created_at)
+        ) ENGINE=InnoDB
+        """)
+
+        # interned page URLs/referrers and user agents, referenced by id from events and sessions
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS url_dict (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            hash BINARY(16) NOT NULL,
+            value TEXT NOT NULL,
+            host VARCHAR(255),
+            UNIQUE KEY uniq_hash (hash),
+            INDEX idx_host (host)
+        ) ENGINE=InnoDB
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_agent_dict (
+            id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+            hash BINARY(16) NOT NULL,
+            value TEXT NOT NULL,
+            UNIQUE KEY uniq_hash (hash)
+        ) ENGINE=InnoDB
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            site_id VARCHAR(100) NOT NULL,
+            session_id VARCHAR(100) NOT NULL,
+            visitor_id VARCHAR(100),
+            started_at DATETIME,
+            ended_at DATETIME,
+            event_count INT DEFAULT 0,
+            pageview_count INT DEFAULT 0,
+            engaged TINYINT(1) DEFAULT 0,
+            landing_page_id BIGINT,
+            exit_page_id BIGINT,
+            referrer_id BIGINT,
+            source VARCHAR(20),
+            sample_weight FLOAT NOT NULL DEFAULT 1,
+            PRIMARY KEY (site_id, session_id),
+            INDEX idx_site_started (site_id, started_at),
+            INDEX idx_site_ended (site_id, ended_at)
+        ) ENGINE=InnoDB
+        """)
+
+        # per ingest worker Space-Saving/HyperLogLog sketches per site and minute (see sketches.py)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS realtime_sketches (
+            site_id VARCHAR(100) NOT NULL,
+            minute DATETIME NOT NULL,
+            worker VARCHAR(64) NOT NULL,
+            sketch MEDIUMBLOB NOT NULL,
+            PRIMARY KEY (site_id, minute, worker),
+            INDEX idx_minute (minute)
+        ) ENGINE=InnoDB
+        """)
+
+        # visitor counts and coordinate sums per site, map zoom and grid cell (see geo.py)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS geo_cells (
+            site_id VARCHAR(100) NOT NULL,
+            zoom TINYINT NOT NULL,
+            cell_x INT NOT NULL,
+            cell_y INT NOT NULL,
+            visitors INT NOT NULL DEFAULT 0,
+            lat_sum DOUBLE NOT NULL DEFAULT 0,
+            lon_sum DOUBLE NOT NULL DEFAULT 0,
+            PRIMARY KEY (site_id, zoom, cell_x, cell_y)
+        ) ENGINE=InnoDB
+        """)
+
+        # weighted scroll events per site, day, page and scroll percent (see scroll_depth.py)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS scroll_histograms (
+            site_id VARCHAR(100) NOT NULL,
+            day DATE NOT NULL,
+            page_url_id BIGINT NOT NULL,
+            percent TINYINT UNSIGNED NOT NULL,
+            events DOUBLE NOT NULL DEFAULT 0,
+            PRIMARY KEY (site_id, day, page_url_id, percent)
+        ) ENGINE=InnoDB
+        """)
+
+        # per ingest worker HyperLogLogs of visitors per site, day and scroll depth bucket
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS scroll_visitor_sketches (
+            site_id VARCHAR(100) NOT NULL,
+            day DATE NOT NULL,
+            worker VARCHAR(64) NOT NULL,
+            sketch MEDIUMBLOB NOT NULL,
+            PRIMARY KEY (site_id, day, worker)
+        ) ENGINE=InnoDB
+        """)
+
+        # last run of each scheduled job (see scheduler.py)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            name VARCHAR(64) PRIMARY KEY,
+            last_due DATETIME,
+            last_started_at DATETIME,
+            last_finished_at DATETIME,
+            last_status VARCHAR(20),
+            last_error VARCHAR(255),
+            last_duration_sec FLOAT,
+            worker VARCHAR(64)
+        ) ENGINE=InnoDB
+        """)
+
+        # roaring bitmaps of visitors.id per site and day (see retention.py)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS visitor_bitmaps (
+            site_id VARCHAR(100) NOT NULL,
+            day DATE NOT NULL,
+            visitors MEDIUMBLOB NOT NULL,
+            new_visitors MEDIUMBLOB NOT NULL,
+            visitor_count INT UNSIGNED NOT NULL DEFAULT 0,
+            new_visitor_count INT UNSIGNED NOT NULL DEFAULT 0,
+            PRIMARY KEY (site_id, day)
+        ) ENGINE=InnoDB
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS TechStack (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            site_id VARCHAR(100),
+            visitor_id VARCHAR(100),
+            Browser VARCHAR(100),
+            BrowserVersion VARCHAR(50),
+            DeviceCat VARCHAR(50),
+            ScreenRes VARCHAR(50),
+            Platform VARCHAR(50),
+            OS VARCHAR(50),
+            OSVersion VARCHAR(50),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            INDEX (site_id)
+            ,INDEX (visitor_id)
+        ) ENGINE=InnoDB
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS site_access (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            site_id VARCHAR(100),
+            user_id INT,
+            role VARCHAR(50) DEFAULT 'admin',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uniq_access (site_id, user_id),
+            CONSTRAINT FK_access_site FOREIGN KEY (site_id) REFERENCES sites(site_id) ON DELETE CASCADE,
+            CONSTRAINT FK_access_user FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        ) ENGINE=InnoDB
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS tracking_rules (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            site_id VARCHAR(50),
+            event_type VARCHAR(20),
+            selector VARCHAR(255),
+            event_name VARCHAR(100),
+            active BOOLEAN DEFAULT TRUE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            INDEX (site_id)
+        ) ENGINE=InnoDB
+        """)
+
+        # Watermark table: tracks last processed watermark per table
+        # (per site for events: tbl_name='events:<site_id>', last_id breaks created_at ties)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS watermark (
+            tbl_name VARCHAR(200) PRIMARY KEY,
+            last_watermark DATETIME,
+            last_id BIGINT DEFAULT 0
+        ) ENGINE=InnoDB
+        """)
+
+        # IP list: distinct new IPs found by the events pipeline, waiting for geolocation
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS ip_list (
+            ip_address VARCHAR(50) PRIMARY KEY,
+            site_id VARCHAR(100),
+            visitor_id VARCHAR(100),
+            first_seen DATETIME,
+            INDEX (first_seen)
+        ) ENGINE=InnoDB
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS ip_geolocation (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            ip_address VARCHAR(50) UNIQUE,
+            site_id VARCHAR(100),
+            visitor_id VARCHAR(100),
+            country VARCHAR(100),
+            countryCode VARCHAR(10),
+            region VARCHAR(10),
+            regionName VARCHAR(100),
+            city VARCHAR(100),
+            lat DECIMAL(10, 6),
+            lon DECIMAL(10, 6),
+            timezone VARCHAR(50),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            INDEX (ip_address)
+        ) ENGINE=InnoDB
+        """)
+
+
+        # Ensure optional columns exist on upgrades
+        try:
+            cur.execute("ALTER TABLE TechStack ADD COLUMN visitor_id VARCHAR(100)")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD COLUMN page_title VARCHAR(255)")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD COLUMN scroll_percent INT")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE sites ADD COLUMN ingest_rate_limit INT")  # events/s per ingest worker, NULL = default
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD INDEX idx_site_created (site_id, created_at)")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE watermark ADD COLUMN last_id BIGINT DEFAULT 0")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE TechStack ADD COLUMN event_id BIGINT")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE TechStack ADD UNIQUE KEY uniq_event (event_id)")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD COLUMN sample_weight FLOAT NOT NULL DEFAULT 1")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE TechStack ADD COLUMN sample_weight FLOAT NOT NULL DEFAULT 1")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE sites ADD COLUMN sample_rate FLOAT")  # fixed sample rate, NULL = adaptive
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE sites ADD COLUMN sampling_target_eps FLOAT")  # events/s budget, NULL = default
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD COLUMN event_id VARCHAR(128)")  # client id from track.js, NULL for old clients
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD UNIQUE KEY uniq_site_event (site_id, event_id)")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD COLUMN session_id VARCHAR(100)")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD COLUMN page_url_id BIGINT, ADD COLUMN referrer_id BIGINT, ADD COLUMN user_agent_id INT UNSIGNED")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE sessions ADD COLUMN landing_page_id BIGINT, ADD COLUMN exit_page_id BIGINT, ADD COLUMN referrer_id BIGINT")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD INDEX idx_site_type_created (site_id, event_type, created_at)")  # funnels
+        except Exception:
+            pass
+        try:
+            # session header, sent once per session (see session_headers.py)
+            cur.execute("ALTER TABLE sessions ADD COLUMN user_agent_id INT UNSIGNED, ADD COLUMN language VARCHAR(20), "
+                        "ADD COLUMN platform VARCHAR(50), ADD COLUMN screen_size VARCHAR(20), ADD COLUMN timezone VARCHAR(50)")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD INDEX idx_site_visitor_created (site_id, visitor_id, created_at)")  # event explorer
+        except Exception:
+            pass
+        try:
+            # normalized page URL and UTM campaign (urlnorm.py)
+            cur.execute("ALTER TABLE events ADD COLUMN page_path_id BIGINT, ADD COLUMN utm_source VARCHAR(100), "
+                        "ADD COLUMN utm_medium VARCHAR(100), ADD COLUMN utm_campaign VARCHAR(100)")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD INDEX idx_site_path_created (site_id, page_path_id, created_at)")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE events ADD INDEX idx_site_campaign (site_id, utm_source, utm_medium, utm_campaign, created_at)")
+        except Exception:
+            pass
+        try:
+            cur.execute("ALTER TABLE sites ADD COLUMN url_query_params VARCHAR(255)")  # query params kept by URL normalization
+        except Exception:
+            pass
+
+
+        conn.commit()
+    finally:
+        conn.close()
+        print('DB Init Completed!')
+
+
+# ---------------- CONNECTION POOL ----------------
+class ConnectionPool:
+    """Small blocking pool of MySQL connections for long-lived workers.
+
+    Connections idle for longer than `ping_after` seconds are pinged (and
+    reconnected) before reuse; a connection that raised is discarded, as is one
+    older than `max_age` seconds (so a factory's choices, e.g. replica routing,
+    are made again).
+    """
+
+    def __init__(self, size, factory=None, ping_after=30, max_age=None):
+        self._factory = factory or get_connection
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._ping_after = ping_after
+        self._max_age = max_age
+
+    def _checkout(self):
+        while True:
+            try:
+                conn, last_used, created = self._idle.get_nowait()
+            except queue.Empty:
+                return self._factory(), time.monotonic()
+            now = time.monotonic()
+            if self._max_age is not None and now - created > self._max_age:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                continue
+            if now - last_used > self._ping_after:
+                conn.ping(reconnect=True)
+            return conn, created
+
+    @contextmanager
+    def connection(self, timeout=None):
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("No database connection available")
+        try:
+            conn, created = self._checkout()
+
+            healthy = False
+            try:
+                yield conn
+                healthy = True
+            finally:
+                if healthy:
+                    self._idle.put((conn, time.monotonic(), created))
+                else:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()[0]
+            except queue.Empty:
+                return
+            try:
+                conn.close()
+            except Exception:
+                pass
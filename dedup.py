@@ -0,0 +1,74 @@
+"""Bounded duplicate filter for client event ids.
+
+track.js gives every event a page-scoped, deterministic `eventId`, so a beacon
+the browser retries, or a handler that fires twice, arrives with an id ingest
+has already seen. `RotatingBloomFilter` remembers ids for at least
+INGEST_DEDUP_WINDOW_SEC in a fixed amount of memory: two Bloom filter
+generations, the older one dropped whenever the current one is a window old
+(or full, which shortens the window but keeps the false-positive rate at
+INGEST_DEDUP_ERROR_RATE). A false positive drops one genuine event.
+
+The filter is per worker process; the `(site_id, event_id)` unique key on
+`events` catches duplicates that land on different workers or come back
+through spool replay.
+"""
+import hashlib
+import math
+import os
+import time
+
+WINDOW_SEC = float(os.getenv("INGEST_DEDUP_WINDOW_SEC", "600"))
+CAPACITY = int(os.getenv("INGEST_DEDUP_CAPACITY", "1000000"))
+ERROR_RATE = float(os.getenv("INGEST_DEDUP_ERROR_RATE", "0.0001"))
+
+
+class BloomFilter:
+    __slots__ = ("size", "hashes", "bits", "count")
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Kirsch-Mitzenmacher double hashing over one 128-bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+
+class RotatingBloomFilter:
+    def __init__(self, window_sec=WINDOW_SEC, capacity=CAPACITY, error_rate=ERROR_RATE):
+        self.window_sec = window_sec
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+        self.started = time.monotonic()
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self.started >= self.window_sec or self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.started = now
+
+    def __contains__(self, key):
+        self._rotate()
+        return key in self.current or (self.previous is not None and key in self.previous)
+
+    def add(self, key):
+        self._rotate()
+        self.current.add(key)
@@ -0,0 +1,212 @@
+"""Interned strings for the high-repetition `events` columns.
+
+`page_url` and `referrer` are stored once in `url_dict`, `user_agent` in
+`user_agent_dict`, each keyed by the MD5 of the value; `events` keeps only
+`page_url_id`, `referrer_id` and `user_agent_id`. Empty strings map to NULL.
+
+The ingest writers resolve strings through a per-process LRU cache
+(DICT_CACHE_SIZE entries per dictionary) and only go to MySQL for misses.
+Reports group on the integer ids and look up `labels()` for the rows they
+actually show. `backfill_events()` converts rows written before the ids
+existed.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+CACHE_SIZE = int(os.getenv("DICT_CACHE_SIZE", "100000"))
+BACKFILL_BATCH_ROWS = int(os.getenv("DICT_BACKFILL_BATCH_ROWS", "5000"))
+
+URLS = "url_dict"
+USER_AGENTS = "user_agent_dict"
+
+# text column -> (id column, dictionary table)
+ENCODED_COLUMNS = {
+    "page_url": ("page_url_id", URLS),
+    "page_path": ("page_path_id", URLS),   # normalized page_url (urlnorm.py); only the id is stored
+    "referrer": ("referrer_id", URLS),
+    "user_agent": ("user_agent_id", USER_AGENTS),
+}
+
+# `events` with its strings decoded, for queries that need the text (the hot
+# tier of cold_storage.hybrid_query, where Parquet partitions hold plain strings)
+DECODED_EVENTS = f"""(
+    SELECT e.id, e.site_id, e.visitor_id, e.session_id, e.event_type, e.created_at, e.sample_weight,
+           e.scroll_percent, e.page_title, e.page_url_id, e.page_path_id, e.referrer_id, e.user_agent_id,
+           e.utm_source, e.utm_medium, e.utm_campaign,
+           COALESCE(pu.value, e.page_url) AS page_url,
+           COALESCE(rf.value, e.referrer) AS referrer,
+           COALESCE(ua.value, e.user_agent) AS user_agent
+    FROM events e
+    LEFT JOIN {URLS} pu ON pu.id = e.page_url_id
+    LEFT JOIN {URLS} rf ON rf.id = e.referrer_id
+    LEFT JOIN {USER_AGENTS} ua ON ua.id = e.user_agent_id
+) AS events"""
+
+
+def _hash(value):
+    return hashlib.md5(value.encode("utf-8")).digest()
+
+
+def _host(value):
+    try:
+        return (urlsplit(value).hostname or "")[:255] or None
+    except ValueError:
+        return None
+
+
+class Dictionary:
+    """value -> id for one dictionary table, with a bounded LRU cache in front."""
+
+    def __init__(self, table, with_host=False, cache_size=CACHE_SIZE):
+        self.table = table
+        self.with_host = with_host
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _select(self, cur, hashes):
+        placeholders = ",".join(["%s"] * len(hashes))
+        cur.execute(f"SELECT hash, id FROM {self.table} WHERE hash IN ({placeholders})", tuple(hashes))
+        return {bytes(h): i for h, i in cur.fetchall()}
+
+    def ids(self, conn, values):
+        """Map each non-empty value to its id, interning new ones.
+
+        Commits on `conn`, so call it before opening the transaction that uses the ids
+        (a rolled-back id must never reach the cache).
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for v in set(values):
+                if not v:
+                    continue
+                i = self._cache.get(v)
+                if i is None:
+                    missing.append(v)
+                else:
+                    self._cache.move_to_end(v)
+                    found[v] = i
+        if not missing:
+            return found
+
+        cur = conn.cursor()
+        by_hash = {_hash(v): v for v in missing}
+        known = self._select(cur, list(by_hash))
+        conn.commit()
+        new = [h for h in by_hash if h not in known]
+        if new:
+            if self.with_host:
+                sql = f"INSERT INTO {self.table} (hash, value, host) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE id=id"
+                rows = [(h, by_hash[h], _host(by_hash[h])) for h in new]
+            else:
+                sql = f"INSERT INTO {self.table} (hash, value) VALUES (%s, %s) ON DUPLICATE KEY UPDATE id=id"
+                rows = [(h, by_hash[h]) for h in new]
+            cur.executemany(sql, rows)
+            conn.commit()
+            # a fresh read sees rows another writer committed concurrently
+            known.update(self._select(cur, new))
+            conn.commit()
+
+        with self._lock:
+            for h, i in known.items():
+                v = by_hash[h]
+                found[v] = i
+                self._cache[v] = i
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return found
+
+
+urls = Dictionary(URLS, with_host=True)
+user_agents = Dictionary(USER_AGENTS)
+
+
+def labels(cur, table, ids):
+    """id -> value for the given ids (None ids are skipped)."""
+    ids = {i for i in ids if i is not None}
+    if not ids:
+        return {}
+    cur.execute(f"SELECT id, value FROM {table} WHERE id IN ({','.join(['%s'] * len(ids))})", tuple(ids))
+    return dict(cur.fetchall())
+
+
+def find(cur, table, value):
+    """Id of `value` in a dictionary table, or None; read-only (unlike Dictionary.ids)."""
+    if not value:
+        return None
+    cur.execute(f"SELECT id FROM {table} WHERE hash=%s", (_hash(value),))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def fill_labels(cur, names, rows):
+    """Fill NULL page_url/referrer/user_agent in `events` rows (column `names`) from their ids."""
+    index = {n: i for i, n in enumerate(names)}
+    columns = [(index[text], index[id_col], table) for text, (id_col, table) in ENCODED_COLUMNS.items()
+               if text in index and id_col in index]
+    if not columns:
+        return rows
+    rows = [list(r) for r in rows]
+    for text_idx, id_idx, table in columns:
+        found = labels(cur, table, [r[id_idx] for r in rows if r[text_idx] is None])
+        for r in rows:
+            if r[text_idx] is None and r[id_idx] is not None:
+                r[text_idx] = found.get(r[id_idx])
+    return rows
+
+
+# ---------------- BACKFILL ----------------
+def backfill_events(conn, max_batches=None):
+    """Move page_url/referrer/user_agent of older `events` rows into the dictionaries.
+
+    Progress is kept in `watermark` ('events_dictionary'), so the job can be
+    stopped and re-run. Returns the number of rows converted.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT last_id FROM watermark WHERE tbl_name='events_dictionary'")
+    row = cur.fetchone()
+    last_id = row[0] if row and row[0] else 0
+    conn.commit()
+
+    converted = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        cur.execute(
+            """
+            SELECT id, page_url, referrer, user_agent FROM events
+            WHERE id > %s AND (page_url IS NOT NULL OR referrer IS NOT NULL OR user_agent IS NOT NULL)
+            ORDER BY id LIMIT %s
+            """,
+            (last_id, BACKFILL_BATCH_ROWS)
+        )
+        rows = cur.fetchall()
+        conn.commit()
+        if not rows:
+            break
+
+        url_ids = urls.ids(conn, [r[1] for r in rows] + [r[2] for r in rows])
+        ua_ids = user_agents.ids(conn, [r[3] for r in rows])
+        last_id = rows[-1][0]
+        cur.executemany(
+            """
+            UPDATE events SET page_url_id=%s, referrer_id=%s, user_agent_id=%s,
+                page_url=NULL, referrer=NULL, user_agent=NULL
+            WHERE id=%s
+            """,
+            [(url_ids.get(r[1]), url_ids.get(r[2]), ua_ids.get(r[3]), r[0]) for r in rows]
+        )
+        cur.execute(
+            """
+            INSERT INTO watermark (tbl_name, last_watermark, last_id) VALUES ('events_dictionary', NOW(), %s)
+            ON DUPLICATE KEY UPDATE last_watermark=VALUES(last_watermark), last_id=VALUES(last_id)
+            """,
+            (last_id,)
+        )
+        conn.commit()
+        converted += len(rows)
+        batches += 1
+    return converted
@@ -0,0 +1,255 @@
+"""Compact in-memory window of recent events for realtime aggregation.
+
+An `EventWindow` holds the last EVENT_WINDOW_SEC seconds of events of every
+site as parallel NumPy columns instead of per-event tuples, dicts and sets:
+
+    ts       uint32   epoch seconds (UTC)
+    site     uint32   interned site_id
+    visitor  uint32   interned visitor_id
+    page     uint32   interned page (0 = no page)
+    event    uint16   interned event_type
+    weight   float32  sample_weight
+
+22 bytes per event plus one interner entry per distinct site, visitor, page
+and event type still in the window (bench/window_bench.py compares it with
+tuples and dict-of-sets aggregation).
+
+Events are appended at the end of the columns and evicted by time from the
+front. When the end of the arrays is reached, the live rows are moved back to
+the start (or the arrays doubled, when more than half full), so the live
+window is always one contiguous slice and aggregations run on views without
+copying. At most EVENT_WINDOW_MAX_EVENTS are kept; beyond that the oldest
+events are dropped early. Visitor and page codes are re-interned when the
+arrays are compacted, so interners only hold values still in the window.
+
+Aggregations (`event_count()`, `active_visitors()`, `visitors_per_minute()`,
+`top_pages()`) are vectorized: a boolean mask per query, `np.unique` for
+distinct visitors and `np.bincount` for per-minute and per-page sums. Counts
+are weighted by sample_weight; distinct visitors count each visitor once with
+its weight (sampling is per visitor, so all of a visitor's events share it).
+Events may arrive slightly out of order (several writer shards); queries mask
+on the timestamp, so ordering only affects how early a late event is evicted.
+"""
+import os
+import threading
+import time
+from datetime import timezone
+
+import numpy as np
+
+WINDOW_SEC = int(os.getenv("EVENT_WINDOW_SEC", "1860"))
+MAX_EVENTS = int(os.getenv("EVENT_WINDOW_MAX_EVENTS", "5000000"))
+INITIAL_CAPACITY = 1 << 16
+
+COLUMNS = (
+    ("ts", np.uint32),
+    ("site", np.uint32),
+    ("visitor", np.uint32),
+    ("page", np.uint32),
+    ("event", np.uint16),
+    ("weight", np.float32),
+)
+NO_PAGE = 0
+
+
+def epoch_seconds(dt):
+    """Epoch seconds of a naive UTC datetime (the queued events' created_at)."""
+    return int(dt.replace(tzinfo=timezone.utc).timestamp())
+
+
+class _Interner:
+    """value <-> dense integer code; code 0 is reserved for None when `with_none`."""
+
+    def __init__(self, with_none=False):
+        self.with_none = with_none
+        self.reset()
+
+    def reset(self, values=()):
+        self.values = [None] if self.with_none else []
+        self.codes = {None: 0} if self.with_none else {}
+        for v in values:
+            self.code(v)
+
+    def code(self, value):
+        c = self.codes.get(value)
+        if c is None:
+            c = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return c
+
+    def __len__(self):
+        return len(self.values)
+
+
+class EventWindow:
+    def __init__(self, window_sec=WINDOW_SEC, capacity=INITIAL_CAPACITY, max_events=MAX_EVENTS):
+        self.window_sec = window_sec
+        self.max_events = max_events
+        self.cols = {name: np.zeros(capacity, dtype) for name, dtype in COLUMNS}
+        self.start = 0
+        self.end = 0
+        self.dropped = 0
+        self.sites = _Interner()
+        self.visitors = _Interner()
+        self.pages = _Interner(with_none=True)
+        self.events = _Interner()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def capacity(self):
+        return len(self.cols["ts"])
+
+    # ---------------- WRITE SIDE ----------------
+    def _make_room(self, n):
+        """Ensure n free rows at the end: evict over max_events, then compact or grow."""
+        excess = len(self) + n - self.max_events
+        if excess > 0:
+            excess = min(excess, len(self))
+            self.start += excess
+            self.dropped += excess
+        if self.end + n <= self.capacity:
+            return
+        live = len(self)
+        capacity = self.capacity
+        while live + n > capacity // 2:
+            capacity *= 2
+        if capacity != self.capacity:
+            cols = {name: np.zeros(capacity, dtype) for name, dtype in COLUMNS}
+        else:
+            cols = self.cols
+        for name in self.cols:
+            cols[name][:live] = self.cols[name][self.start:self.end]
+        self.cols = cols
+        self.start, self.end = 0, live
+        self._reintern(self.visitors, "visitor")
+        self._reintern(self.pages, "page")
+
+    def _reintern(self, interner, column):
+        """Drop interned values no longer referenced by the live rows."""
+        col = self.cols[column][self.start:self.end]
+        if len(interner) <= max(INITIAL_CAPACITY, 2 * len(col)):
+            return
+        used = np.unique(col)
+        if interner.with_none and (not len(used) or used[0] != 0):
+            used = np.concatenate(([0], used))
+        values = interner.values
+        interner.reset(values[c] for c in used.tolist() if values[c] is not None)
+        remap = np.zeros(len(values), col.dtype)
+        remap[used] = np.arange(len(used), dtype=col.dtype)
+        col[:] = remap[col]
+
+    def extend(self, events):
+        """Append queued event dicts (created_at, site_id, visitor_id, page_path, event_type, sample_weight)."""
+        rows = [
+            (epoch_seconds(e["created_at"]), e["site_id"], e["visitor_id"], e.get("page_path") or e.get("page_url"),
+             e["event_type"], e.get("sample_weight") or 1.0)
+            for e in events
+        ]
+        self.append_many(rows)
+
+    def append_many(self, rows):
+        """Append (epoch_seconds, site_id, visitor_id, page, event_type, weight) rows."""
+        if not rows:
+            return
+        with self._lock:
+            self._make_room(len(rows))
+            i, j = self.end, self.end + len(rows)
+            c = self.cols
+            c["ts"][i:j] = [r[0] for r in rows]
+            c["site"][i:j] = [self.sites.code(r[1]) for r in rows]
+            c["visitor"][i:j] = [self.visitors.code(r[2]) for r in rows]
+            c["page"][i:j] = [self.pages.code(r[3]) for r in rows]
+            c["event"][i:j] = [self.events.code(r[4]) for r in rows]
+            c["weight"][i:j] = [r[5] for r in rows]
+            self.end = j
+
+    def evict(self, now=None):
+        """Drop events older than the window from the front; returns how many."""
+        cutoff = (time.time() if now is None else now) - self.window_sec
+        with self._lock:
+            # the leading run of expired rows (a late row behind a newer one waits for the next call)
+            recent = self.cols["ts"][self.start:self.end] >= cutoff
+            n = int(recent.argmax()) if recent.any() else len(recent)
+            self.start += n
+            return n
+
+    def nbytes(self):
+        """Bytes held by the column arrays (allocated capacity; interners not included)."""
+        return sum(a.nbytes for a in self.cols.values())
+
+    # ---------------- AGGREGATION ----------------
+    def _mask(self, site_id, since, until=None):
+        """(column views, boolean mask) of a site's events with since <= ts < until; None if the site is unknown."""
+        site = self.sites.codes.get(site_id)
+        if site is None:
+            return None, None
+        cols = {name: a[self.start:self.end] for name, a in self.cols.items()}
+        mask = (cols["site"] == site) & (cols["ts"] >= since)
+        if until is not None:
+            mask &= cols["ts"] < until
+        return cols, mask
+
+    def event_count(self, site_id, since, until=None, event_type=None):
+        """Weighted number of events (of `event_type`, if given)."""
+        with self._lock:
+            cols, mask = self._mask(site_id, since, until)
+            if cols is None:
+                return 0.0
+            if event_type is not None:
+                code = self.events.codes.get(event_type)
+                if code is None:
+                    return 0.0
+                mask &= cols["event"] == code
+            return float(cols["weight"][mask].sum(dtype=np.float64))
+
+    def active_visitors(self, site_id, since, until=None):
+        """Weighted number of distinct visitors."""
+        with self._lock:
+            cols, mask = self._mask(site_id, since, until)
+            if cols is None:
+                return 0.0
+            _, first = np.unique(cols["visitor"][mask], return_index=True)
+            return float(cols["weight"][mask][first].sum(dtype=np.float64))
+
+    def visitors_per_minute(self, site_id, start, minutes):
+        """Weighted distinct visitors in each of `minutes` minutes from epoch second `start`."""
+        with self._lock:
+            cols, mask = self._mask(site_id, start, start + minutes * 60)
+            if cols is None:
+                return np.zeros(minutes)
+            minute = (cols["ts"][mask] - np.uint32(start)).astype(np.int64) // 60
+            keys = minute * len(self.visitors) + cols["visitor"][mask]
+            keys, first = np.unique(keys, return_index=True)
+            return np.bincount(keys // len(self.visitors), weights=cols["weight"][mask][first], minlength=minutes)
+
+    def top_pages(self, site_id, since, k=50, view_event="page_view"):
+        """[{"page", "views", "users", "event_count"}] of the k pages with the most views."""
+        with self._lock:
+            cols, mask = self._mask(site_id, since)
+            if cols is None:
+                return []
+            mask &= cols["page"] != NO_PAGE
+            page = cols["page"][mask].astype(np.int64)
+            weight = cols["weight"][mask].astype(np.float64)
+            if not len(page):
+                return []
+            n = len(self.pages)
+            view = self.events.codes.get(view_event)
+            is_view = cols["event"][mask] == view if view is not None else np.zeros(len(page), bool)
+            views = np.bincount(page, weights=weight * is_view, minlength=n)
+            event_count = np.bincount(page, weights=weight, minlength=n)
+            keys, first = np.unique(page * len(self.visitors) + cols["visitor"][mask], return_index=True)
+            users = np.bincount(keys // len(self.visitors), weights=weight[first], minlength=n)
+
+            top = np.flatnonzero(views)
+            if len(top) > k:
+                top = top[np.argpartition(-views[top], k - 1)[:k]]
+            top = top[np.argsort(-views[top], kind="stable")]
+            return [
+                {"page": self.pages.values[p], "views": float(views[p]), "users": float(users[p]),
+                 "event_count": float(event_count[p])}
+                for p in top.tolist()
+            ]
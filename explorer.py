@@ -0,0 +1,131 @@
+"""Raw event explorer behind `/api/events`.
+
+Pages are keyset-paginated, newest first, over (site_id, created_at, id): a
+page is `WHERE site_id=? AND (created_at, id) < (cursor) ORDER BY created_at
+DESC, id DESC LIMIT n`, which MySQL answers by descending `idx_site_created`
+(InnoDB appends the primary key `id` to every secondary index) from the cursor
+position, so page 10,000 costs what page 1 does. An `event_type` filter walks
+`idx_site_type_created`, a visitor filter `idx_site_visitor_created` and a page
+filter `idx_site_path_created` the same way; the page is normalized with the
+site's allow-list (urlnorm.py) and matched on `page_path_id`. Rows written
+before normalization existed get `page_path_id` from `urlnorm.backfill_events()`
+(`POST /run/backfill_page_paths`); until it has run, the page filter misses
+them. The cursor is opaque to clients: the last row's (created_at, id) and a
+hash of the filters, base64url-encoded, so it cannot be replayed against a
+different query.
+
+Only hot events are browsable; days moved to the cold tier are not.
+"""
+import base64
+import hashlib
+from datetime import datetime
+
+import msgspec
+
+import dictionary
+import urlnorm
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# field -> columns; page_url/referrer are read with their dictionary ids and decoded after the page is read
+FIELDS = {
+    "id": ("id",),
+    "created_at": ("created_at",),
+    "event_type": ("event_type",),
+    "visitor_id": ("visitor_id",),
+    "session_id": ("session_id",),
+    "page_url": ("page_url", "page_url_id"),
+    "page_title": ("page_title",),
+    "referrer": ("referrer", "referrer_id"),
+    "clicked_url": ("clicked_url",),
+    "is_external": ("is_external",),
+    "scroll_percent": ("scroll_percent",),
+    "sample_weight": ("sample_weight",),
+}
+DEFAULT_FIELDS = ("id", "created_at", "event_type", "visitor_id", "session_id", "page_url", "page_title")
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def _filters_hash(site_id, filters):
+    return hashlib.md5(repr((site_id, sorted(filters.items()))).encode()).hexdigest()[:12]
+
+
+def encode_cursor(created_at, event_id, site_id, filters):
+    raw = msgspec.json.encode([created_at.isoformat(), event_id, _filters_hash(site_id, filters)])
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, site_id, filters):
+    try:
+        created_at, event_id, digest = msgspec.json.decode(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        created_at = datetime.fromisoformat(created_at)
+        event_id = int(event_id)
+    except Exception:
+        raise InvalidQuery("Invalid cursor")
+    if digest != _filters_hash(site_id, filters):
+        raise InvalidQuery("Cursor does not belong to this query")
+    return created_at, event_id
+
+
+def parse_fields(value):
+    if not value:
+        return list(DEFAULT_FIELDS)
+    fields = list(dict.fromkeys(f.strip() for f in value.split(",") if f.strip()))
+    unknown = [f for f in fields if f not in FIELDS]
+    if unknown:
+        raise InvalidQuery(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def page(cur, site_id, filters, fields, limit=DEFAULT_LIMIT, cursor=None):
+    """One page of events: ([{field: value}], next cursor or None).
+
+    `filters` may hold start / end (datetimes), event_type, page (URL, matched after normalization) and visitor_id.
+    """
+    clauses = ["site_id=%s"]
+    params = [site_id]
+    if filters.get("start"):
+        clauses.append("created_at >= %s")
+        params.append(filters["start"])
+    if filters.get("end"):
+        clauses.append("created_at < %s")
+        params.append(filters["end"])
+    if filters.get("event_type"):
+        clauses.append("event_type=%s")
+        params.append(filters["event_type"])
+    if filters.get("visitor_id"):
+        clauses.append("visitor_id=%s")
+        params.append(filters["visitor_id"])
+    if filters.get("page"):
+        cur.execute("SELECT url_query_params FROM sites WHERE site_id=%s", (site_id,))
+        row = cur.fetchone()
+        keep = urlnorm.site_params(row[0] if row else None)
+        page_id = dictionary.find(cur, dictionary.URLS, urlnorm.normalize(filters["page"], keep))
+        if page_id is None:
+            return [], None
+        clauses.append("page_path_id=%s")
+        params.append(page_id)
+    if cursor:
+        after_ts, after_id = decode_cursor(cursor, site_id, filters)
+        clauses.append("(created_at < %s OR (created_at = %s AND id < %s))")
+        params += [after_ts, after_ts, after_id]
+
+    columns = list(dict.fromkeys(["created_at", "id"] + [c for f in fields for c in FIELDS[f]]))
+    cur.execute(
+        f"SELECT {', '.join(columns)} FROM events WHERE {' AND '.join(clauses)} "
+        f"ORDER BY created_at DESC, id DESC LIMIT %s",
+        (*params, limit + 1)
+    )
+    rows = cur.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    rows = dictionary.fill_labels(cur, columns, rows)
+    index = {c: i for i, c in enumerate(columns)}
+    events = [{f: r[index[FIELDS[f][0]]] for f in fields} for r in rows]
+    next_cursor = encode_cursor(rows[-1][0], rows[-1][1], site_id, filters) if more else None
+    return events, next_cursor
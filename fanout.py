@@ -0,0 +1,94 @@
+"""Concurrent execution of a request's independent report queries.
+
+A handler hands `run()` a dict of tasks, each a function of a cursor, and gets
+back a dict of their results. Up to REPORT_QUERY_CONCURRENCY tasks of one
+request run at the same time, each worker on its own pooled read connection
+(one pool per route, connections routed by db.get_read_connection and
+recycled after the route's freshness bound), so page latency follows the
+slowest query rather than their sum. The whole fan-out shares one deadline,
+REPORT_QUERY_DEADLINE_SEC: it is pushed down to MySQL as max_execution_time
+(capped at the governor's per-statement limit, see governor.py) and the
+request fails with 504 once it has passed. A task that raises fails
+the request with its exception.
+
+Statements keep the handler's metrics call site (e.g. `realtime_metrics.timeseries`).
+"""
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+import pymysql
+from fastapi import HTTPException
+
+import db
+import governor
+import metrics
+
+CONCURRENCY = int(os.getenv("REPORT_QUERY_CONCURRENCY", "4"))
+DEADLINE_SEC = float(os.getenv("REPORT_QUERY_DEADLINE_SEC", "20"))
+POOL_SIZE = int(os.getenv("REPORT_QUERY_POOL_SIZE", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("REPORT_QUERY_THREADS", "32")), thread_name_prefix="report-query")
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(route, max_lag):
+    with _pools_lock:
+        pool = _pools.get(route)
+        if pool is None:
+            pool = _pools[route] = db.ConnectionPool(
+                POOL_SIZE, factory=lambda: db.get_read_connection(route, max_lag), max_age=min(max_lag, 60)
+            )
+        return pool
+
+
+def _worker(pool, tasks, results, deadline, call_site):
+    """Run tasks from the shared deque on one pooled connection until none are left."""
+    metrics.set_call_site(call_site)
+    try:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not tasks:
+            return
+        with pool.connection(timeout=remaining) as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("SET SESSION max_execution_time=%s", (max(1, int(min(remaining * 1000, governor.STATEMENT_MS))),))
+            except pymysql.err.MySQLError:
+                pass   # not MySQL (e.g. MariaDB): the deadline is still enforced by run()
+            while time.monotonic() < deadline:
+                try:
+                    name, task = tasks.popleft()
+                except IndexError:
+                    return
+                results[name] = task(cur)
+    finally:
+        metrics.set_call_site(None)
+
+
+def run(route, max_lag, tasks, concurrency=CONCURRENCY, deadline_sec=DEADLINE_SEC):
+    """Run {name: fn(cursor)} concurrently; returns {name: result}."""
+    call_site = sys._getframe(1).f_code.co_name
+    deadline = time.monotonic() + deadline_sec
+    pending = deque(tasks.items())
+    results = {}
+    pool = _pool(route, max_lag)
+    futures = [_executor.submit(_worker, pool, pending, results, deadline, call_site)
+               for _ in range(min(concurrency, len(tasks)))]
+    done, not_done = wait(futures, timeout=deadline_sec, return_when=FIRST_EXCEPTION)
+    for f in done:
+        error = f.exception()
+        if error is not None:
+            pending.clear()
+            if isinstance(error, pymysql.err.OperationalError) and error.args[0] == governor.ER_QUERY_TIMEOUT:
+                raise governor.killed(route)
+            if isinstance(error, TimeoutError):   # pool exhausted until the deadline
+                raise HTTPException(status_code=504, detail=governor.KILLED_DETAIL)
+            raise error
+    if not_done or len(results) < len(tasks):
+        pending.clear()
+        raise HTTPException(status_code=504, detail=governor.KILLED_DETAIL)
+    return results
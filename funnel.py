@@ -0,0 +1,129 @@
+"""Vectorized funnel analysis over named events (tracking-rule event names, page_view, ...).
+
+A funnel is an ordered list of event names, a conversion window and a date
+range. The events of those names in the range are loaded once as NumPy arrays
+(visitor code, event code, epoch seconds, sample weight) and sorted by
+(visitor, created_at). Each step is then one vectorized pass over all rows:
+
+- step 0: a visitor enters at their first step-0 event
+- step k: the first step-k event after the event that completed step k-1 (by
+  position in the visitor's stream, so repeated names and equal timestamps
+  work) and no later than entry + window
+
+so the cost is O(steps x events) array operations, with no self-join per step.
+Visitors count with their sample weight.
+"""
+import numpy as np
+import pyarrow as pa
+
+import cold_storage
+
+MAX_STEPS = 10
+
+_SELECT = "SELECT visitor_id, event_type, created_at, sample_weight FROM {table} WHERE {where}"
+
+
+def load(cur, site_id, steps, start, end):
+    """Fetch the events of the funnel's names as (visitors, events, times, weights) arrays,
+    sorted by (visitor, created_at); `events` holds the index of the name in `steps`' distinct names."""
+    names = list(dict.fromkeys(steps))
+    placeholders = ",".join(["%s"] * len(names))
+    clauses = ["site_id=%s", f"event_type IN ({placeholders})"]
+    params = [site_id, *names]
+    if cold_storage.reaches_cold(cur.connection, "events", start):
+        rows = cold_storage.hybrid_query(
+            cur, "events", site_id, clauses, params, start, end,
+            _SELECT, "SELECT * FROM part"
+        )
+    else:
+        cur.execute(
+            _SELECT.format(table="events", where=" AND ".join(clauses + ["created_at >= %s", "created_at < %s"])),
+            (*params, start, end)
+        )
+        rows = cur.fetchall()
+    return to_arrays(rows, names)
+
+
+def _codes(column):
+    """Dense integer codes and the distinct values of a column (pyarrow does this in C)."""
+    encoded = pa.array(column, pa.string()).dictionary_encode()
+    return encoded.indices.to_numpy(zero_copy_only=False).astype(np.int64), encoded.dictionary.to_pylist()
+
+
+def to_arrays(rows, names):
+    """(visitors, events, times, weights) arrays from (visitor_id, event_type, created_at, sample_weight) rows."""
+    if not rows:
+        return tuple(np.empty(0, dtype) for dtype in (np.int64, np.int16, np.int64, np.float64))
+    visitors, _ = _codes([r[0] for r in rows])
+    event_codes, values = _codes([r[1] for r in rows])
+    events = np.array([names.index(v) for v in values], dtype=np.int16)[event_codes]
+    times = pa.array([r[2] for r in rows], pa.timestamp("s")).to_numpy(zero_copy_only=False).astype(np.int64)
+    weights = pa.array([r[3] for r in rows], pa.float64()).fill_null(1).to_numpy(zero_copy_only=False)
+    order = np.lexsort((times, visitors))
+    return visitors[order], events[order], times[order], weights[order]
+
+
+def _first_per_visitor(visitors, mask):
+    """Row indices of the first masked row of each visitor (rows sorted by visitor)."""
+    idx = np.flatnonzero(mask)
+    if not len(idx):
+        return idx
+    v = visitors[idx]
+    keep = np.empty(len(idx), dtype=bool)
+    keep[0] = True
+    keep[1:] = v[1:] != v[:-1]
+    return idx[keep]
+
+
+def compute(steps, visitors, events, times, weights, window_sec):
+    """Per-step funnel figures for sorted event arrays (see load()).
+
+    Returns [{"name", "visitors", "conversion_rate", "step_rate", "drop_off",
+    "median_seconds"}], where conversion_rate is relative to step 0, step_rate to
+    the previous step and median_seconds is the median time from the previous step.
+    """
+    names = list(dict.fromkeys(steps))
+    n_visitors = int(visitors.max()) + 1 if len(visitors) else 0
+
+    # per visitor: still in the funnel, row that completed the latest step, entry time and weight
+    alive = np.zeros(n_visitors, dtype=bool)
+    position = np.zeros(n_visitors, dtype=np.int64)
+    entered = np.zeros(n_visitors, dtype=np.int64)
+    weight = np.zeros(n_visitors, dtype=np.float64)
+    rows = np.arange(len(visitors))
+
+    result = []
+    for k, name in enumerate(steps):
+        is_step = events == names.index(name)
+        if k == 0:
+            first = _first_per_visitor(visitors, is_step)
+            who = visitors[first]
+            entered[who] = times[first]
+            weight[who] = weights[first]
+            elapsed = None
+        else:
+            candidate = (is_step & alive[visitors] & (rows > position[visitors])
+                         & (times <= entered[visitors] + window_sec))
+            first = _first_per_visitor(visitors, candidate)
+            who = visitors[first]
+            elapsed = times[first] - times[position[who]]
+        alive[:] = False
+        alive[who] = True
+        position[who] = first
+
+        count = float(weight[who].sum())
+        top = result[0]["visitors"] if result else count
+        before = result[-1]["visitors"] if result else count
+        result.append({
+            "name": name,
+            "visitors": int(round(count)),
+            "conversion_rate": round(count * 100.0 / top, 1) if top else 0.0,
+            "step_rate": round(count * 100.0 / before, 1) if before else 0.0,
+            "drop_off": int(round(before - count)),
+            "median_seconds": int(np.median(elapsed)) if elapsed is not None and len(elapsed) else None,
+        })
+    return result
+
+
+def run(cur, site_id, steps, start, end, window_sec):
+    return compute(steps, *load(cur, site_id, steps, start, end), window_sec)
@@ -0,0 +1,133 @@
+"""Zoom-aware clustering of visitor locations for the demographics map.
+
+Locations are bucketed on the Web Mercator tile grid the map itself uses: at
+map zoom z a cell is one tile of zoom z + CELL_BITS, i.e. a 2^CELL_BITS x
+2^CELL_BITS grid per 256px map tile (32px cells by default). `geo_cells`
+holds, per site, zoom level 0..GEO_MAX_ZOOM and cell, the number of located
+visitors and the sum of their coordinates, so a cluster is drawn at the
+centroid of its visitors rather than at the cell centre.
+
+`update()` folds `ip_geolocation` rows past an id watermark (`ip_geolocation`
+row in `watermark`) into every zoom level with additive upserts, in the same
+transaction that advances the watermark. `clusters()` reads the cells of one
+zoom level inside a bounding box, so a payload is bounded by the size of the
+viewport (about 1000 cells for a full-HD map), whatever the number of visitors.
+
+Each `ip_geolocation` row is one IP address with the visitor it was first seen
+with; counts are of those rows, so a visitor seen from several IP addresses
+counts once per distinct location.
+"""
+import math
+import os
+
+MAX_ZOOM = int(os.getenv("GEO_MAX_ZOOM", "14"))
+CELL_BITS = 3
+BATCH_ROWS = int(os.getenv("GEO_BATCH_ROWS", "5000"))
+# rows younger than this may still belong to open transactions with earlier ids
+SETTLE_SECONDS = int(os.getenv("ETL_SETTLE_SECONDS", "5"))
+
+# Web Mercator is cut off at +-85.05112878 degrees latitude
+MAX_LAT = 85.05112878
+WATERMARK = "ip_geolocation"
+
+_UPSERT = """
+INSERT INTO geo_cells (site_id, zoom, cell_x, cell_y, visitors, lat_sum, lon_sum)
+VALUES (%s,%s,%s,%s,%s,%s,%s)
+ON DUPLICATE KEY UPDATE visitors = visitors + VALUES(visitors),
+    lat_sum = lat_sum + VALUES(lat_sum), lon_sum = lon_sum + VALUES(lon_sum)
+"""
+
+
+def _cell(lat, lon, zoom):
+    """(x, y) of the cell containing a point at map zoom `zoom`."""
+    n = 1 << (zoom + CELL_BITS)
+    lat = math.radians(max(-MAX_LAT, min(MAX_LAT, lat)))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def cells(rows):
+    """{(site_id, zoom, x, y): [visitors, lat_sum, lon_sum]} for (site_id, lat, lon) rows."""
+    acc = {}
+    for site_id, lat, lon in rows:
+        if site_id is None or lat is None or lon is None:
+            continue
+        lat, lon = float(lat), float(lon)
+        for zoom in range(MAX_ZOOM + 1):
+            x, y = _cell(lat, lon, zoom)
+            c = acc.get((site_id, zoom, x, y))
+            if c is None:
+                acc[(site_id, zoom, x, y)] = [1, lat, lon]
+            else:
+                c[0] += 1
+                c[1] += lat
+                c[2] += lon
+    return acc
+
+
+def update(conn, batch_rows=BATCH_ROWS, max_batches=None):
+    """Fold new `ip_geolocation` rows into `geo_cells`; returns the number of rows read."""
+    cur = conn.cursor()
+    processed = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        cur.execute("INSERT IGNORE INTO watermark (tbl_name, last_id) VALUES (%s, 0)", (WATERMARK,))
+        cur.execute("SELECT last_id FROM watermark WHERE tbl_name=%s FOR UPDATE", (WATERMARK,))
+        last_id = cur.fetchone()[0] or 0
+        cur.execute(
+            """
+            SELECT id, site_id, lat, lon FROM ip_geolocation
+            WHERE id > %s AND created_at < NOW() - INTERVAL %s SECOND
+            ORDER BY id LIMIT %s
+            """,
+            (last_id, SETTLE_SECONDS, batch_rows)
+        )
+        rows = cur.fetchall()
+        if not rows:
+            conn.commit()
+            break
+        acc = cells(r[1:] for r in rows)
+        if acc:
+            cur.executemany(_UPSERT, [(*key, *value) for key, value in acc.items()])
+        cur.execute("UPDATE watermark SET last_id=%s WHERE tbl_name=%s", (rows[-1][0], WATERMARK))
+        conn.commit()
+        processed += len(rows)
+        batches += 1
+        if len(rows) < batch_rows:
+            break
+    return processed
+
+
+def _x_ranges(west, east, n):
+    """Inclusive cell x ranges covering the longitudes west..east (which may cross the antimeridian)."""
+    if east - west >= 360:
+        return [(0, n - 1)]
+    west = (west + 180.0) % 360.0 - 180.0
+    east = (east + 180.0) % 360.0 - 180.0
+    x0 = int((west + 180.0) / 360.0 * n)
+    x1 = min(int((east + 180.0) / 360.0 * n), n - 1)
+    if west <= east:
+        return [(x0, x1)]
+    return [(x0, n - 1), (0, x1)]
+
+
+def clusters(cur, site_id, zoom, west, south, east, north):
+    """[{"lat", "lon", "visitors"}] of the non-empty cells at `zoom` inside the bounding box."""
+    zoom = max(0, min(int(zoom), MAX_ZOOM))
+    n = 1 << (zoom + CELL_BITS)
+    _, y0 = _cell(north, 0.0, zoom)
+    _, y1 = _cell(south, 0.0, zoom)
+    ranges = _x_ranges(west, east, n)
+    where = " OR ".join(["cell_x BETWEEN %s AND %s"] * len(ranges))
+    cur.execute(
+        f"""
+        SELECT visitors, lat_sum, lon_sum FROM geo_cells
+        WHERE site_id=%s AND zoom=%s AND ({where}) AND cell_y BETWEEN %s AND %s AND visitors > 0
+        """,
+        (site_id, zoom, *[x for r in ranges for x in r], y0, y1)
+    )
+    return [
+        {"lat": round(lat_sum / visitors, 5), "lon": round(lon_sum / visitors, 5), "visitors": int(visitors)}
+        for visitors, lat_sum, lon_sum in cur.fetchall()
+    ]
@@ -0,0 +1,137 @@
+"""Query governor for the dashboard's report endpoints.
+
+A report route is wrapped in `@governed(route)`; once the handler knows which
+site it reports on it calls `enter(cur, site_id)`. Together they enforce
+
+1. at most REPORT_USER_CONCURRENCY reports per user and
+   REPORT_SITE_CONCURRENCY per site running at once. Excess requests wait for
+   a slot, at most REPORT_QUEUE_WAIT_SEC in total and at most
+   REPORT_QUEUE_DEPTH waiting per user or site. Refusal -> 429.
+2. a server-side time limit on every SELECT of the report:
+   `max_execution_time` = REPORT_STATEMENT_MS on the handler's connection
+   (fanout.py applies the same cap to its workers). MySQL stops a statement
+   that runs longer (error 3024) -> 504.
+
+Both answers ask the user to narrow the date range, which is what makes a
+report cheaper. Limits apply per worker process. Waits, refusals and killed
+statements are counted in `report_queries_queued_total`,
+`report_queries_rejected_total` and `report_queries_killed_total`.
+"""
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+
+import pymysql
+from fastapi import HTTPException
+
+import metrics
+
+USER_CONCURRENCY = int(os.getenv("REPORT_USER_CONCURRENCY", "2"))
+SITE_CONCURRENCY = int(os.getenv("REPORT_SITE_CONCURRENCY", "4"))
+QUEUE_WAIT_SEC = float(os.getenv("REPORT_QUEUE_WAIT_SEC", "5"))
+QUEUE_DEPTH = int(os.getenv("REPORT_QUEUE_DEPTH", "4"))
+STATEMENT_MS = int(os.getenv("REPORT_STATEMENT_MS", "15000"))
+
+# MySQL's "Query execution was interrupted, maximum statement execution time exceeded"
+ER_QUERY_TIMEOUT = 3024
+
+BUSY_DETAIL = "Too many reports are running for your account or this site. Try again shortly, or narrow your date range."
+KILLED_DETAIL = "This report took too long to compute. Narrow your date range and try again."
+
+_cond = threading.Condition()
+_active = defaultdict(int)    # ("user", id) / ("site", id) -> running reports
+_waiting = defaultdict(int)
+_context = threading.local()
+
+
+class _Context:
+    __slots__ = ("route", "deadline", "held")
+
+    def __init__(self, route):
+        self.route = route
+        self.deadline = time.monotonic() + QUEUE_WAIT_SEC
+        self.held = []
+
+
+def _acquire(ctx, key, limit):
+    with _cond:
+        if _active[key] >= limit:
+            if _waiting[key] >= QUEUE_DEPTH:
+                metrics.REPORT_QUERIES_REJECTED.labels(ctx.route, key[0], "queue_full").inc()
+                raise HTTPException(status_code=429, detail=BUSY_DETAIL, headers={"Retry-After": "5"})
+            metrics.REPORT_QUERIES_QUEUED.labels(ctx.route, key[0]).inc()
+            start = time.monotonic()
+            _waiting[key] += 1
+            try:
+                while _active[key] >= limit:
+                    remaining = ctx.deadline - time.monotonic()
+                    if remaining <= 0:
+                        metrics.REPORT_QUERIES_REJECTED.labels(ctx.route, key[0], "wait_timeout").inc()
+                        raise HTTPException(status_code=429, detail=BUSY_DETAIL, headers={"Retry-After": "5"})
+                    _cond.wait(remaining)
+            finally:
+                _waiting[key] -= 1
+                if not _waiting[key]:
+                    del _waiting[key]
+                metrics.REPORT_QUEUE_WAIT_SECONDS.labels(ctx.route).observe(time.monotonic() - start)
+        _active[key] += 1
+        ctx.held.append(key)
+
+
+def _release(ctx):
+    with _cond:
+        for key in ctx.held:
+            _active[key] -= 1
+            if not _active[key]:
+                del _active[key]
+        ctx.held.clear()
+        _cond.notify_all()
+
+
+def statement_limit(conn, ms=STATEMENT_MS):
+    """Cap the execution time of SELECTs on `conn` (no-op where the server lacks max_execution_time)."""
+    try:
+        conn.cursor().execute("SET SESSION max_execution_time=%s", (max(1, int(ms)),))
+    except pymysql.err.MySQLError:
+        pass
+
+
+def killed(route):
+    """Count a statement stopped by max_execution_time and build the response for it."""
+    metrics.REPORT_QUERIES_KILLED.labels(route).inc()
+    return HTTPException(status_code=504, detail=KILLED_DETAIL)
+
+
+def enter(cur, site_id):
+    """Take the site's slot for the running report and limit its statements."""
+    ctx = getattr(_context, "current", None)
+    if ctx is None:
+        raise RuntimeError("governor.enter() outside a @governed route")
+    if site_id:
+        _acquire(ctx, ("site", site_id), SITE_CONCURRENCY)
+    statement_limit(cur.connection)
+
+
+def governed(route):
+    """Decorate a sync report handler: per-user slot, and 504 for statements MySQL stopped."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(request, *args, **kwargs):
+            ctx = _Context(route)
+            _context.current = ctx
+            try:
+                user_id = request.session.get("user_id")
+                if user_id:
+                    _acquire(ctx, ("user", user_id), USER_CONCURRENCY)
+                return handler(request, *args, **kwargs)
+            except pymysql.err.OperationalError as e:
+                if e.args and e.args[0] == ER_QUERY_TIMEOUT:
+                    raise killed(route)
+                raise
+            finally:
+                _release(ctx)
+                _context.current = None
+        return wrapper
+    return decorate
@@ -0,0 +1,531 @@
+"""Ingest tier: `/collect`, `/rules` and `track.js`.
+
+Runs either inside the dashboard app (APP_ROLE=all, the default) or on its own
+as a minimal ASGI app without session or OAuth middleware:
+
+    python serve.py --role ingest --workers 8
+    gunicorn -w 8 -k uvicorn.workers.UvicornWorker ingest:app
+
+Accepted events are queued in memory and written by batch writers. Work is
+sharded by site_id across INGEST_WRITER_SHARDS queues, so one site's events are
+written in order by one writer, and each writer flushes up to INGEST_BATCH_SIZE
+events per transaction through the tier's own connection pool. A batch that
+cannot be written is spooled to INGEST_SPOOL_DIR and replayed later, by any
+worker process. Admission control (admission.py) sheds load per site before
+anything is queued, and high-volume sites are sampled per visitor
+(sampling.py); kept events carry their `sample_weight`. Payloads are decoded
+and validated by codec.py, and events whose client `eventId` was already seen
+are dropped (dedup.py). The writers also keep the `sessions` table up to date
+(sessions.py) and the scroll-depth histograms (scroll_depth.py), store the
+per-session browser attributes once per session (session_headers.py), store
+URLs and user agents as dictionary ids (dictionary.py), normalize page URLs and
+extract UTM campaigns (urlnorm.py) and feed the realtime top-pages sketches
+(sketches.py).
+"""
+import asyncio
+import json
+import os
+import time
+import zlib
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, Response
+
+import admission
+import codec
+import dedup
+import dictionary
+import etl
+import metrics
+import sampling
+import scroll_depth
+import session_headers
+import sessions
+import sketches
+import urlnorm
+from db import ConnectionPool
+
+load_dotenv()
+
+WRITER_SHARDS = int(os.getenv("INGEST_WRITER_SHARDS", "4"))
+BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "200"))
+QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+DB_POOL_SIZE = int(os.getenv("INGEST_DB_POOL_SIZE", str(WRITER_SHARDS + 2)))
+SITE_CACHE_TTL = int(os.getenv("INGEST_SITE_CACHE_TTL", "60"))
+RULES_CACHE_TTL = int(os.getenv("INGEST_RULES_CACHE_TTL", "30"))
+SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", "spool")
+SPOOL_REPLAY_SEC = int(os.getenv("INGEST_SPOOL_REPLAY_SEC", "30"))
+# events that waited longer than this to be written are stamped with the write time (see _stamp)
+MAX_QUEUED_SEC = min(float(os.getenv("INGEST_MAX_QUEUED_SEC", "1")), etl.ETL_SETTLE_SECONDS / 2)
+
+# queued events are dicts with these keys
+EVENT_COLUMNS = (
+    "site_id", "visitor_id", "event_type",
+    "page_url", "page_path", "referrer", "user_agent", "ip_address",
+    "language", "platform", "screen_size", "timezone",
+    "clicked_url", "is_external", "page_title", "scroll_percent",
+    "sample_weight", "event_id", "session_id", "created_at",
+    "utm_source", "utm_medium", "utm_campaign",
+)
+# the events insert stores page_url/page_path/referrer/user_agent as dictionary ids
+_STORED_COLUMNS = tuple(dictionary.ENCODED_COLUMNS[c][0] if c in dictionary.ENCODED_COLUMNS else c for c in EVENT_COLUMNS)
+# stored on the session's row instead of the event's (session_headers.py)
+_SESSION_FIELDS = frozenset(session_headers.FIELDS)
+# duplicates are filtered out first (_new_events); one that races in fails the batch, which is spooled
+_INSERT_EVENTS = (
+    f"INSERT INTO events ({', '.join(_STORED_COLUMNS)}) "
+    f"VALUES ({','.join(['%s'] * len(_STORED_COLUMNS))})"
+)
+
+router = APIRouter()
+
+_pool = None
+_queues = []
+_tasks = []
+
+
+# ---------------- HELPERS ----------------
+def get_client_ip(request: Request):
+    """
+    Get the client IP address, handling X-Forwarded-For header
+    if the app is behind a proxy (like Azure App Service).
+    """
+    x_forwarded_for = request.headers.get("X-Forwarded-For")
+    if x_forwarded_for:
+        # The first IP in the list is the original client
+        return x_forwarded_for.split(",")[0].strip()
+    # Fallback to direct connection IP
+    return request.client.host
+
+
+def shard_for(site_id):
+    return zlib.crc32(site_id.encode()) % WRITER_SHARDS
+
+
+class _SiteCache:
+    """Known sites and their ingest settings, refreshed every SITE_CACHE_TTL seconds
+    (or on a miss, at most every few seconds)."""
+
+    def __init__(self):
+        self.sites = {}
+        self.loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _load(self):
+        with _pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT site_id, domain, ingest_rate_limit, sample_rate, sampling_target_eps, url_query_params FROM sites")
+            return {
+                r[0]: {"domain": r[1], "ingest_rate_limit": r[2], "sample_rate": r[3], "sampling_target_eps": r[4],
+                       "url_query_params": r[5]}
+                for r in cur.fetchall()
+            }
+
+    async def get(self, site_id):
+        """Settings for a known site, or None if the site does not exist."""
+        age = time.monotonic() - self.loaded_at
+        if site_id in self.sites and age < SITE_CACHE_TTL:
+            return self.sites[site_id]
+        if age < 5 and self.loaded_at:
+            return self.sites.get(site_id)
+        async with self._lock:
+            if time.monotonic() - self.loaded_at >= 5 or not self.loaded_at:
+                self.sites = await asyncio.to_thread(self._load)
+                self.loaded_at = time.monotonic()
+        return self.sites.get(site_id)
+
+
+_site_cache = _SiteCache()
+_seen_events = dedup.RotatingBloomFilter()
+_rules_cache = {}   # known site_id -> (loaded at, encoded body)
+_NO_RULES = codec.encode({"rules": []})
+
+
+# ---------------- BATCH WRITERS ----------------
+def _new_events(cur, batch):
+    """The events of `batch` that are not stored yet, dropping repeats of a (site_id, event_id).
+
+    A plain consistent read, so writers of the same site take no gap locks on
+    the keys that do not exist yet. If another writer commits one of them
+    before this batch inserts it, the unique key fails the insert and the batch
+    is spooled; on replay the key is found here and the event dropped. The
+    events it returns are therefore exactly the rows the insert adds.
+    """
+    keys = list({(e["site_id"], e["event_id"]) for e in batch if e["event_id"]})
+    stored = set()
+    if keys:
+        cur.execute(
+            f"SELECT site_id, event_id FROM events WHERE (site_id, event_id) IN ({','.join(['(%s,%s)'] * len(keys))})",
+            tuple(v for key in keys for v in key)
+        )
+        stored = {(r[0], r[1]) for r in cur.fetchall()}
+    new = []
+    for e in batch:
+        if e["event_id"]:
+            key = (e["site_id"], e["event_id"])
+            if key in stored:
+                continue
+            stored.add(key)
+        new.append(e)
+    return new
+
+
+def _stamp(batch):
+    """Move created_at of events queued more than MAX_QUEUED_SEC ago up to that age.
+
+    The pipeline (etl.py) takes rows older than ETL_SETTLE_SECONDS as settled
+    and moves its watermark past them, so a row written later than that after
+    its created_at (writers behind, a backlog in the queue) would never be
+    processed. Events written promptly keep their arrival time.
+    """
+    floor = datetime.utcnow() - timedelta(seconds=MAX_QUEUED_SEC)
+    for e in batch:
+        if e["created_at"] < floor:
+            e["created_at"] = floor
+
+
+def _write_batch(batch, stamp=False):
+    """Write a batch in one transaction; `stamp` applies _stamp() first (queued, not replayed, events)."""
+    # normalized page URL (the page reports group on) and UTM campaign of every event
+    urlnorm.annotate(batch, _site_cache.sites)
+    with _pool.connection() as conn:
+        cur = conn.cursor()
+        # session headers not stored yet; events with a session keep theirs on the sessions row only
+        headers = session_headers.new_headers(conn, batch)
+
+        # intern strings first: dictionary rows commit on their own, outside the batch transaction
+        urls = dictionary.urls.ids(conn, [e[c] for e in batch for c in ("page_url", "page_path", "referrer")])
+        user_agents = dictionary.user_agents.ids(
+            conn, [e["user_agent"] for e in batch if not e["session_id"]] + [h[0] for h in headers.values()]
+        )
+        encoded = {"page_url": urls, "page_path": urls, "referrer": urls, "user_agent": user_agents}
+
+        conn.begin()
+        try:
+            if stamp:
+                _stamp(batch)
+            # duplicates the insert would skip must not count in sessions, histograms or sketches
+            batch = _new_events(cur, batch)
+            if not batch:
+                conn.commit()
+                return
+            sessions_written = {(e["site_id"], e["session_id"]) for e in batch if e["session_id"]}
+            headers = {key: header for key, header in headers.items() if key in sessions_written}
+            rows = [
+                tuple(None if e["session_id"] and c in _SESSION_FIELDS
+                      else encoded[c].get(e[c]) if c in encoded else e[c] for c in EVENT_COLUMNS)
+                for e in batch
+            ]
+            # one upsert per visitor per batch, keeping the earliest first_seen and newest last_seen
+            visitors = {}
+            for e in batch:
+                key = (e["visitor_id"], e["site_id"])
+                first, last = visitors.get(key, (e["created_at"], e["created_at"]))
+                visitors[key] = (min(first, e["created_at"]), max(last, e["created_at"]))
+
+            cur.executemany(
+                """
+                INSERT INTO visitors (visitor_id, site_id, first_seen, last_seen)
+                VALUES (%s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE first_seen = LEAST(first_seen, VALUES(first_seen)),
+                    last_seen = GREATEST(last_seen, VALUES(last_seen))
+                """,
+                [(vid, sid, first, last) for (vid, sid), (first, last) in visitors.items()]
+            )
+            cur.executemany(_INSERT_EVENTS, rows)
+            sessions.upsert(cur, batch, {sid: s["domain"] for sid, s in _site_cache.sites.items()}, urls,
+                            headers, user_agents)
+            scroll_depth.upsert(cur, batch, urls)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    session_headers.cache.put(headers)
+    sketches.record(batch, urls)
+    scroll_depth.record(batch)
+
+
+def _flush(batch):
+    start = time.perf_counter()
+    try:
+        _write_batch(batch, stamp=True)
+    except Exception as e:
+        print(f"Ingest batch of {len(batch)} events failed, spooling:", e)
+        _spool(batch)
+    finally:
+        metrics.INGEST_FLUSH_SECONDS.observe(time.perf_counter() - start)
+        metrics.INGEST_BATCH_EVENTS.observe(len(batch))
+
+
+async def _in_thread(fn, *args):
+    """Run fn in a thread. If the caller is cancelled meanwhile, wait for fn to finish before
+    re-raising, so shutdown never closes the pool under a write in progress."""
+    task = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        await task
+        raise
+
+
+async def _writer(queue):
+    """Drain one shard: wait for an event, give the batch FLUSH_MS to fill, write it."""
+    batch = []
+    try:
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            if len(batch) < BATCH_SIZE:
+                await asyncio.sleep(FLUSH_MS / 1000)
+                while len(batch) < BATCH_SIZE and not queue.empty():
+                    batch.append(queue.get_nowait())
+            flushing, batch = batch, []
+            metrics.INGEST_QUEUE_DEPTH.dec(len(flushing))
+            await _in_thread(_flush, flushing)
+    except asyncio.CancelledError:
+        # shutdown: write the batch still filling and whatever is queued
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+        if batch:
+            metrics.INGEST_QUEUE_DEPTH.dec(len(batch))
+            await asyncio.to_thread(_flush, batch)
+        raise
+
+
+# ---------------- SPOOL ----------------
+def _spool(batch):
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    path = os.path.join(SPOOL_DIR, f"{os.getpid()}-{time.time_ns()}.jsonl")
+    with open(path + ".tmp", "w") as f:
+        for e in batch:
+            f.write(json.dumps({**e, "created_at": e["created_at"].isoformat()}) + "\n")
+    os.replace(path + ".tmp", path)
+    metrics.INGEST_SPOOLED_EVENTS.inc(len(batch))
+
+
+def _rewind_watermarks(batch):
+    """Replayed events keep their created_at, which the sites' ETL watermarks may have passed:
+    move each site's back to its oldest replayed event so the pipeline picks them up."""
+    oldest = {}
+    for e in batch:
+        oldest[e["site_id"]] = min(e["created_at"], oldest.get(e["site_id"], e["created_at"]))
+    with _pool.connection() as conn:
+        cur = conn.cursor()
+        for site_id, created_at in oldest.items():
+            etl.rewind(cur, site_id, created_at)
+        conn.commit()
+
+
+def _replay_spool():
+    """Retry spooled batches. Files are claimed by rename so only one worker replays each."""
+    if not os.path.isdir(SPOOL_DIR):
+        return
+    for name in sorted(os.listdir(SPOOL_DIR)):
+        if not name.endswith(".jsonl"):
+            continue
+        path = os.path.join(SPOOL_DIR, name)
+        claimed = f"{path}.replaying-{os.getpid()}"
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            continue  # another worker got it
+        try:
+            with open(claimed) as f:
+                batch = [json.loads(line) for line in f if line.strip()]
+            for e in batch:
+                e["created_at"] = datetime.fromisoformat(e["created_at"])
+                e.setdefault("sample_weight", 1.0)
+                e.setdefault("event_id", None)
+                e.setdefault("session_id", None)
+            _write_batch(batch)
+            _rewind_watermarks(batch)
+            os.remove(claimed)
+            print(f"Replayed {len(batch)} spooled events from {name}")
+        except Exception as e:
+            os.rename(claimed, path)
+            print(f"Spool replay of {name} failed, will retry:", e)
+            return
+
+
+async def _spool_replayer():
+    while True:
+        await asyncio.sleep(SPOOL_REPLAY_SEC)
+        try:
+            await _in_thread(_replay_spool)
+        except Exception as e:
+            print("Spool replay error:", e)
+
+
+def _flush_sketches():
+    with _pool.connection() as conn:
+        sketches.flush(conn)
+        scroll_depth.flush(conn)
+
+
+async def _sketch_flusher():
+    while True:
+        await asyncio.sleep(sketches.FLUSH_SEC)
+        try:
+            await _in_thread(_flush_sketches)
+        except Exception as e:
+            print("Sketch flush error:", e)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Start the writer pool, spool replayer and sketch flusher; flush queues on shutdown."""
+    global _pool, _queues, _tasks
+    _pool = ConnectionPool(DB_POOL_SIZE)
+    _queues = [asyncio.Queue(maxsize=QUEUE_SIZE) for _ in range(WRITER_SHARDS)]
+    _tasks = [asyncio.create_task(_writer(q)) for q in _queues]
+    _tasks.append(asyncio.create_task(_spool_replayer()))
+    _tasks.append(asyncio.create_task(_sketch_flusher()))
+    try:
+        yield
+    finally:
+        for t in _tasks:
+            t.cancel()
+        # the tasks finish their writes in progress and the queued events before the pool closes
+        await asyncio.gather(*_tasks, return_exceptions=True)
+        _pool.close()
+
+
+#---------------- Event Collection ----------------
+@router.post("/collect")
+async def collect(request: Request):
+    data = codec.decode_event(await codec.read_body(request))
+
+    site_id = data.siteId
+    visitor_id = data.visitorId
+
+    # validate site
+    site = await _site_cache.get(site_id)
+    if site is None:
+        raise HTTPException(400, "Invalid site_id")
+
+    # sampling: keep or drop the whole visitor; sampled-out events are acknowledged, not retried
+    weight = sampling.sample(site_id, visitor_id, site)
+    if weight is None:
+        return {"status": "ok"}
+
+    # duplicate of an event already accepted by this worker (beacon retry, handler firing twice)
+    dedup_key = f"{site_id}:{data.eventId}" if data.eventId else None
+    if dedup_key and dedup_key in _seen_events:
+        metrics.INGEST_DUPLICATE_EVENTS.labels(site_id).inc()
+        return {"status": "duplicate"}
+
+    # admission control: per-site token bucket and queue pressure, shedding low-priority events first
+    event_type = data.eventType
+    queue = _queues[shard_for(site_id)]
+    try:
+        admission.admit(site_id, event_type, queue, site["ingest_rate_limit"])
+    except admission.Rejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+
+    event = {
+        "site_id": site_id,
+        "visitor_id": visitor_id,
+        "event_type": event_type,
+        "page_url": data.pageUrl,
+        "referrer": data.referrer,
+        "user_agent": data.userAgent,
+        "ip_address": get_client_ip(request),
+        "language": data.language,
+        "platform": data.platform,
+        "screen_size": data.screenSize,
+        "timezone": data.timezone,
+        "clicked_url": data.clicked_url,
+        "is_external": data.is_external,
+        "page_title": data.pageTitle,
+        "scroll_percent": data.scrollPercent,
+        "sample_weight": weight,
+        "event_id": data.eventId,
+        "session_id": data.sessionId,
+        "created_at": datetime.utcnow(),
+    }
+
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        metrics.INGEST_SHED_EVENTS.labels(site_id, "queue_full", admission.priority_of(event_type)).inc()
+        raise HTTPException(status_code=503, detail="queue_full", headers={"Retry-After": "1"})
+    if dedup_key:
+        _seen_events.add(dedup_key)
+    metrics.INGEST_QUEUE_DEPTH.inc()
+    metrics.INGEST_EVENTS.labels(site_id).inc()
+
+    return {"status": "ok"}
+
+
+# ---------------- Tracking rules API ----------------
+def _load_rules(site_id):
+    with _pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, selector, event_type, event_name FROM tracking_rules WHERE site_id=%s AND active=1", (site_id,))
+        rows = cur.fetchall()
+    rules = []
+    for r in rows:
+        rules.append({"id": r[0], "selector": r[1], "event_type": r[2], "event_name": r[3]})
+    return rules
+
+
+@router.get("/rules")
+async def get_rules(request: Request):
+    """Public endpoint used by track.js to fetch active rules for a site.
+
+    The encoded response body is cached for RULES_CACHE_TTL seconds. Only known
+    sites are looked up and cached, so the cache holds at most one entry per site.
+    """
+    site_id = request.query_params.get("site_id")
+    if not site_id:
+        raise HTTPException(status_code=400, detail="site_id required")
+    if await _site_cache.get(site_id) is None:
+        _rules_cache.pop(site_id, None)
+        return Response(_NO_RULES, media_type="application/json")
+
+    cached = _rules_cache.get(site_id)
+    if cached and time.monotonic() - cached[0] < RULES_CACHE_TTL:
+        return Response(cached[1], media_type="application/json")
+
+    rules = await asyncio.to_thread(_load_rules, site_id)
+    body = codec.encode({"rules": rules})
+    _rules_cache[site_id] = (time.monotonic(), body)
+    return Response(body, media_type="application/json")
+
+
+#---------------- Serve track.js ----------------
+@router.get("/track.js")
+def track_js():
+    return FileResponse(
+        path="static/track.js",
+        media_type="application/javascript",
+        headers={
+            "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
+            "Pragma": "no-cache",
+            "Expires": "0"
+        }
+    )
+
+
+# ---------------- Standalone ingest app ----------------
+app = FastAPI(title="Analytics Ingest", lifespan=lifespan)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["*"]
+)
+app.add_middleware(metrics.MetricsMiddleware)
+app.include_router(router)
+app.include_router(metrics.router)
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
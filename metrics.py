@@ -0,0 +1,228 @@
+"""Prometheus metrics and the low-overhead hooks that feed them.
+
+- MetricsMiddleware: per-route latency histogram and status counts (raw ASGI, no
+  BaseHTTPMiddleware overhead)
+- InstrumentedCursor: pymysql cursor that times every statement and counts rows,
+  labelled by call site, and hands slow ones to slow_queries. The call site is
+  the calling function's name, refined by an optional leading SQL comment tag,
+  e.g. `/* timeseries */ SELECT ...` inside realtime_metrics() is reported as
+  `realtime_metrics.timeseries` (also when fanout.py runs it on another thread).
+- InstrumentedTemplates: Jinja2Templates that times template rendering
+- DB_CONNECT_SECONDS / DB_READ_ROUTES / INGEST_EVENTS / REPORT_QUERIES_* / SCHEDULER_JOB_* are updated
+  directly by app code
+
+When running several worker processes set PROMETHEUS_MULTIPROC_DIR so /metrics
+aggregates all of them.
+"""
+import os
+import sys
+import threading
+import time
+
+import pymysql.cursors
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+from fastapi.templating import Jinja2Templates
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+                               REGISTRY, generate_latest, multiprocess)
+
+import slow_queries
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ["method", "route"], buckets=_LATENCY_BUCKETS
+)
+HTTP_RESPONSES = Counter("http_responses_total", "HTTP responses by route and status", ["method", "route", "status"])
+
+SQL_SECONDS = Histogram(
+    "sql_query_duration_seconds", "SQL statement latency by call site", ["call_site"], buckets=_LATENCY_BUCKETS
+)
+SQL_ROWS = Counter("sql_rows_total", "Rows returned or affected by call site", ["call_site"])
+SQL_ERRORS = Counter("sql_errors_total", "Failed SQL statements by call site", ["call_site"])
+
+DB_CONNECT_SECONDS = Histogram(
+    "db_connect_duration_seconds", "MySQL connect time including TLS and auth handshake", buckets=_LATENCY_BUCKETS
+)
+DB_READ_ROUTES = Counter(
+    "db_read_routes_total", "Read connections by route, target (replica/primary) and reason", ["route", "target", "reason"]
+)
+DB_REPLICA_LAG = Gauge(
+    "db_replica_lag_seconds", "Last measured replication lag per read replica", ["replica"], multiprocess_mode="max"
+)
+
+INGEST_EVENTS = Counter("ingest_events_total", "Events accepted by /collect", ["site_id"])
+INGEST_QUEUE_DEPTH = Gauge("ingest_queue_depth", "Events waiting for a batch writer", multiprocess_mode="livesum")
+INGEST_BATCH_EVENTS = Histogram(
+    "ingest_batch_events", "Events per batch write", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+INGEST_FLUSH_SECONDS = Histogram("ingest_flush_duration_seconds", "Batch write time", buckets=_LATENCY_BUCKETS)
+INGEST_SHED_EVENTS = Counter(
+    "ingest_shed_events_total", "Events refused by admission control", ["site_id", "reason", "priority"]
+)
+INGEST_SPOOLED_EVENTS = Counter("ingest_spooled_events_total", "Events spooled to disk after a failed batch write")
+INGEST_DUPLICATE_EVENTS = Counter(
+    "ingest_duplicate_events_total", "Events dropped because their eventId was already seen", ["site_id"]
+)
+INGEST_SAMPLED_OUT = Counter("ingest_sampled_out_events_total", "Events dropped by per-site sampling", ["site_id"])
+INGEST_SAMPLE_RATE = Gauge(
+    "ingest_sample_rate", "Current per-site sample rate (1 = unsampled)", ["site_id"], multiprocess_mode="livemin"
+)
+
+REPORT_QUERIES_QUEUED = Counter(
+    "report_queries_queued_total", "Report requests that waited for a governor slot", ["route", "scope"]
+)
+REPORT_QUERIES_REJECTED = Counter(
+    "report_queries_rejected_total", "Report requests refused by the governor", ["route", "scope", "reason"]
+)
+REPORT_QUERIES_KILLED = Counter(
+    "report_queries_killed_total", "Report statements stopped by max_execution_time", ["route"]
+)
+REPORT_QUEUE_WAIT_SECONDS = Histogram(
+    "report_queue_wait_seconds", "Time report requests waited for a governor slot", ["route"], buckets=_LATENCY_BUCKETS
+)
+
+_JOB_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+SCHEDULER_JOB_RUNS = Counter("scheduler_job_runs_total", "Due runs of scheduled jobs by outcome", ["job", "outcome"])
+SCHEDULER_JOB_SECONDS = Histogram(
+    "scheduler_job_duration_seconds", "Run time of scheduled jobs", ["job"], buckets=_JOB_BUCKETS
+)
+SCHEDULER_JOB_LAG_SECONDS = Histogram(
+    "scheduler_job_lag_seconds", "Delay between a scheduled job's due time and its start", ["job"], buckets=_JOB_BUCKETS
+)
+SCHEDULER_JOB_LAST_SUCCESS = Gauge(
+    "scheduler_job_last_success_timestamp_seconds", "Unix time of the last successful run", ["job"],
+    multiprocess_mode="max"
+)
+
+TEMPLATE_RENDER_SECONDS = Histogram(
+    "template_render_duration_seconds", "Jinja2 render time by template", ["template"], buckets=_LATENCY_BUCKETS
+)
+
+
+# ---------------- ROUTES ----------------
+class MetricsMiddleware:
+    """Record latency and status per route template (not per raw path, to bound label cardinality)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            if route is not None:
+                label = route.path
+            elif scope["path"].startswith("/static/"):
+                label = "/static"
+            else:
+                label = "unmatched"
+            method = scope["method"]
+            HTTP_REQUEST_SECONDS.labels(method, label).observe(time.perf_counter() - start)
+            HTTP_RESPONSES.labels(method, label, str(status)).inc()
+
+
+# ---------------- SQL ----------------
+_call_site_override = threading.local()
+
+
+def set_call_site(name):
+    """Report this thread's statements under `name` instead of the calling function
+    (used by fanout.py so queries keep the handler's call site)."""
+    _call_site_override.name = name
+
+
+def _call_site(query, depth):
+    site = getattr(_call_site_override, "name", None) or sys._getframe(depth).f_code.co_name
+    if isinstance(query, str) and query.startswith("/* "):
+        end = query.find(" */", 3)
+        if end != -1:
+            site = f"{site}.{query[3:end]}"
+    return site
+
+
+class InstrumentedCursor(pymysql.cursors.Cursor):
+    """Cursor that reports per-statement timing and row counts by call site."""
+
+    _in_many = False
+
+    def _observe(self, call_site, fn, query, args):
+        start = time.perf_counter()
+        try:
+            result = fn(query, args)
+        except Exception:
+            SQL_ERRORS.labels(call_site).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            SQL_SECONDS.labels(call_site).observe(elapsed)
+        if self.rowcount and self.rowcount > 0:
+            SQL_ROWS.labels(call_site).inc(self.rowcount)
+        if elapsed * 1000 >= slow_queries.SLOW_QUERY_MS:
+            slow_queries.record(call_site, query, args, self.rowcount, elapsed)
+        return result
+
+    def execute(self, query, args=None):
+        if self._in_many:
+            # executemany() drives execute() internally; it is timed as one statement
+            return super().execute(query, args)
+        return self._observe(_call_site(query, 2), super().execute, query, args)
+
+    def executemany(self, query, args):
+        call_site = _call_site(query, 2)
+        self._in_many = True
+        try:
+            return self._observe(call_site, super().executemany, query, args)
+        finally:
+            self._in_many = False
+
+
+# ---------------- TEMPLATES ----------------
+class InstrumentedTemplates(Jinja2Templates):
+    """Jinja2Templates that records how long each page takes to render."""
+
+    def TemplateResponse(self, *args, **kwargs):
+        name = kwargs.get("name") or next((a for a in args if isinstance(a, str)), "unknown")
+        start = time.perf_counter()
+        try:
+            return super().TemplateResponse(*args, **kwargs)
+        finally:
+            TEMPLATE_RENDER_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+# ---------------- EXPOSITION ----------------
+def render():
+    """Return (body, content_type) in the Prometheus text format."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+def metrics_endpoint(request: Request):
+    """Prometheus scrape endpoint. Set METRICS_TOKEN to require `Authorization: Bearer <token>`."""
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    body, content_type = render()
+    return Response(content=body, media_type=content_type)
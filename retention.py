@@ -0,0 +1,168 @@
+"""Per-site, per-day visitor bitmaps and the retention matrices computed from them.
+
+Every visitor already has a dense integer id: the auto-increment `visitors.id`
+of its (visitor_id, site_id) row. For each site and UTC day `visitor_bitmaps`
+stores two roaring bitmaps of those ids:
+
+- `visitors`: everyone with at least one event that day
+- `new_visitors`: the visitors whose `first_seen` falls on that day (the day's cohort)
+
+The ETL (etl.py) folds each chunk it processes into the bitmaps, in the same
+transaction that advances the watermark; bitmaps are unioned, so re-processing
+is harmless. `rebuild()` fills in days from events that were processed before
+the bitmaps existed.
+
+Day-N retention of a cohort is |cohort & active(day + N)| / |cohort|; weekly
+cohorts and activity are unions of the days in each week. With per-visitor
+sampling the bitmaps only hold sampled visitors and cohort sizes are those of
+the sample. At a fixed `sites.sample_rate` a visitor is kept on every day or
+none, so the percentages are unbiased. Adaptive rates are not: when a site's
+rate falls after a cohort's day, the cohort members whose hash lies between
+the new and the old rate are sampled out of the later days, so retention
+reads low. Sites whose retention matters should use a fixed rate.
+"""
+from datetime import datetime, timedelta
+
+from pyroaring import BitMap
+
+REBUILD_DAYS = 90
+
+_UPSERT = """
+INSERT INTO visitor_bitmaps (site_id, day, visitors, new_visitors, visitor_count, new_visitor_count)
+VALUES (%s,%s,%s,%s,%s,%s)
+ON DUPLICATE KEY UPDATE visitors=VALUES(visitors), new_visitors=VALUES(new_visitors),
+    visitor_count=VALUES(visitor_count), new_visitor_count=VALUES(new_visitor_count)
+"""
+
+
+def _day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def day_bitmaps(rows):
+    """{day: (active, new)} for (dense_id, created_at, first_seen) rows; rows without an id are skipped."""
+    days = {}
+    for dense_id, created_at, first_seen in rows:
+        if dense_id is None:
+            continue
+        day = _day(created_at)
+        active, new = days.get(day) or days.setdefault(day, (BitMap(), BitMap()))
+        active.add(dense_id)
+        if first_seen is not None and _day(first_seen) == day:
+            new.add(dense_id)
+    return days
+
+
+def merge(cur, site_id, days):
+    """Union `days` ({day: (active, new)}) into the stored bitmaps of a site.
+
+    Locks the affected rows, so run it inside the caller's transaction.
+    """
+    if not days:
+        return
+    placeholders = ",".join(["%s"] * len(days))
+    cur.execute(
+        f"SELECT day, visitors, new_visitors FROM visitor_bitmaps WHERE site_id=%s AND day IN ({placeholders}) FOR UPDATE",
+        (site_id, *days)
+    )
+    for day, visitors, new_visitors in cur.fetchall():
+        active, new = days[day]
+        active |= BitMap.deserialize(visitors)
+        new |= BitMap.deserialize(new_visitors)
+    cur.executemany(
+        _UPSERT,
+        [(site_id, day, active.serialize(), new.serialize(), len(active), len(new)) for day, (active, new) in days.items()]
+    )
+
+
+def load(cur, site_id, start, end):
+    """{day: (active, new)} stored for start <= day <= end."""
+    cur.execute(
+        "SELECT day, visitors, new_visitors FROM visitor_bitmaps WHERE site_id=%s AND day BETWEEN %s AND %s",
+        (site_id, start, end)
+    )
+    return {_day(day): (BitMap.deserialize(v), BitMap.deserialize(n)) for day, v, n in cur.fetchall()}
+
+
+# ---------------- RETENTION ----------------
+def _week(day):
+    return day - timedelta(days=day.weekday())
+
+
+def _by_week(days):
+    weeks = {}
+    for day, (active, new) in days.items():
+        w_active, w_new = weeks.get(_week(day)) or weeks.setdefault(_week(day), (BitMap(), BitMap()))
+        w_active |= active
+        w_new |= new
+    return weeks
+
+
+def matrix(days, first, last, granularity="day", periods=None):
+    """Retention rows for the cohorts starting first..last (days or weeks).
+
+    Returns [{"cohort": date, "size": int, "retention": [percent or None, ...]}],
+    where entry N is period N after the cohort (period 0 is always 100 for a
+    non-empty cohort) and None marks periods that have not happened yet.
+    """
+    step = timedelta(days=7 if granularity == "week" else 1)
+    if granularity == "week":
+        days = _by_week(days)
+        first, last = _week(first), _week(last)
+    empty = (BitMap(), BitMap())
+
+    cohorts = []
+    start = first
+    while start <= last:
+        cohorts.append(start)
+        start += step
+    periods = len(cohorts) if periods is None else periods
+
+    result = []
+    for cohort in cohorts:
+        members = days.get(cohort, empty)[1]
+        size = len(members)
+        retention = []
+        for n in range(periods):
+            period = cohort + n * step
+            if period > last:
+                retention.append(None)
+            elif not size:
+                retention.append(0.0)
+            else:
+                retained = members.intersection_cardinality(days.get(period, empty)[0])
+                retention.append(round(retained * 100.0 / size, 1))
+        result.append({"cohort": cohort, "size": size, "retention": retention})
+    return result
+
+
+# ---------------- REBUILD ----------------
+def rebuild(conn, site_id, days=REBUILD_DAYS):
+    """Rebuild the last `days` days of a site's bitmaps from hot `events`, one day per transaction.
+
+    Archived (cold) days are not covered. Returns the number of days written.
+    """
+    cur = conn.cursor()
+    today = datetime.utcnow().date()
+    written = 0
+    for offset in range(days, -1, -1):
+        day = today - timedelta(days=offset)
+        conn.begin()
+        try:
+            cur.execute(
+                """
+                SELECT DISTINCT v.id, DATE(e.created_at), v.first_seen
+                FROM events e
+                JOIN visitors v ON v.visitor_id = e.visitor_id AND v.site_id = e.site_id
+                WHERE e.site_id=%s AND e.created_at >= %s AND e.created_at < %s
+                """,
+                (site_id, day, day + timedelta(days=1))
+            )
+            found = day_bitmaps(cur.fetchall())
+            merge(cur, site_id, found)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        written += len(found)
+    return written
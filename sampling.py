@@ -0,0 +1,101 @@
+"""Adaptive per-site sampling at ingest.
+
+A visitor is kept when a hash of (site_id, visitor_id) falls below the site's
+current sample rate, so the decision is deterministic per visitor and sessions
+stay whole. Kept events are stored with `sample_weight = 1 / rate` and every
+report sums weights instead of counting rows, which keeps totals unbiased.
+
+Rates are powers of two (1, 1/2, 1/4, ... 1/1024), so the visitors kept at a
+lower rate are always a subset of those kept at a higher one. For each site the
+ingest worker tracks an exponentially weighted events/s estimate (before
+sampling) and every ADJUST_SEC picks the highest rate that keeps the site under
+its budget: `sites.sampling_target_eps`, else SAMPLING_TARGET_EPS (0 disables
+adaptive sampling). Rates go down immediately but only come back up when the
+site would stay under 70% of its budget, so they do not flap. A fixed
+`sites.sample_rate` overrides the adaptive rate. Budgets are per ingest worker
+process.
+"""
+import hashlib
+import math
+import os
+import time
+
+import metrics
+
+TARGET_EPS = float(os.getenv("SAMPLING_TARGET_EPS", "0"))
+ADJUST_SEC = float(os.getenv("SAMPLING_ADJUST_SEC", "30"))
+MIN_RATE = 1 / 1024
+_EWMA_HALF_LIFE = 60.0
+_RAISE_HEADROOM = 0.7
+
+
+def _visitor_fraction(site_id, visitor_id):
+    digest = hashlib.blake2b(f"{site_id}:{visitor_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2.0 ** 64
+
+
+class _SiteRate:
+    __slots__ = ("rate", "eps", "count", "window_start", "adjusted_at")
+
+    def __init__(self):
+        now = time.monotonic()
+        self.rate = 1.0
+        self.eps = 0.0
+        self.count = 0
+        self.window_start = now
+        self.adjusted_at = now
+
+    def observe(self, target):
+        self.count += 1
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed >= 1.0:
+            # fold the last window into the events/s estimate
+            alpha = 1 - math.exp(-elapsed * math.log(2) / _EWMA_HALF_LIFE)
+            self.eps += alpha * (self.count / elapsed - self.eps)
+            self.count = 0
+            self.window_start = now
+        if now - self.adjusted_at >= ADJUST_SEC:
+            self.adjusted_at = now
+            self._adjust(target)
+
+    def _adjust(self, target):
+        if target <= 0 or self.eps <= 0:
+            self.rate = 1.0
+            return
+        if self.eps * self.rate > target:
+            # drop to the highest power-of-two rate under budget
+            steps = math.ceil(math.log2(self.eps / target))
+            self.rate = max(MIN_RATE, 2.0 ** -steps)
+        elif self.rate < 1.0 and self.eps * self.rate * 2 < target * _RAISE_HEADROOM:
+            self.rate = min(1.0, self.rate * 2)
+
+
+_sites = {}
+
+
+def sample(site_id, visitor_id, site):
+    """Return the sample weight for this event, or None if its visitor is sampled out.
+
+    `site` is the site's settings from the ingest site cache.
+    """
+    fixed = site.get("sample_rate")
+    if fixed:
+        rate = min(1.0, max(MIN_RATE, float(fixed)))
+    else:
+        target = site.get("sampling_target_eps") or TARGET_EPS
+        if not target:
+            return 1.0
+        state = _sites.get(site_id)
+        if state is None:
+            state = _sites[site_id] = _SiteRate()
+        state.observe(float(target))
+        rate = state.rate
+
+    metrics.INGEST_SAMPLE_RATE.labels(site_id).set(rate)
+    if rate >= 1.0:
+        return 1.0
+    if _visitor_fraction(site_id, visitor_id) >= rate:
+        metrics.INGEST_SAMPLED_OUT.labels(site_id).inc()
+        return None
+    return 1.0 / rate
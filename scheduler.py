@@ -0,0 +1,257 @@
+"""In-process scheduler for periodic batch jobs.
+
+Jobs are registered with `add(name, fn, schedule)` and run by every dashboard
+worker process (the app's lifespan starts them), but each due run happens on
+one worker only:
+
+- schedules are slot-based: an interval job of n seconds is due at every
+  multiple of n seconds since the epoch, a cron job (`"m h dom mon dow"`, UTC,
+  with `*`, `*/n`, `a-b`, `a-b/n` and lists) at every matching minute. All
+  workers therefore agree on when a run is due.
+- each worker wakes up at the due time plus a random delay of up to the job's
+  jitter, so workers do not all hit MySQL at once.
+- the worker then takes a MySQL `GET_LOCK('<SCHEDULER_LOCK_PREFIX><job>', 0)`
+  lease on a connection of its own, held for the length of the run. The lock
+  is released when the run ends, or when the connection dies with the worker.
+  Under the lock, `scheduled_jobs.last_due` tells it whether another worker
+  already ran this slot. A worker that finds the lock taken or the slot done
+  skips the run.
+- a run that overruns its next slot skips the slots it missed.
+
+A schedule can be overridden per job with `SCHEDULE_<JOB>`, either as seconds
+(`300`), a cron expression (`30 2 * * *`) or `off`. `SCHEDULER_ENABLED=0`
+turns the scheduler off in a process, e.g. while an external orchestrator
+still calls the `/run/*` endpoints.
+
+`scheduled_jobs` keeps each job's last due slot, start, finish, status,
+error and duration. Metrics: `scheduler_job_runs_total{job,outcome}`
+(ok, error, locked, done_elsewhere), `scheduler_job_duration_seconds`,
+`scheduler_job_lag_seconds` (start minus due time) and
+`scheduler_job_last_success_timestamp_seconds`.
+
+On shutdown, sleeping jobs are cancelled at once. Runs in progress get up to
+SCHEDULER_SHUTDOWN_GRACE_SEC to finish. Job functions run in a thread and
+can check `stopping()` between batches.
+"""
+import asyncio
+import os
+import random
+import socket
+import threading
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import metrics
+from db import get_connection
+
+ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+LOCK_PREFIX = os.getenv("SCHEDULER_LOCK_PREFIX", "analytics:job:")
+SHUTDOWN_GRACE_SEC = float(os.getenv("SCHEDULER_SHUTDOWN_GRACE_SEC", "30"))
+WORKER = f"{socket.gethostname()}:{os.getpid()}"[:64]
+
+_jobs = []
+_stopping = threading.Event()
+
+
+def stopping():
+    """True once the process is shutting down; long jobs should return early."""
+    return _stopping.is_set()
+
+
+# ---------------- SCHEDULES ----------------
+class Interval:
+    """Due at every multiple of `seconds` since the epoch (UTC)."""
+
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError("interval must be positive")
+        self.seconds = int(seconds)
+
+    def next_due(self, after):
+        epoch = int(after.replace(tzinfo=timezone.utc).timestamp())
+        return datetime.utcfromtimestamp((epoch // self.seconds + 1) * self.seconds)
+
+    def __repr__(self):
+        return f"every {self.seconds}s"
+
+
+class Cron:
+    """Standard five-field cron expression, evaluated in UTC; day-of-week 0 or 7 = Sunday."""
+
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression needs 5 fields: {expr!r}")
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, dows = (
+            self._parse(f, lo, hi) for f, (lo, hi) in zip(fields, self._RANGES)
+        )
+        self.dows = {d % 7 for d in dows}
+        # when both day fields are restricted a day matches either (as in cron)
+        self.any_day = fields[2] == "*"
+        self.any_dow = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for part in field.split(","):
+            spec, _, step = part.partition("/")
+            if spec == "*":
+                start, end = lo, hi
+            elif "-" in spec:
+                start, end = (int(v) for v in spec.split("-", 1))
+            else:
+                start = end = int(spec)
+                if step:
+                    end = hi
+            if not (lo <= start <= end <= hi):
+                raise ValueError(f"cron field out of range: {field!r}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, dt):
+        dom = dt.day in self.days
+        dow = (dt.weekday() + 1) % 7 in self.dows
+        if self.any_day:
+            return dow
+        if self.any_dow:
+            return dom
+        return dom or dow
+
+    def next_due(self, after):
+        dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f"cron expression never matches: {self.expr!r}")
+
+    def __repr__(self):
+        return f"cron {self.expr!r}"
+
+
+def parse_schedule(value):
+    """Seconds -> Interval, a cron expression -> Cron, "off"/"" -> None."""
+    value = (value or "").strip()
+    if not value or value.lower() == "off":
+        return None
+    if value.isdigit():
+        return Interval(int(value))
+    return Cron(value)
+
+
+# ---------------- JOBS ----------------
+class Job:
+    def __init__(self, name, fn, schedule, jitter):
+        self.name = name
+        self.fn = fn
+        self.schedule = schedule
+        self.jitter = jitter
+
+
+def add(name, fn, schedule, jitter=0.0):
+    """Register `fn()` to run on `schedule` (seconds or a cron expression), unless SCHEDULE_<NAME> overrides it."""
+    schedule = parse_schedule(os.getenv(f"SCHEDULE_{name.upper()}", str(schedule)))
+    if schedule is not None:
+        _jobs.append(Job(name, fn, schedule, jitter))
+
+
+def _run(job, due):
+    """Run one due slot of a job under its lease; returns the outcome."""
+    conn = get_connection()
+    lock = (LOCK_PREFIX + job.name)[:64]
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT GET_LOCK(%s, 0)", (lock,))
+        if cur.fetchone()[0] != 1:
+            return "locked"
+        try:
+            cur.execute("SELECT last_due FROM scheduled_jobs WHERE name=%s", (job.name,))
+            row = cur.fetchone()
+            if row and row[0] and row[0] >= due:
+                return "done_elsewhere"
+            started = datetime.utcnow()
+            cur.execute(
+                """
+                INSERT INTO scheduled_jobs (name, last_due, last_started_at, worker) VALUES (%s,%s,%s,%s)
+                ON DUPLICATE KEY UPDATE last_due=VALUES(last_due), last_started_at=VALUES(last_started_at),
+                    worker=VALUES(worker)
+                """,
+                (job.name, due, started, WORKER)
+            )
+            metrics.SCHEDULER_JOB_LAG_SECONDS.labels(job.name).observe((started - due).total_seconds())
+
+            status, error = "ok", None
+            t0 = time.perf_counter()
+            try:
+                job.fn()
+            except Exception as e:
+                status, error = "error", str(e)[:255]
+                print(f"Scheduled job {job.name} failed:", e)
+            duration = time.perf_counter() - t0
+            metrics.SCHEDULER_JOB_SECONDS.labels(job.name).observe(duration)
+            if status == "ok":
+                metrics.SCHEDULER_JOB_LAST_SUCCESS.labels(job.name).set(time.time())
+            cur.execute(
+                """
+                UPDATE scheduled_jobs SET last_finished_at=%s, last_status=%s, last_error=%s, last_duration_sec=%s
+                WHERE name=%s
+                """,
+                (datetime.utcnow(), status, error, duration, job.name)
+            )
+            return status
+        finally:
+            cur.execute("SELECT RELEASE_LOCK(%s)", (lock,))
+    finally:
+        conn.close()
+
+
+async def _loop(job, running):
+    while True:
+        due = job.schedule.next_due(datetime.utcnow())
+        delay = (due - datetime.utcnow()).total_seconds() + random.uniform(0, job.jitter)
+        await asyncio.sleep(max(0.0, delay))
+        # shielded: cancellation stops the loop, but a run in progress is left to finish (see lifespan)
+        run = asyncio.ensure_future(asyncio.to_thread(_run, job, due))
+        running.add(run)
+        run.add_done_callback(running.discard)
+        try:
+            outcome = await asyncio.shield(run)
+        except Exception as e:
+            outcome = "error"
+            print(f"Scheduled job {job.name} could not run:", e)
+        metrics.SCHEDULER_JOB_RUNS.labels(job.name, outcome).inc()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Run the registered jobs while the app is up; on shutdown cancel them and let running ones finish."""
+    if not ENABLED or not _jobs:
+        yield
+        return
+    _stopping.clear()
+    running = set()
+    tasks = [asyncio.create_task(_loop(job, running)) for job in _jobs]
+    print("Scheduler started:", ", ".join(f"{job.name} ({job.schedule!r})" for job in _jobs))
+    try:
+        yield
+    finally:
+        _stopping.set()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if running:
+            done, pending = await asyncio.wait(running, timeout=SHUTDOWN_GRACE_SEC)
+            if pending:
+                print(f"Scheduler shutdown: {len(pending)} job run(s) still running after {SHUTDOWN_GRACE_SEC}s")
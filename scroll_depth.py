@@ -0,0 +1,307 @@
+"""Per-site, per-page, per-day scroll-depth histograms behind the audience report.
+
+`scroll_percent` is an integer from 0 to 100, so a histogram with one bin per
+percent is an exact quantile summary, and histograms merge by adding bins:
+any date range and any set of pages reduce to one histogram with exact
+averages and percentiles (p50, p90). The batch writers add each batch's
+`scroll` events to `scroll_histograms` (site_id, day, page_url_id, percent ->
+weighted events) with additive upserts, in the batch transaction (`upsert()`).
+Pages are normalized URLs (`page_path_id`, see urlnorm.py); events without a
+page URL are stored under page_url_id 0.
+
+Distinct visitors per depth bucket do not add up across days, so each ingest
+worker also keeps a HyperLogLog of the visitors of every (site, day, bucket)
+(`record()`) and merges it into its own row of `scroll_visitor_sketches`
+every SKETCH_FLUSH_SEC (`flush()`). Visitor counts are estimates with the
+HyperLogLog error documented in sketches.py, scaled by the bucket's mean
+sample weight.
+
+The report reads at most 101 rows per page and day, however many events a
+site has. `rebuild()` fills in days from events that were written before the
+histograms existed.
+"""
+import threading
+from datetime import datetime, timedelta
+
+import msgspec
+
+from sketches import WORKER, HyperLogLog
+
+REBUILD_DAYS = 90
+# (label, lowest percent), highest first
+BUCKETS = (("100", 100), ("90-99", 90), ("70-89", 70), ("50-69", 50), ("<50", 0))
+
+_UPSERT = """
+INSERT INTO scroll_histograms (site_id, day, page_url_id, percent, events)
+VALUES (%s,%s,%s,%s,%s)
+ON DUPLICATE KEY UPDATE events = events + VALUES(events)
+"""
+
+
+def bucket(percent):
+    for label, low in BUCKETS:
+        if percent >= low:
+            return label
+    return BUCKETS[-1][0]
+
+
+def _percent(value):
+    return max(0, min(100, int(value)))
+
+
+def histogram_rows(batch, urls):
+    """One upsert row per (site, day, page, percent) among the batch's scroll events."""
+    bins = {}
+    for e in batch:
+        if e["event_type"] != "scroll" or e.get("scroll_percent") is None:
+            continue
+        key = (e["site_id"], e["created_at"].date(), urls.get(e["page_path"]) or 0, _percent(e["scroll_percent"]))
+        bins[key] = bins.get(key, 0.0) + (e["sample_weight"] or 1.0)
+    return [(*key, events) for key, events in bins.items()]
+
+
+def upsert(cur, batch, urls):
+    rows = histogram_rows(batch, urls)
+    if rows:
+        cur.executemany(_UPSERT, rows)
+
+
+# ---------------- VISITOR SKETCHES ----------------
+class VisitorSketch:
+    """Per depth bucket: HyperLogLog of visitors, raw event count and weighted event count."""
+
+    def __init__(self):
+        self.buckets = {}   # label -> [HyperLogLog, hits, weight]
+
+    def add(self, label, visitor_id, weight):
+        b = self.buckets.get(label)
+        if b is None:
+            b = self.buckets[label] = [HyperLogLog(), 0, 0.0]
+        b[0].add(visitor_id)
+        b[1] += 1
+        b[2] += weight
+
+    def merge(self, other):
+        for label, (users, hits, weight) in other.buckets.items():
+            b = self.buckets.get(label)
+            if b is None:
+                self.buckets[label] = [users, hits, weight]
+            else:
+                b[0].merge(users)
+                b[1] += hits
+                b[2] += weight
+
+    def visitors(self):
+        """{label: estimated visitors}, scaled by the bucket's mean sample weight."""
+        return {label: users.estimate() * (weight / hits if hits else 1.0)
+                for label, (users, hits, weight) in self.buckets.items()}
+
+    def encode(self):
+        return msgspec.msgpack.encode([[label, b[0].to_builtins(), b[1], b[2]] for label, b in self.buckets.items()])
+
+    @classmethod
+    def decode(cls, blob):
+        s = cls()
+        s.buckets = {label: [HyperLogLog.from_builtins(users), hits, weight]
+                     for label, users, hits, weight in msgspec.msgpack.decode(blob)}
+        return s
+
+
+def merge(blobs):
+    total = VisitorSketch()
+    for blob in blobs:
+        total.merge(VisitorSketch.decode(blob))
+    return total
+
+
+_pending = {}   # (site_id, day) -> VisitorSketch not yet merged into this worker's row
+_lock = threading.Lock()
+
+
+def record(batch):
+    """Add a written batch's scroll events to this worker's pending visitor sketches."""
+    with _lock:
+        for e in batch:
+            if e["event_type"] != "scroll" or e.get("scroll_percent") is None:
+                continue
+            key = (e["site_id"], e["created_at"].date())
+            sketch = _pending.get(key)
+            if sketch is None:
+                sketch = _pending[key] = VisitorSketch()
+            sketch.add(bucket(_percent(e["scroll_percent"])), e["visitor_id"], e["sample_weight"] or 1.0)
+
+
+def _keys_clause(keys):
+    return " OR ".join(["(site_id=%s AND day=%s)"] * len(keys)), [v for key in keys for v in key]
+
+
+def flush(conn):
+    """Merge the pending sketches into this worker's rows; returns the number of rows written."""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+    if not pending:
+        return 0
+    cur = conn.cursor()
+    try:
+        where, params = _keys_clause(list(pending))
+        cur.execute(f"SELECT site_id, day, sketch FROM scroll_visitor_sketches WHERE worker=%s AND ({where})",
+                    (WORKER, *params))
+        for site_id, day, blob in cur.fetchall():
+            pending[(site_id, day)].merge(VisitorSketch.decode(blob))
+        cur.executemany(
+            """
+            INSERT INTO scroll_visitor_sketches (site_id, day, worker, sketch) VALUES (%s,%s,%s,%s)
+            ON DUPLICATE KEY UPDATE sketch=VALUES(sketch)
+            """,
+            [(site_id, day, WORKER, sketch.encode()) for (site_id, day), sketch in pending.items()]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        with _lock:
+            for key, sketch in pending.items():
+                current = _pending.get(key)
+                if current is not None:
+                    sketch.merge(current)
+                _pending[key] = sketch
+        raise
+    return len(pending)
+
+
+# ---------------- REPORT SIDE ----------------
+def _range(start, end):
+    clauses, params = [], []
+    if start is not None:
+        clauses.append("day >= %s")
+        params.append(start)
+    if end is not None:
+        clauses.append("day < %s")
+        params.append(end)
+    return "".join(" AND " + c for c in clauses), params
+
+
+def site_histogram(cur, site_id, start=None, end=None):
+    """{percent: weighted events} over all pages of a site for days in [start, end)."""
+    where, params = _range(start, end)
+    cur.execute(f"SELECT percent, SUM(events) FROM scroll_histograms WHERE site_id=%s{where} GROUP BY percent",
+                (site_id, *params))
+    return {int(p): float(n) for p, n in cur.fetchall()}
+
+
+def top_pages(cur, site_id, start=None, end=None, limit=20):
+    """[(page_url_id, histogram)] of the pages with the highest average scroll depth."""
+    where, params = _range(start, end)
+    cur.execute(
+        f"""
+        SELECT page_url_id FROM scroll_histograms WHERE site_id=%s{where}
+        GROUP BY page_url_id ORDER BY SUM(percent * events) / SUM(events) DESC LIMIT %s
+        """,
+        (site_id, *params, limit)
+    )
+    page_ids = [r[0] for r in cur.fetchall()]
+    if not page_ids:
+        return []
+    placeholders = ",".join(["%s"] * len(page_ids))
+    cur.execute(
+        f"""
+        SELECT page_url_id, percent, SUM(events) FROM scroll_histograms
+        WHERE site_id=%s{where} AND page_url_id IN ({placeholders}) GROUP BY page_url_id, percent
+        """,
+        (site_id, *params, *page_ids)
+    )
+    hists = {pid: {} for pid in page_ids}
+    for pid, percent, events in cur.fetchall():
+        hists[pid][int(percent)] = float(events)
+    return [(pid, hists[pid]) for pid in page_ids]
+
+
+def visitors(cur, site_id, start=None, end=None):
+    """{bucket label: estimated distinct visitors} for days in [start, end)."""
+    where, params = _range(start, end)
+    cur.execute(f"SELECT sketch FROM scroll_visitor_sketches WHERE site_id=%s{where}", (site_id, *params))
+    return merge(r[0] for r in cur.fetchall()).visitors()
+
+
+def quantile(hist, q):
+    """Smallest percent with at least a fraction q of the weighted events at or below it."""
+    total = sum(hist.values())
+    if not total:
+        return None
+    seen = 0.0
+    for percent in sorted(hist):
+        seen += hist[percent]
+        if seen >= q * total:
+            return percent
+    return max(hist)
+
+
+def summary(hist):
+    """{"events", "avg", "p50", "p90"} of a histogram."""
+    total = sum(hist.values())
+    return {
+        "events": total,
+        "avg": sum(p * n for p, n in hist.items()) / total if total else 0.0,
+        "p50": quantile(hist, 0.5),
+        "p90": quantile(hist, 0.9),
+    }
+
+
+def buckets(hist):
+    """{bucket label: weighted events} of a histogram."""
+    counts = {label: 0.0 for label, _ in BUCKETS}
+    for percent, n in hist.items():
+        counts[bucket(percent)] += n
+    return counts
+
+
+# ---------------- REBUILD ----------------
+def rebuild(conn, site_id, days=REBUILD_DAYS):
+    """Recompute the last `days` closed days of a site from hot events; returns the days rebuilt.
+
+    Days without hot scroll events are left alone: they may have been archived
+    (the cold tier starts at HOT_RETENTION_DAYS, the default `days` too), and
+    their histograms are then all that is left to report from.
+
+    Events written before page_path_id existed count under their raw page_url_id;
+    those that still have only a page_url string (see dictionary.backfill_events)
+    count under page_url_id 0.
+    """
+    cur = conn.cursor()
+    today = datetime.utcnow().date()
+    rebuilt = 0
+    for n in range(days, 0, -1):
+        day = today - timedelta(days=n)
+        start, end = datetime.combine(day, datetime.min.time()), datetime.combine(day + timedelta(days=1), datetime.min.time())
+        cur.execute(
+            """
+            SELECT COALESCE(page_path_id, page_url_id, 0), scroll_percent, visitor_id, sample_weight FROM events
+            WHERE site_id=%s AND event_type='scroll' AND scroll_percent IS NOT NULL
+              AND created_at >= %s AND created_at < %s
+            """,
+            (site_id, start, end)
+        )
+        rows = cur.fetchall()
+        if not rows:
+            continue
+        bins = {}
+        sketch = VisitorSketch()
+        for page_id, percent, visitor_id, weight in rows:
+            percent = _percent(percent)
+            bins[(page_id, percent)] = bins.get((page_id, percent), 0.0) + (weight or 1.0)
+            sketch.add(bucket(percent), visitor_id, weight or 1.0)
+        conn.begin()
+        try:
+            cur.execute("DELETE FROM scroll_histograms WHERE site_id=%s AND day=%s", (site_id, day))
+            cur.execute("DELETE FROM scroll_visitor_sketches WHERE site_id=%s AND day=%s", (site_id, day))
+            cur.executemany(_UPSERT, [(site_id, day, page_id, percent, n) for (page_id, percent), n in bins.items()])
+            cur.execute(
+                "INSERT INTO scroll_visitor_sketches (site_id, day, worker, sketch) VALUES (%s,%s,'rebuild',%s)",
+                (site_id, day, sketch.encode())
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        rebuilt += 1
+    return rebuilt
@@ -0,0 +1,36 @@
+"""Entry point for both runtimes built from this codebase.
+
+    python serve.py --role all        # dashboard + ingest in one app (default, what app:app serves)
+    python serve.py --role dashboard  # dashboard, reports and APIs only
+    python serve.py --role ingest     # /collect, /rules, /track.js only, as a multi-process worker pool
+
+The ingest role has no session/OAuth middleware and its own connection pool,
+so heavy report queries on the dashboard cannot add latency to beacons.
+"""
+import argparse
+import os
+
+import uvicorn
+
+TARGETS = {
+    "all": "app:app",
+    "dashboard": "app:app",
+    "ingest": "ingest:app",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the analytics dashboard and/or ingest tier")
+    parser.add_argument("--role", choices=sorted(TARGETS), default=os.getenv("APP_ROLE", "all"))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")))
+    args = parser.parse_args()
+
+    # worker processes inherit the role through the environment
+    os.environ["APP_ROLE"] = args.role
+    uvicorn.run(TARGETS[args.role], host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Session headers: the per-session browser attributes, stored once per session.
+
+track.js sends user agent, language, platform, screen size and timezone only
+with `session_start` (the session header), and the referrer only with the
+events of a page load; every other beacon carries just the fields that change.
+The batch writers store the header on the session's `sessions` row
+(`user_agent_id`, `language`, `platform`, `screen_size`, `timezone`) and leave
+those columns NULL on `events` rows that have a session_id; events without a
+session (very old clients) keep them on the row.
+
+A bounded LRU of (site_id, session_id) -> header (SESSION_CACHE_SIZE entries)
+sits in front of `sessions`, so a writer knows which sessions already have
+their header stored without a query per batch. Clients still running the old
+script resend the header on every event; against the cache those copies are
+dropped before their user agents are interned or written. A cache miss is
+looked up in `sessions`; the first header stored for a session wins.
+
+Readers that need the attributes per event join `sessions` (the ETL's
+TechStack step) or, for archived rows, get them filled in by `fill_events()`.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "100000"))
+
+# event dict keys of the header, in `sessions` column order (user_agent is stored as user_agent_id)
+FIELDS = ("user_agent", "language", "platform", "screen_size", "timezone")
+COLUMNS = ("user_agent_id", "language", "platform", "screen_size", "timezone")
+
+
+def header_of(event):
+    """The event's header tuple, or None if it carries none of the header fields."""
+    header = tuple(event.get(f) for f in FIELDS)
+    return header if any(v is not None for v in header) else None
+
+
+class SessionCache:
+    """(site_id, session_id) -> header of the sessions whose header is stored, with LRU eviction."""
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _select(self, cur, keys):
+        where = " OR ".join(["(s.site_id=%s AND s.session_id=%s)"] * len(keys))
+        cur.execute(
+            f"""
+            SELECT s.site_id, s.session_id, ua.value, s.language, s.platform, s.screen_size, s.timezone
+            FROM sessions s LEFT JOIN user_agent_dict ua ON ua.id = s.user_agent_id
+            WHERE ({where}) AND (s.user_agent_id IS NOT NULL OR s.language IS NOT NULL OR s.platform IS NOT NULL
+                OR s.screen_size IS NOT NULL OR s.timezone IS NOT NULL)
+            """,
+            tuple(v for key in keys for v in key)
+        )
+        return {(r[0], r[1]): tuple(r[2:]) for r in cur.fetchall()}
+
+    def known(self, conn, keys):
+        """The subset of `keys` whose header is stored: {key: header}."""
+        found = {}
+        missing = []
+        with self._lock:
+            for key in set(keys):
+                header = self._cache.get(key)
+                if header is None:
+                    missing.append(key)
+                else:
+                    self._cache.move_to_end(key)
+                    found[key] = header
+        if missing:
+            stored = self._select(conn.cursor(), missing)
+            conn.commit()
+            self.put(stored)
+            found.update(stored)
+        return found
+
+    def put(self, headers):
+        """Remember headers that are now stored (call after the writing transaction commits)."""
+        with self._lock:
+            for key, header in headers.items():
+                self._cache[key] = header
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+cache = SessionCache()
+
+
+def new_headers(conn, batch):
+    """{(site_id, session_id): header} for the sessions in `batch` that send a header not stored yet.
+
+    Queries `sessions` for sessions missing from the cache, so call it before
+    opening the batch transaction.
+    """
+    sent = {}
+    for e in batch:
+        if e.get("session_id"):
+            header = header_of(e)
+            if header is not None:
+                sent.setdefault((e["site_id"], e["session_id"]), header)
+    if not sent:
+        return {}
+    known = cache.known(conn, list(sent))
+    return {key: header for key, header in sent.items() if key not in known}
+
+
+def fill_events(cur, names, rows):
+    """Fill the header columns of `events` rows (column `names`) from their sessions."""
+    index = {n: i for i, n in enumerate(names)}
+    if "session_id" not in index or not all(c in index for c in COLUMNS):
+        return rows
+    sid_idx, site_idx = index["session_id"], index["site_id"]
+    wanted = {(r[site_idx], r[sid_idx]) for r in rows
+              if r[sid_idx] and all(r[index[c]] is None for c in COLUMNS)}
+    if not wanted:
+        return rows
+    wanted = list(wanted)
+    where = " OR ".join(["(site_id=%s AND session_id=%s)"] * len(wanted))
+    cur.execute(
+        f"SELECT site_id, session_id, {', '.join(COLUMNS)} FROM sessions WHERE {where}",
+        tuple(v for key in wanted for v in key)
+    )
+    headers = {(r[0], r[1]): r[2:] for r in cur.fetchall()}
+    rows = [list(r) for r in rows]
+    for r in rows:
+        header = headers.get((r[site_idx], r[sid_idx]))
+        if header is not None and all(r[index[c]] is None for c in COLUMNS):
+            for c, v in zip(COLUMNS, header):
+                r[index[c]] = v
+    return rows
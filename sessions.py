@@ -0,0 +1,113 @@
+"""Materialized `sessions` table, maintained by the ingest batch writers.
+
+Each batch is folded into one row per (site_id, session_id) in the batch and
+upserted: start/end widen, event and page-view counts add up, landing page,
+referrer and source come from the earliest event seen and the exit page from
+the latest. Reports read duration, bounce and landing pages from this table
+instead of regrouping raw events.
+
+A session bounces when it has at most one page view and no engagement event
+(anything besides session_start, first_visit, page_view and scroll).
+"""
+from urllib.parse import urlsplit
+
+SOURCES = ("Direct", "Organic", "Social", "Referral", "Email")
+PASSIVE_EVENTS = {"session_start", "first_visit", "page_view", "scroll"}
+
+_SEARCH = ("google", "bing", "yahoo")
+_SOCIAL = ("facebook", "twitter", "instagram", "linkedin", "t.co")
+
+# MySQL applies the assignments left to right, so the columns that compare
+# against the stored started_at/ended_at must come before those are widened.
+_UPSERT = """
+INSERT INTO sessions (site_id, session_id, visitor_id, started_at, ended_at, event_count, pageview_count,
+                      engaged, landing_page_id, exit_page_id, referrer_id, source, sample_weight,
+                      user_agent_id, language, platform, screen_size, timezone)
+VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+ON DUPLICATE KEY UPDATE
+    user_agent_id = COALESCE(user_agent_id, VALUES(user_agent_id)),
+    language = COALESCE(language, VALUES(language)),
+    platform = COALESCE(platform, VALUES(platform)),
+    screen_size = COALESCE(screen_size, VALUES(screen_size)),
+    timezone = COALESCE(timezone, VALUES(timezone)),
+    landing_page_id = IF(VALUES(started_at) < started_at, VALUES(landing_page_id), landing_page_id),
+    referrer_id = IF(VALUES(started_at) < started_at, VALUES(referrer_id), referrer_id),
+    source = IF(VALUES(started_at) < started_at, VALUES(source), source),
+    exit_page_id = IF(VALUES(ended_at) >= ended_at, VALUES(exit_page_id), exit_page_id),
+    started_at = LEAST(started_at, VALUES(started_at)),
+    ended_at = GREATEST(ended_at, VALUES(ended_at)),
+    event_count = event_count + VALUES(event_count),
+    pageview_count = pageview_count + VALUES(pageview_count),
+    engaged = GREATEST(engaged, VALUES(engaged))
+"""
+
+
+def classify_source(referrer, domain=None):
+    """Traffic source class of a referrer; referrals from the site itself count as Direct."""
+    ref_low = (referrer or "").lower()
+    if not ref_low:
+        return "Direct"
+    if domain and urlsplit(ref_low).hostname in (domain.lower(), "www." + domain.lower()):
+        return "Direct"
+    if any(k in ref_low for k in _SEARCH):
+        return "Organic"
+    if any(k in ref_low for k in _SOCIAL):
+        return "Social"
+    if "mailto:" in ref_low or "email" in ref_low:
+        return "Email"
+    return "Referral"
+
+
+def session_rows(batch, domains, urls, headers=None, user_agents=None):
+    """One upsert row per session in the batch; events without a session_id are skipped.
+
+    `domains` maps site_id to the site's domain (for classify_source), `urls`
+    maps normalized page URLs (landing and exit pages) and referrers to their
+    dictionary ids. `headers` holds the
+    session headers to store (see session_headers.py), with user agents
+    mapped to ids by `user_agents`.
+    """
+    headers = headers or {}
+    user_agents = user_agents or {}
+    sessions = {}
+    for e in sorted((e for e in batch if e.get("session_id")), key=lambda e: e["created_at"]):
+        key = (e["site_id"], e["session_id"])
+        s = sessions.get(key)
+        if s is None:
+            s = sessions[key] = {
+                "visitor_id": e["visitor_id"],
+                "started_at": e["created_at"],
+                "events": 0,
+                "pageviews": 0,
+                "engaged": 0,
+                "landing_page": e["page_path"],
+                "referrer": e["referrer"],
+                "weight": e["sample_weight"],
+            }
+        s["ended_at"] = e["created_at"]
+        s["exit_page"] = e["page_path"]
+        s["events"] += 1
+        if e["event_type"] == "page_view":
+            s["pageviews"] += 1
+        if e["event_type"] not in PASSIVE_EVENTS:
+            s["engaged"] = 1
+
+    return [
+        (site_id, session_id, s["visitor_id"], s["started_at"], s["ended_at"], s["events"], s["pageviews"],
+         s["engaged"], urls.get(s["landing_page"]), urls.get(s["exit_page"]), urls.get(s["referrer"]),
+         classify_source(s["referrer"], domains.get(site_id)), s["weight"],
+         *_header_columns(headers.get((site_id, session_id)), user_agents))
+        for (site_id, session_id), s in sessions.items()
+    ]
+
+
+def _header_columns(header, user_agents):
+    if header is None:
+        return (None,) * 5
+    return (user_agents.get(header[0]), *header[1:])
+
+
+def upsert(cur, batch, domains, urls, headers=None, user_agents=None):
+    rows = session_rows(batch, domains, urls, headers, user_agents)
+    if rows:
+        cur.executemany(_UPSERT, rows)
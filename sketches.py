@@ -0,0 +1,350 @@
+"""Streaming heavy-hitter sketches behind the realtime top pages and top referrers.
+
+Every ingest worker keeps, per site and UTC minute, a `MinuteSketch`:
+
+- a Space-Saving summary of page views (weighted by sample_weight) per page id
+- a Space-Saving summary of page views per referrer id
+- for each page currently tracked by the first summary: a HyperLogLog of its
+  visitors, its weighted event count, last title, and the number and summed
+  weight of the views recorded while tracked
+
+The batch writers feed committed events into it (`record()`), and a background
+task (`flush()`) persists each worker's dirty minutes to `realtime_sketches`
+every SKETCH_FLUSH_SEC, one row per (site, minute, worker). `/api/realtime`
+merges the rows of the last 30 minutes across workers and minutes (`merge()`)
+instead of fetching raw events. Memory is bounded per site-minute by
+SKETCH_CAPACITY counters per summary and one HyperLogLog (at most 2^p bytes)
+per tracked page; minutes older than WINDOW_MIN are dropped.
+
+Error bounds, with N the total weight summarized and m = SKETCH_CAPACITY:
+
+- every page/referrer with more than N/m views is in the summary, and its count
+  overestimates the true count by at most its recorded `error`, itself <= N/m.
+  Merged summaries keep the same bound for the combined N (mergeable summaries,
+  Agarwal et al. 2012).
+- users per page are HyperLogLog estimates with a relative standard error of
+  1.04 / sqrt(2^p), about 3.3% at the default p = 10, scaled by the mean
+  sample weight of the page's recorded views (not its Space-Saving count,
+  which includes the count inherited on eviction). Visitors seen while a page was not tracked (before it
+  entered, or after it was evicted from, a worker's summary for that minute)
+  are missed, so for pages near the N/m threshold users are a lower bound.
+"""
+import hashlib
+import heapq
+import math
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+import msgspec
+
+CAPACITY = int(os.getenv("SKETCH_CAPACITY", "200"))
+HLL_PRECISION = int(os.getenv("SKETCH_HLL_PRECISION", "10"))
+FLUSH_SEC = float(os.getenv("SKETCH_FLUSH_SEC", "2"))
+WINDOW_MIN = 31
+# persisted rows older than this are deleted by the flusher
+RETAIN_MIN = 120
+
+WORKER = f"{socket.gethostname()}:{os.getpid()}"[:64]
+
+
+# ---------------- SPACE-SAVING ----------------
+class SpaceSaving:
+    """Weighted Space-Saving summary: at most `capacity` keys with [count, error]."""
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.counters = {}
+        self._heap = []   # (count, key), lazily invalidated
+
+    def _push(self, key, count):
+        heapq.heappush(self._heap, (count, key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c[0], k) for k, c in self.counters.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, key = heapq.heappop(self._heap)
+            c = self.counters.get(key)
+            if c is not None and c[0] == count:
+                return key
+
+    def min_count(self):
+        """Smallest count, or 0 while the summary is not full (absent keys then have count 0)."""
+        if len(self.counters) < self.capacity:
+            return 0.0
+        while True:
+            count, key = self._heap[0]
+            c = self.counters.get(key)
+            if c is not None and c[0] == count:
+                return count
+            heapq.heappop(self._heap)
+
+    def offer(self, key, weight=1.0):
+        """Add `weight` to `key`. Returns the evicted key, if one was evicted."""
+        c = self.counters.get(key)
+        if c is not None:
+            c[0] += weight
+            self._push(key, c[0])
+            return None
+        evicted = None
+        floor = 0.0
+        if len(self.counters) >= self.capacity:
+            evicted = self._pop_min()
+            floor = self.counters.pop(evicted)[0]
+        self.counters[key] = [floor + weight, floor]
+        self._push(key, floor + weight)
+        return evicted
+
+    def merge(self, other):
+        """Fold `other` into this summary. Returns the keys that were dropped."""
+        mine, theirs = self.min_count(), other.min_count()
+        merged = {}
+        for key in self.counters.keys() | other.counters.keys():
+            a = self.counters.get(key) or (mine, mine)
+            b = other.counters.get(key) or (theirs, theirs)
+            merged[key] = [a[0] + b[0], a[1] + b[1]]
+        kept = heapq.nlargest(self.capacity, merged.items(), key=lambda kv: kv[1][0])
+        self.counters = dict(kept)
+        self._heap = [(c[0], k) for k, c in self.counters.items()]
+        heapq.heapify(self._heap)
+        return merged.keys() - self.counters.keys()
+
+    def top(self, k):
+        """[(key, count, error)] of the k largest counts."""
+        return [(key, c[0], c[1]) for key, c in heapq.nlargest(k, self.counters.items(), key=lambda kv: kv[1][0])]
+
+    def to_builtins(self):
+        return [[k, c[0], c[1]] for k, c in self.counters.items()]
+
+    @classmethod
+    def from_builtins(cls, data, capacity=CAPACITY):
+        s = cls(capacity)
+        s.counters = {k: [count, error] for k, count, error in data}
+        s._heap = [(c[0], k) for k, c in s.counters.items()]
+        heapq.heapify(s._heap)
+        return s
+
+
+# ---------------- HYPERLOGLOG ----------------
+class HyperLogLog:
+    """HyperLogLog with 2^p registers, kept sparse ({index: rank}) while small."""
+
+    def __init__(self, p=HLL_PRECISION):
+        self.p = p
+        self.sparse = {}
+        self.dense = None
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        self._set(index, rank)
+
+    def _set(self, index, rank):
+        if self.dense is not None:
+            if rank > self.dense[index]:
+                self.dense[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            if len(self.sparse) > (1 << self.p) // 4:
+                self.dense = bytearray(1 << self.p)
+                for i, r in self.sparse.items():
+                    self.dense[i] = r
+                self.sparse = {}
+
+    def merge(self, other):
+        if other.dense is not None:
+            if self.dense is None:
+                self.dense = bytearray(other.dense)
+                for i, r in self.sparse.items():
+                    self._set(i, r)
+                self.sparse = {}
+            else:
+                self.dense = bytearray(map(max, self.dense, other.dense))
+        else:
+            for i, r in other.sparse.items():
+                self._set(i, r)
+
+    def estimate(self):
+        m = 1 << self.p
+        if self.dense is not None:
+            zeros = self.dense.count(0)
+            total = sum(2.0 ** -r for r in self.dense)
+        else:
+            zeros = m - len(self.sparse)
+            total = zeros + sum(2.0 ** -r for r in self.sparse.values())
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / total
+        if raw <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)   # linear counting for small cardinalities
+        return raw
+
+    def to_builtins(self):
+        return bytes(self.dense) if self.dense is not None else [[i, r] for i, r in self.sparse.items()]
+
+    @classmethod
+    def from_builtins(cls, data, p=HLL_PRECISION):
+        h = cls(p)
+        if isinstance(data, bytes):
+            h.dense = bytearray(data)
+        else:
+            h.sparse = {i: r for i, r in data}
+        return h
+
+
+# ---------------- MINUTE SKETCH ----------------
+class MinuteSketch:
+    """Top pages (with users, events, title) and top referrers for one site and minute."""
+
+    def __init__(self, capacity=CAPACITY):
+        self.pages = SpaceSaving(capacity)
+        self.referrers = SpaceSaving(capacity)
+        # page id -> [title, weighted events, page views, HyperLogLog, weighted page views]
+        self.page_info = {}
+
+    def _info(self, page):
+        info = self.page_info.get(page)
+        if info is None:
+            info = self.page_info[page] = [None, 0.0, 0, HyperLogLog(), 0.0]
+        return info
+
+    def add(self, page, referrer, visitor_id, event_type, title, weight):
+        if page is not None and event_type == "page_view":
+            evicted = self.pages.offer(page, weight)
+            if evicted is not None:
+                self.page_info.pop(evicted, None)
+            info = self._info(page)
+            info[2] += 1
+            info[4] += weight
+            if referrer is not None:
+                self.referrers.offer(referrer, weight)
+        if page in self.pages.counters:
+            info = self._info(page)
+            info[1] += weight
+            info[3].add(visitor_id)
+            if title:
+                info[0] = title
+
+    def merge(self, other):
+        for page, (title, events, views, users, view_weight) in other.page_info.items():
+            info = self._info(page)
+            info[0] = title or info[0]
+            info[1] += events
+            info[2] += views
+            info[3].merge(users)
+            info[4] += view_weight
+        for page in self.pages.merge(other.pages):
+            self.page_info.pop(page, None)
+        self.referrers.merge(other.referrers)
+
+    def top_pages(self, k):
+        """[{"page_id", "title", "views", "error", "users", "event_count"}] for the k most viewed pages."""
+        result = []
+        for page, views, error in self.pages.top(k):
+            title, events, hits, users, view_weight = self.page_info.get(page) or (None, 0.0, 0, HyperLogLog(), 0.0)
+            mean_weight = view_weight / hits if hits else 1.0
+            result.append({
+                "page_id": page,
+                "title": title,
+                "views": views,
+                "error": error,
+                "users": users.estimate() * mean_weight,
+                "event_count": events,
+            })
+        return result
+
+    def top_referrers(self, k):
+        return [{"referrer_id": ref, "views": views, "error": error} for ref, views, error in self.referrers.top(k)]
+
+    def to_builtins(self):
+        return {
+            "capacity": self.pages.capacity,
+            "pages": self.pages.to_builtins(),
+            "referrers": self.referrers.to_builtins(),
+            "info": [[page, i[0], i[1], i[2], i[3].to_builtins(), i[4]] for page, i in self.page_info.items()],
+        }
+
+    @classmethod
+    def from_builtins(cls, data):
+        s = cls(data["capacity"])
+        s.pages = SpaceSaving.from_builtins(data["pages"], data["capacity"])
+        s.referrers = SpaceSaving.from_builtins(data["referrers"], data["capacity"])
+        # rows persisted before the weighted page views were kept count each view as weight 1
+        s.page_info = {
+            page: [title, events, views, HyperLogLog.from_builtins(users), float((view_weight or [views])[0])]
+            for page, title, events, views, users, *view_weight in data["info"]
+        }
+        return s
+
+
+def encode(sketch):
+    return msgspec.msgpack.encode(sketch.to_builtins())
+
+
+def decode(blob):
+    return MinuteSketch.from_builtins(msgspec.msgpack.decode(blob))
+
+
+def merge(blobs, capacity=CAPACITY):
+    """One MinuteSketch merged from persisted sketch blobs."""
+    total = MinuteSketch(capacity)
+    for blob in blobs:
+        total.merge(decode(blob))
+    return total
+
+
+# ---------------- INGEST SIDE ----------------
+_sketches = {}   # (site_id, minute) -> MinuteSketch
+_dirty = set()
+_lock = threading.Lock()
+_last_prune = 0.0
+
+
+def record(batch, urls):
+    """Add a written batch of queued events; `urls` maps normalized page URLs and referrers to dictionary ids."""
+    with _lock:
+        for e in batch:
+            key = (e["site_id"], e["created_at"].replace(second=0, microsecond=0))
+            sketch = _sketches.get(key)
+            if sketch is None:
+                sketch = _sketches[key] = MinuteSketch()
+            sketch.add(urls.get(e["page_path"]), urls.get(e["referrer"]), e["visitor_id"], e["event_type"],
+                       e["page_title"], e["sample_weight"])
+            _dirty.add(key)
+
+
+def flush(conn):
+    """Persist this worker's dirty minutes and drop old ones (from memory and the table)."""
+    global _last_prune
+    cutoff = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(minutes=WINDOW_MIN)
+    with _lock:
+        for key in [k for k in _sketches if k[1] < cutoff]:
+            del _sketches[key]
+        dirty = [k for k in _dirty if k in _sketches]
+        rows = [(site_id, minute, WORKER, encode(_sketches[(site_id, minute)])) for site_id, minute in dirty]
+        _dirty.clear()
+    cur = conn.cursor()
+    try:
+        if rows:
+            cur.executemany(
+                """
+                INSERT INTO realtime_sketches (site_id, minute, worker, sketch) VALUES (%s,%s,%s,%s)
+                ON DUPLICATE KEY UPDATE sketch=VALUES(sketch)
+                """,
+                rows
+            )
+        conn.commit()
+    except Exception:
+        with _lock:
+            _dirty.update(dirty)
+        raise
+    if time.monotonic() - _last_prune > 60:
+        cur.execute("DELETE FROM realtime_sketches WHERE minute < %s", (cutoff - timedelta(minutes=RETAIN_MIN),))
+        conn.commit()
+        _last_prune = time.monotonic()
+    return len(rows)
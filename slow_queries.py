@@ -0,0 +1,166 @@
+"""Slow-query recorder with sampled, asynchronous EXPLAIN plans.
+
+metrics.InstrumentedCursor calls `record()` for every statement slower than
+SLOW_QUERY_MS. Statements are grouped by fingerprint (literals, placeholders
+and IN-lists normalised away) and per fingerprint we keep call sites, the shape
+of the bound parameters (types only, never values), row counts and timings.
+The first slow run of a SELECT fingerprint, and then at most one run every
+EXPLAIN_INTERVAL_SEC, is explained on a background thread with the same
+parameters so the plan matches what actually ran.
+
+Stats are per process; /admin/slow_queries shows the worker that served it.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pymysql.cursors
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+EXPLAIN_INTERVAL_SEC = int(os.getenv("EXPLAIN_INTERVAL_SEC", "600"))
+MAX_FINGERPRINTS = int(os.getenv("SLOW_QUERY_MAX_FINGERPRINTS", "500"))
+
+_COMMENT = re.compile(r"/\*.*?\*/", re.S)
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_PLACEHOLDER = re.compile(r"%s|%\(\w+\)s")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.I)
+_WHITESPACE = re.compile(r"\s+")
+
+_lock = threading.Lock()
+_stats = {}
+_explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+_connection_factory = None
+
+
+def configure(get_connection):
+    """Register the connection factory used for background EXPLAINs."""
+    global _connection_factory
+    _connection_factory = get_connection
+
+
+def fingerprint(sql):
+    text = _COMMENT.sub(" ", sql)
+    text = _STRING.sub("?", text)
+    text = _PLACEHOLDER.sub("?", text)
+    text = _NUMBER.sub("?", text)
+    text = _IN_LIST.sub("IN (...)", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def param_shape(args):
+    """Describe bound parameters by type, collapsing runs: e.g. `str x3, datetime`."""
+    if args is None:
+        return ""
+    if isinstance(args, dict):
+        return ", ".join(f"{k}:{type(v).__name__}" for k, v in args.items())
+    if not isinstance(args, (list, tuple)):
+        args = (args,)
+    parts = []
+    prev, run = None, 0
+    for a in args:
+        name = type(a).__name__
+        if name == prev:
+            run += 1
+            continue
+        if prev is not None:
+            parts.append(prev if run == 1 else f"{prev} x{run}")
+        prev, run = name, 1
+    if prev is not None:
+        parts.append(prev if run == 1 else f"{prev} x{run}")
+    return ", ".join(parts)
+
+
+def record(call_site, sql, args, rowcount, duration):
+    """Record one slow statement; schedules an EXPLAIN when this fingerprint is due for one."""
+    if not isinstance(sql, str) or sql.lstrip().upper().startswith("EXPLAIN"):
+        return
+    fp = fingerprint(sql)
+    key = hashlib.md5(fp.encode()).hexdigest()[:12]
+    shape = param_shape(args)
+    now = time.time()
+
+    print(f"Slow query {key} ({duration * 1000:.0f} ms, {rowcount} rows) at {call_site} [{shape}]: {fp[:200]}")
+
+    explain_due = False
+    with _lock:
+        entry = _stats.get(key)
+        if entry is None:
+            if len(_stats) >= MAX_FINGERPRINTS:
+                # drop the fingerprint that has cost the least so far
+                del _stats[min(_stats, key=lambda k: _stats[k]["total"])]
+            entry = _stats[key] = {
+                "fingerprint": fp, "count": 0, "total": 0.0, "max": 0.0, "rows": 0,
+                "call_sites": {}, "param_shapes": set(), "last_seen": None,
+                "explain": None, "explained_at": 0.0, "explain_pending": False,
+            }
+        entry["count"] += 1
+        entry["total"] += duration
+        entry["max"] = max(entry["max"], duration)
+        entry["rows"] += max(rowcount or 0, 0)
+        entry["call_sites"][call_site] = entry["call_sites"].get(call_site, 0) + 1
+        if len(entry["param_shapes"]) < 10:
+            entry["param_shapes"].add(shape)
+        entry["last_seen"] = now
+
+        is_select = fp.lstrip("( ").upper().startswith(("SELECT", "WITH"))
+        if (_connection_factory and is_select and not entry["explain_pending"]
+                and now - entry["explained_at"] >= EXPLAIN_INTERVAL_SEC):
+            entry["explain_pending"] = True
+            explain_due = True
+
+    if explain_due:
+        _explainer.submit(_explain, key, sql, args)
+
+
+def _explain(key, sql, args):
+    plan = None
+    try:
+        conn = _connection_factory()
+        try:
+            # plain DictCursor: the explain itself must not be instrumented/recorded
+            cur = conn.cursor(pymysql.cursors.DictCursor)
+            cur.execute("EXPLAIN " + sql, args)
+            plan = cur.fetchall()
+        finally:
+            conn.close()
+    except Exception as e:
+        plan = [{"error": str(e)}]
+    with _lock:
+        entry = _stats.get(key)
+        if entry is not None:
+            entry["explain"] = plan
+            entry["explained_at"] = time.time()
+            entry["explain_pending"] = False
+
+
+def _index_misses(plan):
+    """Tables in a plan read by a full table or full index scan."""
+    return [step.get("table") for step in plan or [] if step.get("type") in ("ALL", "index")]
+
+
+def top(limit=50):
+    """Fingerprints ordered by total time spent, formatted for the admin view."""
+    with _lock:
+        entries = sorted(_stats.items(), key=lambda kv: kv[1]["total"], reverse=True)[:limit]
+        result = []
+        for key, e in entries:
+            result.append({
+                "key": key,
+                "fingerprint": e["fingerprint"],
+                "count": e["count"],
+                "total_ms": round(e["total"] * 1000, 1),
+                "avg_ms": round(e["total"] / e["count"] * 1000, 1),
+                "max_ms": round(e["max"] * 1000, 1),
+                "avg_rows": round(e["rows"] / e["count"], 1),
+                "call_sites": sorted(e["call_sites"].items(), key=lambda kv: -kv[1]),
+                "param_shapes": sorted(e["param_shapes"]),
+                "last_seen": datetime.utcfromtimestamp(e["last_seen"]).isoformat() if e["last_seen"] else None,
+                "explain": e["explain"],
+                "index_misses": _index_misses(e["explain"]),
+            })
+    return result
@@ -3,7 +3,9 @@
   const siteId = s && s.getAttribute("data-site-id");
   if (!siteId) return;
 
-  const endpoint = "https://analytics-imvks.azurewebsites.net/collect";
+  // beacons go to whichever host served this script (the ingest tier)
+  const origin = s.src ? new URL(s.src).origin : "https://analytics-imvks.azurewebsites.net";
+  const endpoint = origin + "/collect";
 
   // ===============================
   // VISITOR ID (persistent)
@@ -42,27 +44,43 @@
   localStorage.setItem("_va_last_activity", now);
 
   // ===============================
-  // SEND EVENT
+  // EVENT IDS
+  // Deterministic per page view, so a retried beacon, a handler that fires
+  // twice or a second copy of this script on the page sends the same eventId
+  // and the server drops the duplicate.
+  // ===============================
+  const pageviews = (window.__va_pageviews = window.__va_pageviews || {});
+  const pageviewId = pageviews[siteId] || (pageviews[siteId] = crypto.randomUUID());
+
   // ===============================
-  function sendEvent(type, extra = {}) {
-    navigator.sendBeacon(
-      endpoint,
-      JSON.stringify({
-        siteId,
-        visitorId: vid,
-        sessionId,
-        eventType: type,
-        pageUrl: location.href,
-        pageTitle: window.document.title,
-        referrer: document.referrer,
-        userAgent: navigator.userAgent,
-        language: navigator.language,
-        platform: navigator.platform,
-        screenSize: screen.width + "x" + screen.height,
-        timezone: Intl.DateTimeFormat().resolvedOptions().timeZone,
-        ...extra
-      })
-    );
+  // SEND EVENT
+  // Browser attributes go out once per session, as the header of
+  // session_start (the server keeps them per sessionId); the referrer goes
+  // with the events of a page load. Other events carry only what changes.
+  // ===============================
+  const PAGE_LOAD_EVENTS = ["session_start", "first_visit", "page_view"];
+
+  function sendEvent(type, extra = {}, key = type) {
+    const payload = {
+      siteId,
+      visitorId: vid,
+      sessionId,
+      eventId: (pageviewId + ":" + key).slice(0, 128),
+      eventType: type,
+      pageUrl: location.href,
+      pageTitle: window.document.title.slice(0, 255)
+    };
+    if (type === "session_start") {
+      payload.userAgent = navigator.userAgent;
+      payload.language = navigator.language;
+      payload.platform = navigator.platform;
+      payload.screenSize = screen.width + "x" + screen.height;
+      payload.timezone = Intl.DateTimeFormat().resolvedOptions().timeZone;
+    }
+    if (PAGE_LOAD_EVENTS.indexOf(type) !== -1 && document.referrer) {
+      payload.referrer = document.referrer;
+    }
+    navigator.sendBeacon(endpoint, JSON.stringify(Object.assign(payload, extra)));
   }
 
   // ===============================
@@ -113,7 +131,7 @@
       const t = SCROLL_THRESHOLDS[i];
       if (percent >= t && !sentThresholds.has(t)) {
         sentThresholds.add(t);
-        sendEvent("scroll", { scrollPercent: percent, scrollThreshold: t });
+        sendEvent("scroll", { scrollPercent: percent, scrollThreshold: t }, "scroll:" + t);
       }
     }
   }, { passive: true });
@@ -128,7 +146,7 @@
     sendEvent("click", {
       clicked_url: link.href,
       is_external: link.host !== location.host
-    });
+    }, "click:" + Math.round(e.timeStamp));
   });
 
   // ===============================
@@ -169,7 +187,7 @@
                 selector: r.selector,
                 clicked_url: el.href || null,
                 rule_id: ruleId
-              });
+              }, "rule:" + ruleId + ":" + Math.round(e.timeStamp));
             });
           });
         })
@@ -0,0 +1,86 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import etl
+import ingest
+
+
+class FakeCursor:
+    def __init__(self, inserted):
+        self.inserted = inserted
+
+    def execute(self, sql, params=None):
+        pass
+
+    def executemany(self, sql, rows):
+        if sql == ingest._INSERT_EVENTS:
+            self.inserted.extend(rows)
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        return None
+
+
+class FakeConn:
+    def __init__(self, inserted):
+        self.inserted = inserted
+
+    def cursor(self):
+        return FakeCursor(self.inserted)
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+        self.inserted = []
+
+    @contextmanager
+    def connection(self):
+        yield FakeConn(self.inserted)
+
+
+def _event(created_at, event_id):
+    event = dict.fromkeys(ingest.EVENT_COLUMNS)
+    event.update(site_id="site", visitor_id="visitor", event_type="click", sample_weight=1.0,
+                 event_id=event_id, created_at=created_at, page_url="https://example.com/")
+    return event
+
+
+def test_late_flush_is_still_picked_up_by_the_pipeline(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(ingest, "_pool", pool)
+    created_at = ingest._STORED_COLUMNS.index("created_at")
+
+    queued = datetime.utcnow() - timedelta(seconds=3 * etl.ETL_SETTLE_SECONDS)
+    late = _event(queued, "late")
+    # while the event waited, a pipeline run moved the site's watermark as far as it can go
+    watermark = datetime.utcnow() - timedelta(seconds=etl.ETL_SETTLE_SECONDS)
+    prompt = _event(datetime.utcnow(), "prompt")
+
+    ingest._flush([late, prompt])
+
+    late_row, prompt_row = pool.inserted
+    # the pipeline reads rows with created_at past its watermark
+    assert late_row[created_at] > watermark
+    assert prompt_row[created_at] == prompt["created_at"]
+
+
+def test_replayed_events_keep_their_created_at(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(ingest, "_pool", pool)
+    created_at = ingest._STORED_COLUMNS.index("created_at")
+
+    old = datetime.utcnow() - timedelta(hours=1)
+    ingest._write_batch([_event(old, "spooled")])
+
+    assert pool.inserted[0][created_at] == old
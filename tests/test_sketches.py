@@ -0,0 +1,44 @@
+import sketches
+from sketches import MinuteSketch, SpaceSaving
+
+
+def test_users_of_page_entering_on_eviction():
+    s = MinuteSketch(capacity=2)
+    for page in (1, 2):
+        for v in range(100):
+            s.add(page, None, f"visitor-{page}-{v}", "page_view", None, 1.0)
+    s.add(3, None, "late-visitor", "page_view", None, 1.0)
+
+    top = {p["page_id"]: p for p in s.top_pages(2)}
+    # page 3 inherits the evicted page's count, but only one visitor viewed it
+    assert top[3]["views"] == 101
+    assert top[3]["error"] == 100
+    assert round(top[3]["users"]) == 1
+
+    restored = sketches.decode(sketches.encode(s))
+    assert round({p["page_id"]: p for p in restored.top_pages(2)}[3]["users"]) == 1
+
+
+def test_users_scaled_by_sample_weight():
+    s = MinuteSketch(capacity=2)
+    for v in range(10):
+        s.add(1, None, f"visitor-{v}", "page_view", None, 4.0)
+    assert round(s.top_pages(1)[0]["users"]) == 40
+
+
+def test_space_saving_merge():
+    a = SpaceSaving(capacity=3)
+    for key, weight in (("x", 5), ("y", 3), ("z", 1)):
+        a.offer(key, weight)
+    b = SpaceSaving(capacity=3)
+    for key, weight in (("x", 2), ("w", 4)):
+        b.offer(key, weight)
+
+    dropped = a.merge(b)
+
+    # keys missing from a full summary count as its minimum (1 for a), from a non-full one as 0
+    assert dropped == {"z"}
+    assert a.top(3) == [("x", 7, 0), ("w", 5, 1), ("y", 3, 0)]
+    # every count is within its error above the true count (x 7, w 4, y 3)
+    for key, count, error in a.top(3):
+        assert count - error <= {"x": 7, "w": 4, "y": 3}[key] <= count
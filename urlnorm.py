@@ -0,0 +1,139 @@
+"""Page URL normalization and UTM campaign extraction at ingest.
+
+`page_url` is stored as sent, but every report that groups by page groups on
+`page_path_id`: the dictionary id (url_dict) of the normalized URL, so
+`https://Example.com/pricing/?ref=nav#plans` and `https://example.com/pricing`
+are one page. Normalizing
+
+- lowercases scheme and host and drops the default port,
+- drops the fragment and a trailing slash (except on the root path),
+- drops the query string except the parameters on the allow-list: the global
+  URL_KEEP_PARAMS plus the site's `sites.url_query_params` (comma-separated,
+  e.g. `id,category` for sites that route on the query string); kept
+  parameters are sorted by name.
+
+utm_source, utm_medium and utm_campaign are read from the raw URL's query
+string (lowercased, at most UTM_MAX_LENGTH characters) into the indexed
+`events` columns of the same names, which the campaign report groups on.
+
+The batch writers call `annotate()` on each batch before it is written, so the
+ingest hot path only queues the raw event. `backfill_events()` sets
+`page_path_id` on rows written before normalization existed.
+"""
+import os
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import dictionary
+
+KEEP_PARAMS = frozenset(p.strip() for p in os.getenv("URL_KEEP_PARAMS", "").split(",") if p.strip())
+UTM_MAX_LENGTH = 100
+UTM_FIELDS = ("utm_source", "utm_medium", "utm_campaign")
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def site_params(value):
+    """The allow-list of a site's `url_query_params` column value."""
+    return KEEP_PARAMS | frozenset(p.strip() for p in (value or "").split(",") if p.strip())
+
+
+def normalize(url, keep=KEEP_PARAMS):
+    """The normalized form of a page URL; URLs that do not parse are returned unchanged."""
+    if not url:
+        return url
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if not host:
+        return url
+    if port and port != _DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    path = parts.path.rstrip("/") or "/"
+    query = ""
+    if keep and parts.query:
+        query = urlencode(sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k in keep))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+def campaign(url):
+    """(utm_source, utm_medium, utm_campaign) of a URL, None for the ones it lacks."""
+    if not url or "utm_" not in url:
+        return (None, None, None)
+    try:
+        params = dict(parse_qsl(urlsplit(url).query))
+    except ValueError:
+        return (None, None, None)
+    return tuple((params.get(f) or "").strip().lower()[:UTM_MAX_LENGTH] or None for f in UTM_FIELDS)
+
+
+def annotate(batch, sites):
+    """Set page_path and the utm_* fields on every event of a batch.
+
+    `sites` maps site_id to its settings (ingest's site cache), for the
+    per-site `url_query_params` allow-list.
+    """
+    seen = {}
+    for e in batch:
+        site = sites.get(e["site_id"]) or {}
+        key = (e["site_id"], e["page_url"])
+        derived = seen.get(key)
+        if derived is None:
+            derived = seen[key] = (normalize(e["page_url"], site_params(site.get("url_query_params"))),
+                                   *campaign(e["page_url"]))
+        e["page_path"], e["utm_source"], e["utm_medium"], e["utm_campaign"] = derived
+
+
+# ---------------- BACKFILL ----------------
+def backfill_events(conn, max_batches=None):
+    """Set page_path_id on older `events` rows from their page URL, with each site's allow-list.
+
+    Progress is kept in `watermark` ('events_page_path'), so the job can be
+    stopped and re-run. Returns the number of rows updated.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT site_id, url_query_params FROM sites")
+    keep = {site_id: site_params(params) for site_id, params in cur.fetchall()}
+    cur.execute("SELECT last_id FROM watermark WHERE tbl_name='events_page_path'")
+    row = cur.fetchone()
+    last_id = row[0] if row and row[0] else 0
+    conn.commit()
+
+    updated = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        cur.execute(
+            f"""
+            SELECT e.id, e.site_id, COALESCE(pu.value, e.page_url) FROM events e
+            LEFT JOIN {dictionary.URLS} pu ON pu.id = e.page_url_id
+            WHERE e.id > %s AND e.page_path_id IS NULL
+            ORDER BY e.id LIMIT %s
+            """,
+            (last_id, dictionary.BACKFILL_BATCH_ROWS)
+        )
+        rows = cur.fetchall()
+        conn.commit()
+        if not rows:
+            break
+
+        paths = {r[0]: normalize(r[2], keep.get(r[1], KEEP_PARAMS)) for r in rows if r[2]}
+        path_ids = dictionary.urls.ids(conn, list(paths.values()))
+        last_id = rows[-1][0]
+        cur.executemany(
+            "UPDATE events SET page_path_id=%s WHERE id=%s AND page_path_id IS NULL",
+            [(path_ids[path], event_id) for event_id, path in paths.items() if path in path_ids]
+        )
+        cur.execute(
+            """
+            INSERT INTO watermark (tbl_name, last_watermark, last_id) VALUES ('events_page_path', NOW(), %s)
+            ON DUPLICATE KEY UPDATE last_watermark=VALUES(last_watermark), last_id=VALUES(last_id)
+            """,
+            (last_id,)
+        )
+        conn.commit()
+        updated += len(paths)
+        batches += 1
+    return updated